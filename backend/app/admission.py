@@ -0,0 +1,204 @@
+"""Admission of runs, with concurrency limits and fair queuing.
+
+A run is admitted once executing it doesn't exceed any of the limits of the
+worker, configured with `RUNS_*` environment variables:
+
+- `RUNS_MAX_STREAMS`: streamed runs, 64 by default.
+- `RUNS_MAX_BACKGROUND`: other runs, 8 by default.
+- `RUNS_MAX_PER_USER`: runs of each user, 8 by default.
+- `RUNS_MAX_PER_ASSISTANT`: runs of each assistant, unlimited by default.
+- `RUNS_MAX_PER_MODEL`: runs by agent or LLM type, as a JSON object such as
+  `{"GPT 4 Turbo": 16}`, for the rate limits of model providers.
+
+Runs that can't be admitted yet wait in a queue per user, and users take
+turns: the oldest run of the next user that fits the limits is admitted
+first. Runs are rejected with `QueueFull` once `RUNS_MAX_QUEUED` runs (1000 by
+default) or `RUNS_MAX_QUEUED_PER_USER` runs of the user (100 by default) are
+waiting.
+"""
+
+import asyncio
+from collections import Counter, OrderedDict, deque
+from typing import Callable, Optional
+
+from pydantic import BaseSettings
+
+from app import metrics
+
+
+class AdmissionSettings(BaseSettings):
+    max_streams: Optional[int] = 64
+    max_background: Optional[int] = 8
+    max_per_user: Optional[int] = 8
+    max_per_assistant: Optional[int] = None
+    max_per_model: dict[str, int] = {}
+    max_queued: int = 1000
+    max_queued_per_user: int = 100
+
+    class Config:
+        env_prefix = "runs_"
+
+
+class QueueFull(Exception):
+    """Too many runs are waiting to be admitted."""
+
+
+def run_keys(kind: str, user_id: str, configurable: dict) -> tuple[str, ...]:
+    """The keys of the limits that apply to a run of `kind`, stream or
+    background, with an assistant's `configurable`."""
+    bot_type = configurable.get("type", "agent")
+    model = configurable.get(f"type=={bot_type}/agent_type") or configurable.get(
+        f"type=={bot_type}/llm_type"
+    )
+    keys = [f"kind:{kind}", f"user:{user_id}"]
+    if assistant_id := configurable.get("assistant_id"):
+        keys.append(f"assistant:{assistant_id}")
+    if model:
+        keys.append(f"model:{model}")
+    return tuple(keys)
+
+
+class Ticket:
+    """A run waiting to be admitted, and then executing."""
+
+    def __init__(
+        self,
+        user_id: str,
+        keys: tuple[str, ...],
+        on_position: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        self.user_id = user_id
+        self.keys = keys
+        self.on_position = on_position
+        self.position: Optional[int] = None
+        self.admitted = False
+        self._future = asyncio.get_running_loop().create_future()
+
+    async def wait(self) -> None:
+        """Wait until admitted."""
+        await self._future
+
+
+class Scheduler:
+    """Admits the runs of a worker."""
+
+    def __init__(self, settings: AdmissionSettings) -> None:
+        self.settings = settings
+        self.running: Counter[str] = Counter()
+        # In the order in which users take turns
+        self.queues: OrderedDict[str, deque[Ticket]] = OrderedDict()
+        self.queued = 0
+
+    def _limit(self, key: str) -> Optional[int]:
+        kind, _, name = key.partition(":")
+        if kind == "kind":
+            if name == "stream":
+                return self.settings.max_streams
+            return self.settings.max_background
+        if kind == "user":
+            return self.settings.max_per_user
+        if kind == "assistant":
+            return self.settings.max_per_assistant
+        return self.settings.max_per_model.get(name)
+
+    def _fits(self, ticket: Ticket) -> bool:
+        for key in ticket.keys:
+            limit = self._limit(key)
+            if limit is not None and self.running[key] >= limit:
+                return False
+        return True
+
+    def _admit(self, ticket: Ticket) -> None:
+        ticket.admitted = True
+        ticket.position = None
+        self.running.update(ticket.keys)
+        ticket._future.set_result(None)
+
+    def enqueue(
+        self,
+        user_id: str,
+        keys: tuple[str, ...],
+        on_position: Optional[Callable[[int], None]] = None,
+    ) -> Ticket:
+        """Admit a run, or queue it until it can be admitted.
+
+        `on_position` is called with the estimated position of the run in the
+        queue, starting from 1, whenever it changes.
+        """
+        ticket = Ticket(user_id, keys, on_position)
+        if self._fits(ticket):
+            self._admit(ticket)
+            return ticket
+        queue = self.queues.get(user_id)
+        if self.queued >= self.settings.max_queued or (
+            queue and len(queue) >= self.settings.max_queued_per_user
+        ):
+            metrics.incr("runs.rejected")
+            raise QueueFull()
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        queue.append(ticket)
+        self.queued += 1
+        metrics.incr("runs.queued")
+        self._update_positions()
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        """Release a run once over, or drop it from its queue if it wasn't
+        admitted."""
+        if ticket.admitted:
+            for key in ticket.keys:
+                self.running[key] -= 1
+                if not self.running[key]:
+                    del self.running[key]
+            ticket.admitted = False
+        elif (queue := self.queues.get(ticket.user_id)) and ticket in queue:
+            queue.remove(ticket)
+            self.queued -= 1
+            if not queue:
+                del self.queues[ticket.user_id]
+        else:
+            return
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Admit waiting runs, user by user."""
+        admitted = True
+        while admitted:
+            admitted = False
+            for user_id, queue in self.queues.items():
+                ticket = next(
+                    (t for t in queue if not t._future.done() and self._fits(t)),
+                    None,
+                )
+                if ticket is None:
+                    continue
+                queue.remove(ticket)
+                self.queued -= 1
+                if queue:
+                    self.queues.move_to_end(user_id)
+                else:
+                    del self.queues[user_id]
+                self._admit(ticket)
+                admitted = True
+                break
+        self._update_positions()
+
+    def _update_positions(self) -> None:
+        """Notify runs of their position: the number of runs admitted before
+        them if every user takes turns, plus one."""
+        lengths = [len(queue) for queue in self.queues.values()]
+        for turn, queue in enumerate(self.queues.values()):
+            for index, ticket in enumerate(queue):
+                position = index + 1
+                for other, length in enumerate(lengths):
+                    if other != turn:
+                        position += min(length, index + (other < turn))
+                if position != ticket.position:
+                    ticket.position = position
+                    if ticket.on_position is not None:
+                        ticket.on_position(position)
+
+
+scheduler = Scheduler(AdmissionSettings())
+metrics.register_gauge("runs.waiting", lambda: scheduler.queued)
@@ -1,15 +1,21 @@
-import pickle
+import os
+from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, Mapping, Optional, Sequence, Union
+from typing import Any, AsyncIterator, Dict, Mapping, Optional, Sequence, Union
 
+import orjson
 from langchain_core.messages import AnyMessage
 from langchain_core.runnables import (
     ConfigurableField,
+    Runnable,
     RunnableBinding,
+    RunnableConfig,
 )
-from langgraph.checkpoint import CheckpointAt
+from langchain_core.runnables.config import merge_configs
+from langchain_core.runnables.configurable import DynamicRunnable
+from langgraph.checkpoint import BaseCheckpointSaver, CheckpointAt
 from langgraph.graph.message import Messages
-from langgraph.pregel import Pregel
+from langgraph.pregel import Pregel, StateSnapshot
 
 from app.agent_types.tools_agent import get_tools_agent_executor
 from app.agent_types.xml_agent import get_xml_agent_executor
@@ -23,6 +29,7 @@ from app.llms import (
     get_openai_llm,
 )
 from app.retrieval import get_retrieval_executor
+from app.serde import get_serializer
 from app.tools import (
     RETRIEVAL_DESCRIPTION,
     TOOLS,
@@ -74,7 +81,13 @@ class AgentType(str, Enum):
 
 DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant."
 
-CHECKPOINTER = PostgresCheckpoint(serde=pickle, at=CheckpointAt.END_OF_STEP)
+CHECKPOINTER = PostgresCheckpoint(
+    serde=get_serializer(),
+    at=CheckpointAt.END_OF_STEP,
+    snapshot_interval=20,
+    blob_threshold=4096,
+    write_behind=os.getenv("CHECKPOINT_WRITE_BEHIND", "false").lower() == "true",
+)
 
 
 def get_agent_executor(
@@ -367,6 +380,72 @@ agent: Pregel = (
     )
 )
 
+
+def graph_key(configurable: Dict[str, Any]) -> str:
+    """A key equal for the configs that `build_graph` builds the same graph
+    for: those of runs on different threads, unless they retrieve the files of
+    their thread."""
+    bot_type = configurable.get("type", "agent")
+    tools = configurable.get(f"type=={bot_type}/tools") or []
+    if bot_type != "chat_retrieval" and not any(
+        tool["type"] == AvailableTools.RETRIEVAL for tool in tools
+    ):
+        configurable = {k: v for k, v in configurable.items() if k != "thread_id"}
+    return orjson.dumps(configurable, option=orjson.OPT_SORT_KEYS).decode()
+
+
+def build_graph(config: RunnableConfig) -> Runnable:
+    """The agent with its configurable fields and alternatives resolved for
+    `config`, to be run with configs of the same `graph_key` without building
+    it again every time."""
+    runnable, _ = agent.bound.prepare(config)
+    return runnable
+
+
+def _with_checkpointer(
+    config: RunnableConfig, checkpointer: BaseCheckpointSaver
+) -> tuple[Pregel, RunnableConfig]:
+    """The graph of the agent resolved for `config`, using `checkpointer`."""
+    graph: Runnable = agent
+    while not isinstance(graph, Pregel):
+        if isinstance(graph, DynamicRunnable):
+            graph, config = graph.prepare(config)
+        else:
+            config = merge_configs(graph.config, config)
+            graph = graph.bound
+    return graph.copy(update={"checkpointer": checkpointer}), config
+
+
+async def aget_state(
+    config: RunnableConfig,
+    *,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+    before_id: Optional[str] = None,
+) -> StateSnapshot:
+    """Get the state of a thread, with only a window of its messages if any of
+    `limit`, `offset` or `before_id` is given, see `window_checkpoint`."""
+    graph, config = _with_checkpointer(
+        config, CHECKPOINTER.window(limit=limit, offset=offset, before_id=before_id)
+    )
+    return await graph.aget_state(config)
+
+
+async def aget_state_history(
+    config: RunnableConfig,
+    *,
+    before: Optional[datetime] = None,
+    limit: Optional[int] = None,
+) -> AsyncIterator[StateSnapshot]:
+    """Get the states of a thread, most recent first: only those older than
+    `before`, up to `limit` of them."""
+    graph, config = _with_checkpointer(
+        config, CHECKPOINTER.page(before=before, limit=limit)
+    )
+    async for state in graph.aget_state_history(config):
+        yield state
+
+
 if __name__ == "__main__":
     import asyncio
 
@@ -1,12 +1,13 @@
-from typing import Annotated, List
+from datetime import datetime
+from typing import Annotated, List, Optional
 from uuid import uuid4
 
-from fastapi import APIRouter, HTTPException, Path
+from fastapi import APIRouter, HTTPException, Path, Query
 from pydantic import BaseModel, Field
 
 import app.storage as storage
 from app.auth.handlers import AuthedUser
-from app.schema import Assistant
+from app.schema import Assistant, UUIDStr
 
 router = APIRouter()
 
@@ -19,13 +20,42 @@ class AssistantPayload(BaseModel):
     public: bool = Field(default=False, description="Whether the assistant is public.")
 
 
-AssistantID = Annotated[str, Path(description="The ID of the assistant.")]
+AssistantID = Annotated[UUIDStr, Path(description="The ID of the assistant.")]
 
 
 @router.get("/")
-async def list_assistants(user: AuthedUser) -> List[Assistant]:
-    """List all assistants for the current user."""
-    return await storage.list_assistants(user["user_id"])
+async def list_assistants(
+    user: AuthedUser,
+    limit: Annotated[
+        Optional[int], Query(ge=1, description="The maximum number of assistants.")
+    ] = None,
+    before: Annotated[
+        Optional[datetime],
+        Query(description="Only return assistants updated before this time."),
+    ] = None,
+    before_id: Annotated[
+        Optional[str],
+        Query(
+            description="With `before`, return the assistants after the one with this ID."
+        ),
+    ] = None,
+    assistant_type: Annotated[
+        Optional[str], Query(description="Only return assistants of this type.")
+    ] = None,
+    name_prefix: Annotated[
+        Optional[str],
+        Query(description="Only return assistants whose name starts with this."),
+    ] = None,
+) -> List[Assistant]:
+    """List assistants for the current user, most recently updated first."""
+    return await storage.list_assistants(
+        user["user_id"],
+        limit=limit,
+        before=before,
+        before_id=before_id,
+        assistant_type=assistant_type,
+        name_prefix=name_prefix,
+    )
 
 
 @router.get("/public/")
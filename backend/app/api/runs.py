@@ -1,9 +1,22 @@
-from typing import Any, Dict, Optional, Sequence, Union
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Union,
+)
 from uuid import UUID
 
 import langsmith.client
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+import orjson
+import structlog
+from fastapi import APIRouter, Header, HTTPException
 from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
 from langchain.pydantic_v1 import ValidationError
 from langchain_core.messages import AnyMessage
 from langchain_core.runnables import RunnableConfig
@@ -11,10 +24,13 @@ from langsmith.utils import tracing_is_enabled
 from pydantic import BaseModel, Field
 from sse_starlette import EventSourceResponse
 
-from app.agent import agent
+import app.storage as storage
+from app import admission, runs
+from app.agent import agent, build_graph, graph_key
 from app.auth.handlers import AuthedUser
-from app.storage import get_assistant, get_thread
-from app.stream import astream_state, to_sse
+from app.schema import Assistant, Run, Thread, UUIDStr
+
+logger = structlog.get_logger(__name__)
 
 router = APIRouter()
 
@@ -22,33 +38,67 @@ router = APIRouter()
 class CreateRunPayload(BaseModel):
     """Payload for creating a run."""
 
-    thread_id: str
+    thread_id: UUIDStr
     input: Optional[Union[Sequence[AnyMessage], Dict[str, Any]]] = Field(
         default_factory=dict
     )
     config: Optional[RunnableConfig] = None
+    stream_mode: Literal["messages", "deltas"] = Field(
+        "messages",
+        description=(
+            "How messages being generated are streamed: as a whole on every "
+            "new chunk, or as `delta` events holding the new chunk only, to be "
+            "appended to the previous chunks of the message with the same id."
+        ),
+    )
 
 
-async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
-    thread = await get_thread(user_id, payload.thread_id)
-    if not thread:
-        raise HTTPException(status_code=404, detail="Thread not found")
+class BatchRun(BaseModel):
+    """A run of a batch."""
 
-    assistant = await get_assistant(user_id, str(thread["assistant_id"]))
-    if not assistant:
-        raise HTTPException(status_code=404, detail="Assistant not found")
+    thread_id: UUIDStr
+    input: Optional[Union[Sequence[AnyMessage], Dict[str, Any]]] = Field(
+        default_factory=dict
+    )
+    config: Optional[RunnableConfig] = None
+
+
+class CreateBatchRunPayload(BaseModel):
+    """Payload for creating runs on many threads."""
 
-    config: RunnableConfig = {
+    runs: List[BatchRun] = Field(..., max_items=10000)
+
+
+def _run_config(
+    user_id: str,
+    thread: Thread,
+    assistant: Assistant,
+    payload_config: Optional[RunnableConfig],
+) -> RunnableConfig:
+    return {
         **assistant["config"],
         "configurable": {
             **assistant["config"]["configurable"],
-            **((payload.config or {}).get("configurable") or {}),
+            **((payload_config or {}).get("configurable") or {}),
             "user_id": user_id,
             "thread_id": str(thread["thread_id"]),
             "assistant_id": str(assistant["assistant_id"]),
         },
     }
 
+
+async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
+    thread, assistant = await storage.get_thread_and_assistant(
+        user_id, payload.thread_id
+    )
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+
+    if not assistant:
+        raise HTTPException(status_code=404, detail="Assistant not found")
+
+    config = _run_config(user_id, thread, assistant, payload.config)
+
     try:
         if payload.input is not None:
             agent.get_input_schema(config).validate(payload.input)
@@ -62,12 +112,13 @@ async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
 async def create_run(
     payload: CreateRunPayload,
     user: AuthedUser,
-    background_tasks: BackgroundTasks,
-):
-    """Create a run."""
+) -> Run:
+    """Create a run, executed in the background."""
     input_, config = await _run_input_and_config(payload, user["user_id"])
-    background_tasks.add_task(agent.ainvoke, input_, config)
-    return {"status": "ok"}  # TODO add a run id
+    try:
+        return await runs.start_run(user["user_id"], agent, input_, config)
+    except admission.QueueFull:
+        raise HTTPException(status_code=429, detail="Too many runs queued")
 
 
 @router.post("/stream")
@@ -75,10 +126,134 @@ async def stream_run(
     payload: CreateRunPayload,
     user: AuthedUser,
 ):
-    """Create a run."""
+    """Create a run, and stream its events.
+
+    A run waiting to be admitted first sends `queue` events with its position.
+    The run goes on if the connection drops, and its events can be streamed
+    again from `/runs/{run_id}/stream`.
+    """
     input_, config = await _run_input_and_config(payload, user["user_id"])
+    try:
+        stream = await runs.start_stream(
+            user["user_id"],
+            agent,
+            input_,
+            config,
+            deltas=payload.stream_mode == "deltas",
+        )
+    except admission.QueueFull:
+        raise HTTPException(status_code=429, detail="Too many runs queued")
+    return EventSourceResponse(stream.subscribe())
 
-    return EventSourceResponse(to_sse(astream_state(agent, input_, config)))
+
+async def _batch_lines(
+    user_id: str, payload: CreateBatchRunPayload
+) -> AsyncIterator[bytes]:
+    resolved = await storage.get_threads_and_assistants(
+        user_id, [run.thread_id for run in payload.runs]
+    )
+    # Runs of the same assistant config share a graph
+    graphs: dict[str, Any] = {}
+    indexes: list[int] = []
+    valid: list[tuple] = []
+    for index, run in enumerate(payload.runs):
+        thread, assistant = resolved.get(run.thread_id, (None, None))
+        error: Any = None
+        if not thread:
+            error = "Thread not found"
+        elif not assistant:
+            error = "Assistant not found"
+        else:
+            config = _run_config(user_id, thread, assistant, run.config)
+            key = graph_key(config["configurable"])
+            try:
+                if key not in graphs:
+                    graphs[key] = (
+                        build_graph(config),
+                        agent.get_input_schema(config),
+                    )
+                graph, input_schema = graphs[key]
+                if run.input is not None:
+                    input_schema.validate(run.input)
+            except ValidationError as e:
+                error = e.errors()
+            except Exception:
+                logger.exception("failed to build graph")
+                error = "Internal Server Error"
+        if error is not None:
+            yield (
+                orjson.dumps(
+                    {"index": index, "thread_id": run.thread_id, "error": error}
+                )
+                + b"\n"
+            )
+        else:
+            indexes.append(index)
+            valid.append((graph, run.input, config))
+    if not valid:
+        return
+    async for ended in runs.run_batch(user_id, valid):
+        index = indexes[ended["index"]]
+        yield (
+            orjson.dumps(
+                {**ended, "index": index, "thread_id": payload.runs[index].thread_id}
+            )
+            + b"\n"
+        )
+
+
+@router.post("/batch")
+async def create_batch_run(
+    payload: CreateBatchRunPayload,
+    user: AuthedUser,
+) -> StreamingResponse:
+    """Create runs on many threads, streaming their outcome as JSON lines.
+
+    Each line holds the `index` of a run in the payload and its `thread_id`,
+    along with the `run_id`, `status` and `error` of the run once it ended.
+    Runs that couldn't be created come first, with an `error` only. Runs are
+    executed in the background, a few at once.
+    """
+    return StreamingResponse(
+        _batch_lines(user["user_id"], payload), media_type="application/x-ndjson"
+    )
+
+
+@router.get("/{run_id}/stream")
+async def resume_stream_run(
+    user: AuthedUser,
+    run_id: str,
+    last_event_id: Annotated[
+        Optional[int],
+        Header(description="Stream the events after the one with this ID."),
+    ] = None,
+):
+    """Stream the events of a run, from the start or after `Last-Event-ID`.
+
+    Once the run finished, events that are no longer buffered are replaced by
+    the messages of its final checkpoint.
+    """
+    if stream := runs.get_stream(user["user_id"], run_id):
+        return EventSourceResponse(stream.subscribe(last_event_id))
+    run = await storage.get_run(user["user_id"], run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    if run["status"] not in runs.ENDED:
+        # Executing on another replica
+        raise HTTPException(status_code=404, detail="Run stream not found")
+    _, assistant = await storage.get_thread_and_assistant(
+        user["user_id"], run["thread_id"]
+    )
+    if not assistant:
+        raise HTTPException(status_code=404, detail="Assistant not found")
+    config = {
+        "configurable": {
+            **assistant["config"]["configurable"],
+            "thread_id": run["thread_id"],
+            "assistant_id": assistant["assistant_id"],
+        }
+    }
+    return EventSourceResponse(runs.final_events(agent, config))
 
 
 @router.get("/input_schema")
@@ -99,6 +274,24 @@ async def config_schema() -> dict:
     return agent.config_schema().schema()
 
 
+@router.get("/{run_id}")
+async def get_run(user: AuthedUser, run_id: str) -> Run:
+    """Get a run by ID."""
+    run = await storage.get_run(user["user_id"], run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run
+
+
+@router.post("/{run_id}/cancel")
+async def cancel_run(user: AuthedUser, run_id: str) -> Run:
+    """Cancel a run, if not over yet."""
+    run = await runs.cancel(user["user_id"], run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run
+
+
 if tracing_is_enabled():
     langsmith_client = langsmith.client.Client()
 
@@ -1,18 +1,19 @@
+from datetime import datetime
 from typing import Annotated, Any, Dict, List, Optional, Sequence, Union
 from uuid import uuid4
 
-from fastapi import APIRouter, HTTPException, Path
+from fastapi import APIRouter, HTTPException, Path, Query
 from langchain.schema.messages import AnyMessage
 from pydantic import BaseModel, Field
 
 import app.storage as storage
 from app.auth.handlers import AuthedUser
-from app.schema import Thread
+from app.schema import Thread, UUIDStr
 
 router = APIRouter()
 
 
-ThreadID = Annotated[str, Path(description="The ID of the thread.")]
+ThreadID = Annotated[UUIDStr, Path(description="The ID of the thread.")]
 
 
 class ThreadPutRequest(BaseModel):
@@ -29,28 +30,86 @@ class ThreadPostRequest(BaseModel):
     config: Optional[Dict[str, Any]] = None
 
 
+class ThreadForkRequest(BaseModel):
+    """Payload for forking a thread."""
+
+    thread_ts: Optional[datetime] = Field(
+        None, description="The state to fork from, the latest one by default."
+    )
+    name: Optional[str] = Field(
+        None, description="The name of the new thread, that of the thread by default."
+    )
+
+
 @router.get("/")
-async def list_threads(user: AuthedUser) -> List[Thread]:
-    """List all threads for the current user."""
-    return await storage.list_threads(user["user_id"])
+async def list_threads(
+    user: AuthedUser,
+    limit: Annotated[
+        Optional[int], Query(ge=1, description="The maximum number of threads.")
+    ] = None,
+    before: Annotated[
+        Optional[datetime],
+        Query(description="Only return threads updated before this time."),
+    ] = None,
+    before_id: Annotated[
+        Optional[str],
+        Query(
+            description="With `before`, return the threads after the one with this ID."
+        ),
+    ] = None,
+    assistant_id: Annotated[
+        Optional[str], Query(description="Only return threads of this assistant.")
+    ] = None,
+    assistant_type: Annotated[
+        Optional[str],
+        Query(description="Only return threads of assistants of this type."),
+    ] = None,
+    name_prefix: Annotated[
+        Optional[str],
+        Query(description="Only return threads whose name starts with this."),
+    ] = None,
+) -> List[Thread]:
+    """List threads for the current user, most recently updated first."""
+    return await storage.list_threads(
+        user["user_id"],
+        limit=limit,
+        before=before,
+        before_id=before_id,
+        assistant_id=assistant_id,
+        assistant_type=assistant_type,
+        name_prefix=name_prefix,
+    )
 
 
 @router.get("/{tid}/state")
 async def get_thread_state(
     user: AuthedUser,
     tid: ThreadID,
+    limit: Annotated[
+        Optional[int], Query(ge=1, description="The maximum number of messages.")
+    ] = None,
+    offset: Annotated[
+        Optional[int],
+        Query(ge=0, description="The number of most recent messages to skip."),
+    ] = None,
+    before_message_id: Annotated[
+        Optional[str],
+        Query(description="Only return messages before the one with this ID."),
+    ] = None,
 ):
-    """Get state for a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    """Get state for a thread, or a window of its most recent messages."""
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.get_thread_state(
         user_id=user["user_id"],
         thread_id=tid,
         assistant=assistant,
+        limit=limit,
+        offset=offset,
+        before_message_id=before_message_id,
     )
 
 
@@ -61,10 +120,9 @@ async def add_thread_state(
     payload: ThreadPostRequest,
 ):
     """Add state to a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.update_thread_state(
@@ -79,19 +137,45 @@ async def add_thread_state(
 async def get_thread_history(
     user: AuthedUser,
     tid: ThreadID,
+    limit: Annotated[
+        Optional[int], Query(ge=1, description="The maximum number of states.")
+    ] = None,
+    before: Annotated[
+        Optional[datetime],
+        Query(description="Only return states older than this thread_ts."),
+    ] = None,
 ):
-    """Get all past states for a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    """Get past states for a thread, most recent first."""
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.get_thread_history(
         user_id=user["user_id"],
         thread_id=tid,
         assistant=assistant,
+        limit=limit,
+        before=before,
+    )
+
+
+@router.post("/{tid}/fork")
+async def fork_thread(
+    user: AuthedUser,
+    tid: ThreadID,
+    payload: ThreadForkRequest,
+) -> Thread:
+    """Create a thread starting from a state of another thread."""
+    thread = await storage.get_thread(user["user_id"], tid)
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    fork = await storage.fork_thread(
+        user["user_id"], thread, thread_ts=payload.thread_ts, name=payload.name
     )
+    if not fork:
+        raise HTTPException(status_code=404, detail="State not found")
+    return fork
 
 
 @router.get("/{tid}")
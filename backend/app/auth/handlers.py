@@ -1,16 +1,22 @@
+import hashlib
+import os
+import time
 from abc import ABC, abstractmethod
 from functools import lru_cache
 from typing import Annotated
 
 import jwt
-import requests
 from fastapi import Depends, HTTPException, Request
 from fastapi.security.http import HTTPBearer
 
 import app.storage as storage
+from app.auth import jwks
 from app.auth.settings import AuthType, settings
+from app.cache import LRUCache
 from app.schema import User
 
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
 
 class AuthHandler(ABC):
     @abstractmethod
@@ -28,17 +34,33 @@ class NOOPAuth(AuthHandler):
 
 
 class JWTAuthBase(AuthHandler):
+    """Verified claims are cached by token hash until the token expires, so
+    that requests with an already verified token skip its verification."""
+
+    def __init__(self) -> None:
+        self._verified: LRUCache[bytes, dict] = LRUCache(
+            "tokens", maxsize=TOKEN_CACHE_SIZE
+        )
+
     async def __call__(self, request: Request) -> User:
         http_bearer = await HTTPBearer()(request)
         token = http_bearer.credentials
+        payload = self._verify(token)
+        user, _ = await storage.get_or_create_user(payload["sub"])
+        return user
 
+    def _verify(self, token: str) -> dict:
+        key = hashlib.sha256(token.encode()).digest()
+        if payload := self._verified.get(key):
+            return payload
         try:
             payload = self.decode_token(token, self.get_decode_key(token))
         except jwt.PyJWTError as e:
             raise HTTPException(status_code=401, detail=str(e))
-
-        user, _ = await storage.get_or_create_user(payload["sub"])
-        return user
+        ttl = payload["exp"] - time.time()
+        if ttl > 0:
+            self._verified.set(key, payload, ttl=ttl)
+        return payload
 
     @abstractmethod
     def decode_token(self, token: str, decode_key: str) -> dict:
@@ -67,7 +89,11 @@ class JWTAuthLocal(JWTAuthBase):
 
 
 class JWTAuthOIDC(JWTAuthBase):
-    """Auth handler that uses OIDC discovery to get the decode key."""
+    """Auth handler that uses OIDC discovery to get the decode key.
+
+    Keys are fetched in the background, see `app.auth.jwks`, so that getting
+    the decode key of a token does no I/O.
+    """
 
     def decode_token(self, token: str, decode_key: str) -> dict:
         alg = self._decode_complete_unverified(token)["header"]["alg"]
@@ -86,20 +112,12 @@ class JWTAuthOIDC(JWTAuthBase):
         kid = unverified["header"].get("kid")
         return self._get_jwk_client(issuer).get_signing_key(kid).key
 
-    @lru_cache
     def _decode_complete_unverified(self, token: str) -> dict:
         return jwt.api_jwt.decode_complete(token, options={"verify_signature": False})
 
-    @lru_cache
-    def _get_jwk_client(self, issuer: str) -> jwt.PyJWKClient:
-        """
-        lru_cache ensures a single instance of PyJWKClient per issuer. This is
-        so that we can take advantage of jwks caching (and invalidation) handled
-        by PyJWKClient.
-        """
-        url = issuer.rstrip("/") + "/.well-known/openid-configuration"
-        config = requests.get(url).json()
-        return jwt.PyJWKClient(config["jwks_uri"], cache_jwk_set=True)
+    def _get_jwk_client(self, issuer: str) -> jwks.IssuerKeys:
+        """Only the configured issuer is trusted, and its keys fetched."""
+        return jwks.get_issuer_keys(issuer)
 
 
 @lru_cache(maxsize=1)
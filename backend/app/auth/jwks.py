@@ -0,0 +1,106 @@
+"""Signing keys of the OIDC issuer, for verifying tokens without I/O.
+
+The keys are fetched with OIDC discovery when the app starts, see
+`app.lifespan`, and refreshed in the background before the JWKS response
+expires: after 80% of its `Cache-Control: max-age`, or of
+`JWKS_REFRESH_INTERVAL` seconds (300 by default) if it has none. A token
+signed with an unknown key is rejected, and triggers an early refresh in
+case the keys were rotated, at most every `JWKS_MIN_REFRESH_INTERVAL`
+seconds (30 by default).
+"""
+
+import asyncio
+import os
+import re
+import time
+from typing import Optional
+
+import httpx
+import jwt
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+REFRESH_INTERVAL = float(os.getenv("JWKS_REFRESH_INTERVAL", "300"))
+MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30"))
+RETRY_INTERVAL = 10.0
+
+_issuers: dict[str, "IssuerKeys"] = {}
+
+
+def _max_age(cache_control: Optional[str]) -> Optional[float]:
+    if cache_control and (match := re.search(r"max-age=(\d+)", cache_control)):
+        return float(match.group(1))
+
+
+class IssuerKeys:
+    """The signing keys of an issuer, by key ID."""
+
+    def __init__(
+        self, issuer: str, *, transport: Optional[httpx.AsyncBaseTransport] = None
+    ) -> None:
+        self.issuer = issuer
+        self.keys: dict[str, jwt.PyJWK] = {}
+        self.transport = transport
+        self.max_age = REFRESH_INTERVAL
+        self._last_refresh = 0.0
+        self._wakeup = asyncio.Event()
+
+    def get_signing_key(self, kid: str) -> jwt.PyJWK:
+        """Get a key by ID, without I/O."""
+        if key := self.keys.get(kid):
+            return key
+        # The keys may have been rotated since the last refresh
+        self._wakeup.set()
+        raise jwt.PyJWKClientError(
+            f'Unable to find a signing key that matches: "{kid}"'
+        )
+
+    async def refresh(self) -> None:
+        """Fetch the keys, with OIDC discovery."""
+        self._last_refresh = time.monotonic()
+        url = self.issuer.rstrip("/") + "/.well-known/openid-configuration"
+        async with httpx.AsyncClient(transport=self.transport, timeout=10) as client:
+            config = (await client.get(url)).raise_for_status().json()
+            response = (await client.get(config["jwks_uri"])).raise_for_status()
+        key_set = jwt.PyJWKSet.from_dict(response.json())
+        self.keys = {key.key_id: key for key in key_set.keys}
+        max_age = _max_age(response.headers.get("cache-control"))
+        self.max_age = max_age or REFRESH_INTERVAL
+
+    async def _try_refresh(self) -> float:
+        """Refresh the keys, returning the delay until the next refresh."""
+        try:
+            await self.refresh()
+            return self.max_age * 0.8
+        except Exception:
+            logger.exception("failed to fetch signing keys", issuer=self.issuer)
+            return RETRY_INTERVAL
+
+    async def run(self, delay: float) -> None:
+        """Refresh the keys after `delay` seconds, and then whenever they are
+        about to expire or an unknown key is seen, until cancelled."""
+        while True:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            wait = self._last_refresh + MIN_REFRESH_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            delay = await self._try_refresh()
+
+
+def get_issuer_keys(issuer: str) -> IssuerKeys:
+    """Get the keys of an issuer started with `start`."""
+    if keys := _issuers.get(issuer):
+        return keys
+    raise jwt.PyJWKClientError(f"Unknown issuer: {issuer}")
+
+
+async def start(issuer: str, **kwargs) -> asyncio.Task:
+    """Fetch the keys of `issuer`, and keep them refreshed in a task."""
+    keys = _issuers[issuer] = IssuerKeys(issuer, **kwargs)
+    delay = await keys._try_refresh()
+    return asyncio.create_task(keys.run(delay))
@@ -0,0 +1,98 @@
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, TypeVar
+
+from app import metrics
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """A least recently used cache bounded by entry count and total size.
+
+    Sizes are given by the caller when setting a value, in whatever unit the
+    `maxbytes` bound uses. With `ttl`, values expire that many seconds after
+    they were set. Hits, misses and evictions are recorded as
+    `cache.<name>.*` metrics.
+
+    All methods are synchronous, so they are atomic with respect to other
+    coroutines running on the event loop.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        maxsize: int,
+        maxbytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.nbytes = 0
+        # Values with their size and expiry time
+        self._data: OrderedDict[K, tuple[V, int, float]] = OrderedDict()
+        metrics.register_gauge(f"cache.{name}.entries", lambda: len(self._data))
+        metrics.register_gauge(f"cache.{name}.bytes", lambda: self.nbytes)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self._entry(key) is not None
+
+    def _entry(self, key: K) -> Optional[tuple[V, int, float]]:
+        entry = self._data.get(key)
+        if entry is not None and entry[2] <= time.monotonic():
+            self.pop(key)
+            metrics.incr(f"cache.{self.name}.expirations")
+            return None
+        return entry
+
+    def get(self, key: K) -> Optional[V]:
+        """Get a value, marking it as recently used."""
+        if (entry := self._entry(key)) is None:
+            metrics.incr(f"cache.{self.name}.misses")
+            return None
+        metrics.incr(f"cache.{self.name}.hits")
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def peek(self, key: K) -> Optional[V]:
+        """Get a value without marking it as used or recording metrics."""
+        if entry := self._entry(key):
+            return entry[0]
+
+    def set(
+        self, key: K, value: V, *, size: int = 0, ttl: Optional[float] = None
+    ) -> None:
+        """Set a value, evicting the least recently used values if needed.
+
+        `ttl` overrides the cache TTL for this value.
+        """
+        self.pop(key)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl is not None else float("inf")
+        self._data[key] = (value, size, expires)
+        self.nbytes += size
+        while len(self._data) > self.maxsize or (
+            self.maxbytes is not None and self.nbytes > self.maxbytes
+        ):
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self.nbytes -= evicted_size
+            metrics.incr(f"cache.{self.name}.evictions")
+
+    def pop(self, key: K) -> Optional[V]:
+        """Remove a value, returning it if it was present."""
+        if entry := self._data.pop(key, None):
+            self.nbytes -= entry[1]
+            return entry[0]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.nbytes = 0
@@ -1,8 +1,25 @@
+import asyncio
+import contextlib
+import copy
+import functools
+import hashlib
 import pickle
-from datetime import datetime
-from typing import AsyncIterator, Optional
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterator,
+    Mapping,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+)
 
+import structlog
 from langchain_core.messages import BaseMessage
+from langchain_core.pydantic_v1 import BaseModel
 from langchain_core.runnables import ConfigurableFieldSpec, RunnableConfig
 from langgraph.checkpoint import BaseCheckpointSaver
 from langgraph.checkpoint.base import (
@@ -11,27 +28,619 @@ from langgraph.checkpoint.base import (
     CheckpointThreadTs,
     CheckpointTuple,
     SerializerProtocol,
+    copy_checkpoint,
 )
 
+from app import metrics
+from app.cache import LRUCache
 from app.lifespan import get_pg_pool
+from app.serde import DATA_KEY, TYPE_KEY, is_pickle, revive
+
+logger = structlog.get_logger(__name__)
+
+# A delta is only written if its base is still the latest checkpoint stored
+# before it: the base was taken from the cache, and compaction or another
+# replica may have deleted it, or written newer checkpoints, since.
+UPSERT_CHECKPOINT = """
+INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, base_ts, checkpoint, blobs)
+SELECT $1, $2, $3, $4, $5, $6
+WHERE $4::timestamptz IS NULL OR $4 = (
+    SELECT max(thread_ts) FROM checkpoints WHERE thread_id = $1 AND thread_ts < $2
+)
+ON CONFLICT (thread_id, thread_ts)
+DO UPDATE SET checkpoint = EXCLUDED.checkpoint, base_ts = EXCLUDED.base_ts, blobs = EXCLUDED.blobs,
+    base_thread_id = NULL
+RETURNING thread_ts;"""
+
+# The deltas of a batch that weren't written, see UPSERT_CHECKPOINT.
+MISSING_DELTAS = """
+SELECT k.thread_id, k.thread_ts
+FROM unnest($1::text[], $2::timestamptz[], $3::timestamptz[]) AS k(thread_id, thread_ts, base_ts)
+WHERE NOT EXISTS (
+    SELECT 1 FROM checkpoints c
+    WHERE c.thread_id = k.thread_id AND c.thread_ts = k.thread_ts
+    AND c.base_ts = k.base_ts AND c.base_thread_id IS NULL
+);"""
+
+# The first checkpoint of a fork is an empty delta against a checkpoint of
+# another thread, the latest one unless $5 is given.
+INSERT_FORK = """
+INSERT INTO checkpoints (thread_id, thread_ts, base_thread_id, base_ts, checkpoint)
+SELECT $1, $2, thread_id, thread_ts, $3 FROM checkpoints
+WHERE thread_id = $4 AND ($5::timestamptz IS NULL OR thread_ts = $5)
+ORDER BY thread_ts DESC LIMIT 1
+RETURNING base_ts;"""
+
+# Blobs already stored are touched, at most hourly, so that compaction doesn't
+# collect them while checkpoints referencing them are being written.
+UPSERT_BLOB = """
+INSERT INTO checkpoint_blobs (hash, data) VALUES ($1, $2)
+ON CONFLICT (hash) DO UPDATE SET touched_at = CURRENT_TIMESTAMP
+WHERE checkpoint_blobs.touched_at < CURRENT_TIMESTAMP - INTERVAL '1 hour';"""
+
+BLOB_KEY = "__blob"
+
+
+def _rehydrate(value: Any) -> Any:
+    """Rebuild messages pickled with an older layout of their classes."""
+    if isinstance(value, list) and all(isinstance(v, BaseMessage) for v in value):
+        return [
+            v if v.__fields__.keys() <= v.__dict__.keys() else v.__class__(**v.__dict__)
+            for v in value
+        ]
+    return value
+
+
+class _Thunk:
+    """Computes a channel value on demand, or parts of it if it is a list."""
+
+    def __call__(self) -> Any:
+        raise NotImplementedError
+
+    def length(self) -> Optional[int]:
+        value = self()
+        return len(value) if isinstance(value, list) else None
+
+    def slice(self, start: int, stop: int) -> list:
+        return self()[start:stop]
+
+    def ids(self) -> list[Optional[str]]:
+        return [getattr(v, "id", None) for v in self()]
+
+
+def _raw_id(value: Any) -> Optional[str]:
+    if isinstance(value, BaseMessage):
+        return value.id
+    if isinstance(value, dict) and ":" in str(value.get(TYPE_KEY)):
+        # Tagged with its class, as models are
+        data = value[DATA_KEY]
+        return data.get("id") if isinstance(data, dict) else None
+
+
+class _Revive(_Thunk):
+    """A value revived from its decoded form, see `app.serde.revive`."""
+
+    def __init__(self, raw: Any, revive: Callable[[Any], Any]) -> None:
+        self.raw = raw
+        self.revive = revive
+
+    def __call__(self) -> Any:
+        return self.revive(self.raw)
+
+    def length(self) -> Optional[int]:
+        return len(self.raw) if isinstance(self.raw, list) else None
+
+    def slice(self, start: int, stop: int) -> list:
+        return self.revive(self.raw[start:stop])
+
+    def ids(self) -> list[Optional[str]]:
+        return [_raw_id(v) for v in self.raw]
+
+
+class _Get(_Thunk):
+    """A value of other channel values."""
+
+    def __init__(self, values: Mapping[str, Any], key: str) -> None:
+        self.values = values
+        self.key = key
+
+    def __call__(self) -> Any:
+        return self.values[self.key]
+
+    def length(self) -> Optional[int]:
+        return channel_length(self.values, self.key)
+
+    def slice(self, start: int, stop: int) -> list:
+        return channel_slice(self.values, self.key, start, stop)
+
+    def ids(self) -> list[Optional[str]]:
+        return channel_ids(self.values, self.key)
+
+
+def _deep_copy(value: Any) -> Any:
+    """Deep copy a channel value, several times faster than `copy.deepcopy`
+    for messages."""
+    cls = value.__class__
+    if cls is str or cls is int or cls is float or cls is bool or value is None:
+        return value
+    if cls is list:
+        return [_deep_copy(v) for v in value]
+    if cls is dict:
+        return {k: _deep_copy(v) for k, v in value.items()}
+    if isinstance(value, BaseModel):
+        # As pydantic's copy(deep=True) does, without deep copying str fields
+        copied = cls.__new__(cls)
+        object.__setattr__(
+            copied, "__dict__", {k: _deep_copy(v) for k, v in value.__dict__.items()}
+        )
+        object.__setattr__(copied, "__fields_set__", set(value.__fields_set__))
+        for name in cls.__private_attributes__:
+            if hasattr(value, name):
+                object.__setattr__(copied, name, _deep_copy(getattr(value, name)))
+        return copied
+    return copy.deepcopy(value)
+
+
+class _Copy(_Get):
+    """A deep copy of a value of other channel values."""
+
+    def __call__(self) -> Any:
+        return _deep_copy(super().__call__())
+
+    def slice(self, start: int, stop: int) -> list:
+        return _deep_copy(super().slice(start, stop))
+
+
+class _Concat(_Thunk):
+    """A list value of other channel values, with items appended."""
+
+    def __init__(
+        self, values: Mapping[str, Any], appends: Mapping[str, Any], key: str
+    ) -> None:
+        self.values = values
+        self.appends = appends
+        self.key = key
+
+    def __call__(self) -> Any:
+        return self.values[self.key] + self.appends[self.key]
+
+    def length(self) -> Optional[int]:
+        return channel_length(self.values, self.key) + channel_length(
+            self.appends, self.key
+        )
+
+    def slice(self, start: int, stop: int) -> list:
+        split = channel_length(self.values, self.key)
+        head = (
+            channel_slice(self.values, self.key, start, min(stop, split))
+            if start < split
+            else []
+        )
+        tail = (
+            channel_slice(self.appends, self.key, max(start - split, 0), stop - split)
+            if stop > split
+            else []
+        )
+        return head + tail
+
+    def ids(self) -> list[Optional[str]]:
+        return channel_ids(self.values, self.key) + channel_ids(self.appends, self.key)
+
 
+class _Window(_Thunk):
+    """A window of a list value, see `window_checkpoint`."""
 
-def loads(value: bytes) -> Checkpoint:
-    loaded: Checkpoint = pickle.loads(value)
-    for key, value in loaded["channel_values"].items():
-        if isinstance(value, list) and all(isinstance(v, BaseMessage) for v in value):
-            loaded["channel_values"][key] = [v.__class__(**v.__dict__) for v in value]
+    def __init__(
+        self,
+        values: Mapping[str, Any],
+        key: str,
+        limit: Optional[int],
+        offset: Optional[int],
+        before_id: Optional[str],
+    ) -> None:
+        self.values = values
+        self.key = key
+        self.limit = limit
+        self.offset = offset
+        self.before_id = before_id
+
+    def __call__(self) -> Any:
+        length = channel_length(self.values, self.key)
+        if length is None:
+            return self.values[self.key]
+        if self.before_id is not None:
+            ids = channel_ids(self.values, self.key)
+            stop = ids.index(self.before_id) if self.before_id in ids else 0
+        else:
+            stop = max(length - (self.offset or 0), 0)
+        start = max(stop - self.limit, 0) if self.limit else 0
+        return channel_slice(self.values, self.key, start, stop)
+
+
+class LazyChannelValues(MutableMapping[str, Any]):
+    """Channel values, each computed on first access.
+
+    Values are given as thunks computing them, so that reviving the messages
+    of a checkpoint is only paid for the channels that are read. Parts of list
+    values can be read without computing the whole list, see `channel_slice`.
+    Copies share the values computed so far, like copies of a dict would.
+    """
+
+    def __init__(self, thunks: dict[str, _Thunk]) -> None:
+        self._thunks = thunks
+        self._values: dict[str, Any] = {}
+
+    @classmethod
+    def revive(
+        cls, raw: dict[str, Any], revive: Callable[[Any], Any]
+    ) -> "LazyChannelValues":
+        return cls({k: _Revive(v, revive) for k, v in raw.items()})
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = self._thunks[key]()
+            return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._values[key] = value
+        self._thunks[key] = _Get(self._values, key)
+
+    def __delitem__(self, key: str) -> None:
+        del self._thunks[key]
+        self._values.pop(key, None)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._thunks)
+
+    def __len__(self) -> int:
+        return len(self._thunks)
+
+    def copy(self) -> "LazyChannelValues":
+        return LazyChannelValues({k: _Get(self, k) for k in self._thunks})
+
+
+def channel_length(values: Mapping[str, Any], key: str) -> Optional[int]:
+    """The length of a list channel value, or None if it isn't a list."""
+    if isinstance(values, LazyChannelValues) and key not in values._values:
+        return values._thunks[key].length()
+    value = values[key]
+    return len(value) if isinstance(value, list) else None
+
+
+def channel_slice(values: Mapping[str, Any], key: str, start: int, stop: int) -> list:
+    """Items `start` to `stop` of a list channel value, only reviving those."""
+    if isinstance(values, LazyChannelValues) and key not in values._values:
+        return values._thunks[key].slice(start, stop)
+    return values[key][start:stop]
+
+
+def channel_ids(values: Mapping[str, Any], key: str) -> list[Optional[str]]:
+    """The ids of the messages of a list channel value, without reviving them."""
+    if isinstance(values, LazyChannelValues) and key not in values._values:
+        return values._thunks[key].ids()
+    return [getattr(v, "id", None) for v in values[key]]
+
+
+def window_checkpoint(
+    checkpoint: Checkpoint,
+    *,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+    before_id: Optional[str] = None,
+) -> Checkpoint:
+    """Get a checkpoint with only a window of the messages of its list channels.
+
+    The window ends `offset` messages before the end of the list, or right
+    before the message with id `before_id`, and holds at most `limit` messages.
+    Only the messages in the window are revived.
+    """
+    values = checkpoint["channel_values"]
+    return {
+        **checkpoint,
+        "channel_values": LazyChannelValues(
+            {k: _Window(values, k, limit, offset, before_id) for k in values}
+        ),
+    }
+
+
+def _seen_dict() -> defaultdict[str, int]:
+    return defaultdict(int)
+
+
+def loads(
+    value: bytes,
+    serde: SerializerProtocol = pickle,
+    blobs: Optional[Mapping[bytes, bytes]] = None,
+) -> dict[str, Any]:
+    """Load a checkpoint, or a delta, written by `PostgresCheckpoint`.
+
+    Channel values are revived lazily, see `LazyChannelValues`. Message
+    contents stored out of line are taken from `blobs`, by hash.
+    """
+    if is_pickle(value):
+        loaded = serde.loads(value)
+        revive_value = _rehydrate
+    else:
+        loaded = serde.decode(value)
+        revive_value = revive
+    # Versions are dumped as plain dicts, see `PostgresCheckpoint._dump`. Fork
+    # deltas have none, they keep those of their base
+    if "channel_versions" in loaded:
+        loaded["channel_versions"] = defaultdict(int, loaded["channel_versions"])
+        loaded["versions_seen"] = defaultdict(
+            _seen_dict,
+            {k: defaultdict(int, v) for k, v in loaded["versions_seen"].items()},
+        )
+    if blobs:
+        revive_value = functools.partial(_resolve_blobs, revive_value, blobs, serde)
+    for key in ("channel_values", "channel_appends"):
+        if key in loaded:
+            loaded[key] = LazyChannelValues.revive(loaded[key], revive_value)
     return loaded
 
 
+def dumps(payload: dict[str, Any], serde: SerializerProtocol = pickle) -> bytes:
+    """Dump a checkpoint, or a delta, to be read by `loads`."""
+    if "channel_versions" in payload:
+        # Serializers keep the types of values, `loads` makes these
+        # defaultdicts again
+        payload = {
+            **payload,
+            "channel_versions": dict(payload["channel_versions"]),
+            "versions_seen": {k: dict(v) for k, v in payload["versions_seen"].items()},
+        }
+    return serde.dumps(payload)
+
+
+def _plain(checkpoint: Checkpoint) -> Checkpoint:
+    """Get a checkpoint with its channel values in a plain dict, for dumping."""
+    if isinstance(checkpoint["channel_values"], LazyChannelValues):
+        return {**checkpoint, "channel_values": dict(checkpoint["channel_values"])}
+    return checkpoint
+
+
+def _freeze(checkpoint: Checkpoint) -> Checkpoint:
+    """Copy a checkpoint so that later in-place updates of its channel values
+    (eg. by the graph that produced it) can't leak into a delta base."""
+    frozen = copy_checkpoint(checkpoint)
+    if isinstance(frozen["channel_values"], LazyChannelValues):
+        # Loaded checkpoints only hand out values computed from their rows
+        return frozen
+    for key, value in frozen["channel_values"].items():
+        if isinstance(value, (list, dict, set)):
+            frozen["channel_values"][key] = value.copy()
+    return frozen
+
+
+def _detach(checkpoint: Checkpoint) -> Checkpoint:
+    """Copy a cached checkpoint for a caller, who may update it in place.
+
+    Channel values are deep copied when read, so reads of a window of a list
+    only copy the messages in it.
+    """
+    detached = copy_checkpoint(checkpoint)
+    values = checkpoint["channel_values"]
+    detached["channel_values"] = LazyChannelValues(
+        {k: _Copy(values, k) for k in values}
+    )
+    return detached
+
+
+def _externalize(
+    payload: dict[str, Any], serde: SerializerProtocol, threshold: int
+) -> tuple[dict[str, Any], dict[bytes, bytes]]:
+    """Move message contents of `threshold` bytes or more out of a checkpoint,
+    or a delta, to blobs addressed by the hash of their serialized form.
+
+    Returns the payload with those contents replaced by references, and the
+    blobs by hash.
+    """
+    blobs: dict[bytes, bytes] = {}
+
+    def _message(message: Any) -> Any:
+        if not isinstance(message, BaseMessage) or (
+            isinstance(message.content, str) and len(message.content) < threshold
+        ):
+            return message
+        data = serde.dumps(message.content)
+        if len(data) < threshold:
+            return message
+        digest = hashlib.sha256(data).digest()
+        blobs[digest] = data
+        return message.copy(update={"content": {BLOB_KEY: digest.hex()}})
+
+    payload = dict(payload)
+    for key in ("channel_values", "channel_appends"):
+        if key in payload:
+            payload[key] = {
+                k: [_message(m) for m in v] if isinstance(v, list) else v
+                for k, v in payload[key].items()
+            }
+    return payload, blobs
+
+
+def _resolve_blobs(
+    revive_value: Callable[[Any], Any],
+    blobs: Mapping[bytes, bytes],
+    serde: SerializerProtocol,
+    value: Any,
+) -> Any:
+    """Revive a channel value, putting back message contents moved to blobs."""
+    value = revive_value(value)
+    if not isinstance(value, list):
+        return value
+    return [
+        m.copy(
+            update={"content": serde.loads(blobs[bytes.fromhex(m.content[BLOB_KEY])])}
+        )
+        if isinstance(m, BaseMessage)
+        and isinstance(m.content, dict)
+        and BLOB_KEY in m.content
+        else m
+        for m in value
+    ]
+
+
+def diff_checkpoint(base: Checkpoint, checkpoint: Checkpoint) -> dict[str, Any]:
+    """Compute the changes needed to turn `base` into `checkpoint`.
+
+    List channels (eg. messages) that only grew since `base` are recorded as
+    appends, so the size of a delta depends on the new content only.
+    """
+    base_values = base["channel_values"]
+    values: dict[str, Any] = {}
+    appends: dict[str, list] = {}
+    for key, value in checkpoint["channel_values"].items():
+        if key not in base_values:
+            values[key] = value
+            continue
+        previous = base_values[key]
+        if value is previous:
+            continue
+        if (
+            isinstance(value, list)
+            and isinstance(previous, list)
+            and len(value) >= len(previous)
+            and all(a is b or a == b for a, b in zip(previous, value))
+        ):
+            if len(value) > len(previous):
+                appends[key] = value[len(previous) :]
+        elif value != previous:
+            values[key] = value
+    return {
+        "v": checkpoint["v"],
+        "ts": checkpoint["ts"],
+        "channel_values": values,
+        "channel_appends": appends,
+        "channel_deletes": [
+            key for key in base_values if key not in checkpoint["channel_values"]
+        ],
+        "channel_versions": checkpoint["channel_versions"],
+        "versions_seen": checkpoint["versions_seen"],
+    }
+
+
+def apply_delta(base: Checkpoint, delta: dict[str, Any]) -> Checkpoint:
+    """Rebuild a checkpoint from its base and the delta computed against it.
+
+    Channel values are only computed when read, from the base or the delta.
+    Versions and format version missing from the delta are the base's, as is
+    the case for the first checkpoint of a fork.
+    """
+    base_values = base["channel_values"]
+    values: dict[str, _Thunk] = {
+        key: _Get(base_values, key)
+        for key in base_values
+        if key not in delta["channel_deletes"]
+    }
+    for key in delta["channel_values"]:
+        values[key] = _Get(delta["channel_values"], key)
+    for key in delta["channel_appends"]:
+        values[key] = _Concat(base_values, delta["channel_appends"], key)
+    if "channel_versions" not in delta:
+        return Checkpoint(
+            v=delta.get("v", base["v"]),
+            ts=delta["ts"],
+            channel_values=LazyChannelValues(values),
+            channel_versions=defaultdict(int, base["channel_versions"]),
+            versions_seen=defaultdict(
+                _seen_dict,
+                {k: defaultdict(int, v) for k, v in base["versions_seen"].items()},
+            ),
+        )
+    return Checkpoint(
+        v=delta["v"],
+        ts=delta["ts"],
+        channel_values=LazyChannelValues(values),
+        channel_versions=delta["channel_versions"],
+        versions_seen=delta["versions_seen"],
+    )
+
+
+class StoredCheckpoint(NamedTuple):
+    thread_ts: datetime
+    parent_ts: Optional[datetime]
+    checkpoint: Checkpoint
+    depth: int
+    """The number of deltas between this checkpoint and its snapshot."""
+    size: int
+    """The serialized size of this checkpoint and the rows it is built from."""
+
+
 class PostgresCheckpoint(BaseCheckpointSaver):
+    """Checkpoint saver backed by the `checkpoints` table.
+
+    If `snapshot_interval` is set, checkpoints are stored as deltas against the
+    previous checkpoint written for the same thread, with a full snapshot at
+    least every `snapshot_interval` rows. Reads rebuild the state from the
+    nearest snapshot and the deltas that follow it. A delta is only written
+    if its base is still the latest checkpoint stored for the thread, and as
+    a snapshot otherwise.
+
+    The latest checkpoint of recently used threads is kept in an LRU cache,
+    bounded by `cache_size` threads and `cache_bytes` of serialized data.
+    Writes go through the cache, so a thread doesn't have to read back and
+    decode its own last write. Latest checkpoint reads still check that the
+    cached checkpoint is the latest one in the database, which only reads
+    the primary key index. Cached channel values are deep copied when first
+    accessed, so callers may update the checkpoints they get in place.
+
+    With `write_behind`, `aput` queues rows in memory instead of writing them
+    right away. Queued rows are written in a single round trip once
+    `flush_rows` are queued, or `flush_interval` seconds after the first one
+    was queued. Reading a thread with queued rows flushes them first. Call
+    `aclose` on shutdown to write the rows still queued.
+
+    With `blob_threshold`, message contents (eg. tool outputs) that serialize
+    to that many bytes or more are stored once in the `checkpoint_blobs`
+    table, and checkpoints only hold their hash. Blobs are fetched along with
+    the checkpoints referencing them, and kept in an LRU cache bounded by
+    `blob_cache_bytes`.
+
+    Threads forked with `afork` start with a delta against a checkpoint of
+    the thread they were forked from, which reads follow like any other base.
+    """
+
     def __init__(
         self,
         *,
         serde: Optional[SerializerProtocol] = None,
         at: Optional[CheckpointAt] = None,
+        snapshot_interval: Optional[int] = None,
+        cache_size: int = 1024,
+        cache_bytes: int = 128 * 1024 * 1024,
+        write_behind: bool = False,
+        flush_interval: float = 0.005,
+        flush_rows: int = 100,
+        blob_threshold: Optional[int] = None,
+        blob_cache_bytes: int = 64 * 1024 * 1024,
     ) -> None:
         super().__init__(serde=serde, at=at)
+        self.snapshot_interval = snapshot_interval
+        self.latest: LRUCache[str, StoredCheckpoint] = LRUCache(
+            "checkpoints", maxsize=cache_size, maxbytes=cache_bytes
+        )
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        # Rows waiting to be written, and being written, keyed by primary key,
+        # with their blobs and, for deltas, the checkpoint to write as a
+        # snapshot instead if their base turns out to be stale
+        self._pending: dict[
+            tuple[str, datetime], tuple[tuple, dict, Optional[Checkpoint]]
+        ] = {}
+        self._flushing: dict[
+            tuple[str, datetime], tuple[tuple, dict, Optional[Checkpoint]]
+        ] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_timer: Optional[asyncio.Task] = None
+        metrics.register_gauge("checkpoints.pending", lambda: len(self._pending))
+        self.blob_threshold = blob_threshold
+        self.blobs: LRUCache[bytes, bytes] = LRUCache(
+            "checkpoint_blobs", maxsize=4096, maxbytes=blob_cache_bytes
+        )
 
     @property
     def config_specs(self) -> list[ConfigurableFieldSpec]:
@@ -53,95 +662,494 @@ class PostgresCheckpoint(BaseCheckpointSaver):
     def put(self, config: RunnableConfig, checkpoint: Checkpoint) -> RunnableConfig:
         raise NotImplementedError
 
-    async def alist(self, config: RunnableConfig) -> AsyncIterator[CheckpointTuple]:
-        async with get_pg_pool().acquire() as db, db.transaction():
-            thread_id = config["configurable"]["thread_id"]
-            async for value in db.cursor(
-                "SELECT checkpoint, thread_ts, parent_ts FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts DESC",
-                thread_id,
+    def _remember(self, thread_id: str, stored: StoredCheckpoint) -> None:
+        """Cache a checkpoint, unless a more recent one is already cached."""
+        current = self.latest.peek(thread_id)
+        if current is not None and current.thread_ts >= stored.thread_ts:
+            return
+        self.latest.set(
+            thread_id,
+            stored._replace(checkpoint=_freeze(stored.checkpoint)),
+            size=stored.size,
+        )
+
+    def _tuple(self, thread_id: str, stored: StoredCheckpoint) -> CheckpointTuple:
+        return CheckpointTuple(
+            {
+                "configurable": {
+                    "thread_id": thread_id,
+                    "thread_ts": stored.thread_ts,
+                }
+            },
+            stored.checkpoint,
+            {
+                "configurable": {
+                    "thread_id": thread_id,
+                    "thread_ts": stored.parent_ts,
+                }
+            }
+            if stored.parent_ts
+            else None,
+        )
+
+    async def _fetch(
+        self, conn, thread_id: str, where: str, *args: Any
+    ) -> list[tuple[StoredCheckpoint, bool]]:
+        """Fetch the checkpoints matching `where`, rebuilt from their snapshots.
+
+        Every scan of `checkpoints` is filtered on thread_id = $1, so that
+        only the partition holding the thread is read. The base of the first
+        checkpoint of a fork is in another thread, and fetched separately.
+
+        Returns checkpoints sorted by ascending thread_ts, each with a flag
+        that is False for rows only fetched as the base of a matching delta.
+        """
+        rows = await conn.fetch(
+            f"""
+            WITH RECURSIVE matched AS (
+                SELECT thread_ts FROM checkpoints WHERE thread_id = $1 {where}
+            ), chain AS (
+                SELECT thread_ts FROM matched
+                UNION
+                SELECT c.base_ts
+                FROM checkpoints c JOIN chain USING (thread_ts)
+                WHERE c.thread_id = $1 AND c.base_ts IS NOT NULL
+                AND c.base_thread_id IS NULL
+            )
+            SELECT c.thread_ts, c.parent_ts, c.base_thread_id, c.base_ts, c.checkpoint, c.blobs,
+                m.thread_ts IS NOT NULL
+            FROM chain
+            JOIN checkpoints c USING (thread_ts)
+            LEFT JOIN matched m USING (thread_ts)
+            WHERE c.thread_id = $1
+            ORDER BY c.thread_ts""",
+            thread_id,
+            *args,
+        )
+        blobs = await self._load_blobs(
+            conn, {digest for row in rows for digest in row["blobs"] or ()}
+        )
+        built: dict[datetime, StoredCheckpoint] = {}
+        results = []
+        for thread_ts, parent_ts, base_thread_id, base_ts, value, _, is_match in rows:
+            if base_thread_id is not None:
+                base = await self._fork_base(conn, base_thread_id, base_ts)
+            else:
+                base = built.get(base_ts)
+            if base_ts is None:
+                stored = StoredCheckpoint(
+                    thread_ts, parent_ts, loads(value, self.serde, blobs), 0, len(value)
+                )
+            elif base:
+                stored = StoredCheckpoint(
+                    thread_ts,
+                    parent_ts,
+                    apply_delta(base.checkpoint, loads(value, self.serde, blobs)),
+                    base.depth + 1,
+                    base.size + len(value),
+                )
+            else:
+                raise ValueError(
+                    f"Checkpoint {thread_id}/{thread_ts} is missing its base {base_ts}"
+                )
+            built[thread_ts] = stored
+            results.append((stored, is_match))
+        return results
+
+    async def _fork_base(
+        self, conn, thread_id: str, thread_ts: datetime
+    ) -> Optional[StoredCheckpoint]:
+        """Get the checkpoint a thread was forked from."""
+        cached = self.latest.peek(thread_id)
+        if cached is not None and cached.thread_ts == thread_ts:
+            return cached._replace(checkpoint=_detach(cached.checkpoint))
+        rows = await self._fetch(conn, thread_id, "AND thread_ts = $2", thread_ts)
+        return rows[-1][0] if rows else None
+
+    async def _load_blobs(self, conn, digests: set[bytes]) -> dict[bytes, bytes]:
+        blobs = {digest: self.blobs.get(digest) for digest in digests}
+        if missing := [digest for digest, data in blobs.items() if data is None]:
+            for digest, data in await conn.fetch(
+                "SELECT hash, data FROM checkpoint_blobs WHERE hash = ANY($1)", missing
             ):
-                yield CheckpointTuple(
-                    {
-                        "configurable": {
-                            "thread_id": thread_id,
-                            "thread_ts": value[1],
-                        }
-                    },
-                    loads(value[0]),
-                    {
-                        "configurable": {
-                            "thread_id": thread_id,
-                            "thread_ts": value[2],
-                        }
-                    }
-                    if value[2]
-                    else None,
+                blobs[digest] = data
+                self.blobs.set(digest, data, size=len(data))
+        return blobs
+
+    def _dump(self, payload: dict[str, Any]) -> tuple[bytes, dict[bytes, bytes]]:
+        """Serialize a checkpoint or delta, along with the blobs it references."""
+        blobs = {}
+        if self.blob_threshold is not None:
+            payload, blobs = _externalize(payload, self.serde, self.blob_threshold)
+        return dumps(payload, self.serde), blobs
+
+    async def _write(
+        self,
+        conn,
+        rows: list[tuple],
+        blobs: dict[bytes, bytes],
+        checkpoints: Mapping[tuple[str, datetime], Checkpoint],
+    ) -> None:
+        """Write rows, and their blobs, in a transaction.
+
+        Deltas that aren't written because their base is no longer the latest
+        checkpoint of their thread are written as snapshots of `checkpoints`,
+        by primary key, instead.
+        """
+        async with conn.transaction():
+            if blobs:
+                await conn.executemany(UPSERT_BLOB, list(blobs.items()))
+            if len(rows) == 1:
+                if await conn.fetchval(UPSERT_CHECKPOINT, *rows[0]):
+                    return
+                missing = [rows[0]]
+            else:
+                await conn.executemany(UPSERT_CHECKPOINT, rows)
+                deltas = [row for row in rows if row[3] is not None]
+                if not deltas:
+                    return
+                keys = {
+                    tuple(key)
+                    for key in await conn.fetch(
+                        MISSING_DELTAS,
+                        [row[0] for row in deltas],
+                        [row[1] for row in deltas],
+                        [row[3] for row in deltas],
+                    )
+                }
+                missing = [row for row in deltas if row[:2] in keys]
+            if not missing:
+                return
+            metrics.incr("checkpoints.stale_bases", len(missing))
+            snapshots, snapshot_blobs = [], {}
+            for thread_id, thread_ts, parent_ts, *_ in missing:
+                value, blobs = self._dump(_plain(checkpoints[(thread_id, thread_ts)]))
+                snapshot_blobs.update(blobs)
+                snapshots.append(
+                    (thread_id, thread_ts, parent_ts, None, value, list(blobs) or None)
                 )
+                # Later deltas of the thread are built on the snapshot
+                cached = self.latest.peek(thread_id)
+                if cached is not None and cached.thread_ts == thread_ts:
+                    self.latest.set(
+                        thread_id,
+                        cached._replace(depth=0, size=len(value)),
+                        size=len(value),
+                    )
+            if snapshot_blobs:
+                await conn.executemany(UPSERT_BLOB, list(snapshot_blobs.items()))
+            await conn.executemany(UPSERT_CHECKPOINT, snapshots)
+
+    def _has_pending(self, thread_id: str) -> bool:
+        return any(
+            key[0] == thread_id
+            for rows in (self._pending, self._flushing)
+            for key in rows
+        )
+
+    async def aflush(self) -> None:
+        """Write all queued rows."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            try:
+                async with get_pg_pool().acquire() as conn:
+                    await self._write(
+                        conn,
+                        [row for row, _, _ in self._flushing.values()],
+                        {
+                            digest: data
+                            for _, blobs, _ in self._flushing.values()
+                            for digest, data in blobs.items()
+                        },
+                        {
+                            key: checkpoint
+                            for key, (_, _, checkpoint) in self._flushing.items()
+                        },
+                    )
+                metrics.incr("checkpoints.flushes")
+                metrics.incr("checkpoints.flushed_rows", len(self._flushing))
+            except BaseException:
+                # Keep the rows queued, unless they were queued again since
+                self._pending = {**self._flushing, **self._pending}
+                raise
+            finally:
+                self._flushing = {}
+
+    async def aclose(self) -> None:
+        """Cancel the pending flush timer, and write all queued rows."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_timer
+            self._flush_timer = None
+        await self.aflush()
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.aflush()
+        except Exception:
+            logger.exception("failed to write checkpoints")
+
+    async def _flush_if_pending(self, thread_id: str) -> None:
+        if self._has_pending(thread_id):
+            await self.aflush()
+
+    async def alist(
+        self,
+        config: RunnableConfig,
+        *,
+        before: Optional[datetime] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        """List checkpoints of a thread, most recent first.
+
+        Only checkpoints older than `before` are listed, up to `limit` of them.
+        Graphs list a page of history with a saver returned by `page`.
+        """
+        thread_id = config["configurable"]["thread_id"]
+        await self._flush_if_pending(thread_id)
+        where, args = "", []
+        if before:
+            args.append(before)
+            where += f" AND thread_ts < ${len(args) + 1}"
+        if limit:
+            args.append(limit)
+            where += f" ORDER BY thread_ts DESC LIMIT ${len(args) + 1}"
+        async with get_pg_pool().acquire() as db:
+            rows = await self._fetch(db, thread_id, where, *args)
+        for stored, is_match in reversed(rows):
+            if is_match:
+                yield self._tuple(thread_id, stored)
+
+    def page(
+        self, *, before: Optional[datetime] = None, limit: Optional[int] = None
+    ) -> "CheckpointPage":
+        """This saver, listing only checkpoints older than `before`, up to
+        `limit` of them."""
+        return CheckpointPage(self, before=before, limit=limit)
+
+    def window(
+        self,
+        *,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        before_id: Optional[str] = None,
+    ) -> "CheckpointWindow":
+        """This saver, getting checkpoints with only a window of the messages
+        of their list channels, see `window_checkpoint`."""
+        return CheckpointWindow(self, limit=limit, offset=offset, before_id=before_id)
 
     async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """Get a checkpoint of a thread, the latest one unless `thread_ts` is given.
+
+        Graphs read a window of its messages with a saver returned by `window`.
+        """
         thread_id = config["configurable"]["thread_id"]
         thread_ts = config["configurable"].get("thread_ts")
+        if thread_ts and not isinstance(thread_ts, datetime):
+            thread_ts = datetime.fromisoformat(thread_ts)
+        stored = await self._get(thread_id, thread_ts)
+        if stored is None:
+            return None
+        return self._tuple(thread_id, stored)
+
+    async def _get(
+        self, thread_id: str, thread_ts: Optional[datetime]
+    ) -> Optional[StoredCheckpoint]:
+        await self._flush_if_pending(thread_id)
         async with get_pg_pool().acquire() as conn:
-            if thread_ts:
-                if value := await conn.fetchrow(
-                    "SELECT checkpoint, parent_ts FROM checkpoints WHERE thread_id = $1 AND thread_ts = $2",
-                    thread_id,
-                    datetime.fromisoformat(thread_ts),
-                ):
-                    return CheckpointTuple(
-                        config,
-                        loads(value[0]),
-                        {
-                            "configurable": {
-                                "thread_id": thread_id,
-                                "thread_ts": value[1],
-                            }
-                        }
-                        if value[1]
-                        else None,
+            if cached := self.latest.get(thread_id):
+                if thread_ts is None:
+                    latest_ts = await conn.fetchval(
+                        "SELECT thread_ts FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts DESC LIMIT 1",
+                        thread_id,
                     )
+                    if latest_ts != cached.thread_ts:
+                        metrics.incr("cache.checkpoints.stale")
+                        cached = None
+                elif thread_ts != cached.thread_ts:
+                    cached = None
+                if cached:
+                    return cached._replace(checkpoint=_detach(cached.checkpoint))
+            if thread_ts:
+                rows = await self._fetch(
+                    conn, thread_id, "AND thread_ts = $2", thread_ts
+                )
             else:
-                if value := await conn.fetchrow(
-                    "SELECT checkpoint, thread_ts, parent_ts FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts DESC LIMIT 1",
+                rows = await self._fetch(
+                    conn, thread_id, "ORDER BY thread_ts DESC LIMIT 1"
+                )
+                if rows:
+                    self._remember(thread_id, rows[-1][0])
+            if rows:
+                # The cache may share its values
+                stored = rows[-1][0]
+                return stored._replace(checkpoint=_detach(stored.checkpoint))
+
+    async def arebase(self, thread_id: str, thread_ts: datetime) -> None:
+        """Rewrite a delta as a full snapshot, so that the checkpoints it is built
+        from can be deleted."""
+        await self._flush_if_pending(thread_id)
+        async with get_pg_pool().acquire() as conn, conn.transaction():
+            rows = await self._fetch(conn, thread_id, "AND thread_ts = $2", thread_ts)
+            if rows and rows[-1][0].depth:
+                value, blobs = self._dump(_plain(rows[-1][0].checkpoint))
+                if blobs:
+                    await conn.executemany(UPSERT_BLOB, list(blobs.items()))
+                await conn.execute(
+                    "UPDATE checkpoints SET checkpoint = $3, base_ts = NULL, base_thread_id = NULL, blobs = $4 WHERE thread_id = $1 AND thread_ts = $2",
                     thread_id,
-                ):
-                    return CheckpointTuple(
-                        {
-                            "configurable": {
-                                "thread_id": thread_id,
-                                "thread_ts": value[1],
-                            }
-                        },
-                        loads(value[0]),
-                        {
-                            "configurable": {
-                                "thread_id": thread_id,
-                                "thread_ts": value[2],
-                            }
-                        }
-                        if value[2]
-                        else None,
-                    )
+                    thread_ts,
+                    value,
+                    list(blobs) or None,
+                )
+
+    async def afork(
+        self, config: RunnableConfig, thread_id: str
+    ) -> Optional[RunnableConfig]:
+        """Fork a thread into `thread_id`, from the checkpoint `config` points
+        at, or the latest one of its thread.
+
+        The fork is a single empty delta against that checkpoint, so it takes
+        constant time and space whatever the size of the thread. Returns the
+        config of the fork, or None if there is no checkpoint to fork from.
+        """
+        source_id = config["configurable"]["thread_id"]
+        source_ts = config["configurable"].get("thread_ts")
+        if source_ts and not isinstance(source_ts, datetime):
+            source_ts = datetime.fromisoformat(source_ts)
+        await self._flush_if_pending(source_id)
+        thread_ts = datetime.now(timezone.utc)
+        value = self.serde.dumps(
+            {
+                "ts": thread_ts.isoformat(),
+                "channel_values": {},
+                "channel_appends": {},
+                "channel_deletes": [],
+            }
+        )
+        async with get_pg_pool().acquire() as conn:
+            if not await conn.fetchval(
+                INSERT_FORK, thread_id, thread_ts, value, source_id, source_ts
+            ):
+                return None
+        metrics.incr("checkpoints.forks")
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "thread_ts": thread_ts.isoformat(),
+            }
+        }
 
     async def aput(self, config: RunnableConfig, checkpoint: Checkpoint) -> None:
         thread_id = config["configurable"]["thread_id"]
-        async with get_pg_pool().acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, checkpoint)
-                VALUES ($1, $2, $3, $4) 
-                ON CONFLICT (thread_id, thread_ts) 
-                DO UPDATE SET checkpoint = EXCLUDED.checkpoint;""",
-                thread_id,
-                datetime.fromisoformat(checkpoint["ts"]),
-                datetime.fromisoformat(checkpoint.get("parent_ts"))
-                if checkpoint.get("parent_ts")
-                else None,
-                pickle.dumps(checkpoint),
+        parent_ts = checkpoint.get("parent_ts") or config["configurable"].get(
+            "thread_ts"
+        )
+        if isinstance(parent_ts, str):
+            parent_ts = datetime.fromisoformat(parent_ts)
+        thread_ts = datetime.fromisoformat(checkpoint["ts"])
+        # Store a delta against the latest checkpoint we know of for this
+        # thread, unless it is time for a new snapshot.
+        base = self.latest.peek(thread_id)
+        if (
+            self.snapshot_interval is not None
+            and base is not None
+            and base.depth + 1 < self.snapshot_interval
+            and base.thread_ts < thread_ts
+        ):
+            value, blobs = self._dump(diff_checkpoint(base.checkpoint, checkpoint))
+            stored = StoredCheckpoint(
+                thread_ts, parent_ts, checkpoint, base.depth + 1, base.size + len(value)
             )
+            base_ts = base.thread_ts
+        else:
+            value, blobs = self._dump(_plain(checkpoint))
+            stored = StoredCheckpoint(thread_ts, parent_ts, checkpoint, 0, len(value))
+            base_ts = None
+        row = (thread_id, thread_ts, parent_ts, base_ts, value, list(blobs) or None)
+        if self.write_behind:
+            # Frozen, as the graph goes on updating its channel values
+            self._pending[(thread_id, thread_ts)] = (
+                row,
+                blobs,
+                _freeze(checkpoint) if base_ts else None,
+            )
+            if len(self._pending) >= self.flush_rows:
+                await self.aflush()
+            elif self._flush_timer is None or self._flush_timer.done():
+                self._flush_timer = asyncio.create_task(self._flush_later())
+        else:
+            async with get_pg_pool().acquire() as conn:
+                await self._write(
+                    conn, [row], blobs, {(thread_id, thread_ts): checkpoint}
+                )
+        self._remember(thread_id, stored)
         return {
             "configurable": {
                 "thread_id": thread_id,
                 "thread_ts": checkpoint["ts"],
             }
         }
+
+
+class CheckpointPage(BaseCheckpointSaver):
+    """A read only view of a saver, listing a single page of history."""
+
+    def __init__(
+        self,
+        saver: PostgresCheckpoint,
+        *,
+        before: Optional[datetime] = None,
+        limit: Optional[int] = None,
+    ) -> None:
+        super().__init__(serde=saver.serde, at=saver.at)
+        self.saver = saver
+        self.before = before
+        self.limit = limit
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await self.saver.aget_tuple(config)
+
+    async def alist(self, config: RunnableConfig) -> AsyncIterator[CheckpointTuple]:
+        async for checkpoint in self.saver.alist(
+            config, before=self.before, limit=self.limit
+        ):
+            yield checkpoint
+
+
+class CheckpointWindow(BaseCheckpointSaver):
+    """A read only view of a saver, getting checkpoints with only a window of
+    their messages."""
+
+    def __init__(
+        self,
+        saver: PostgresCheckpoint,
+        *,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        before_id: Optional[str] = None,
+    ) -> None:
+        super().__init__(serde=saver.serde, at=saver.at)
+        self.saver = saver
+        self.limit = limit
+        self.offset = offset
+        self.before_id = before_id
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        saved = await self.saver.aget_tuple(config)
+        if saved is None or (
+            self.limit is None and self.offset is None and self.before_id is None
+        ):
+            return saved
+        return saved._replace(
+            checkpoint=window_checkpoint(
+                saved.checkpoint,
+                limit=self.limit,
+                offset=self.offset,
+                before_id=self.before_id,
+            )
+        )
@@ -0,0 +1,264 @@
+"""Background compaction of the checkpoints table.
+
+Checkpoints are deleted according to the retention policies configured with
+`CHECKPOINT_*` environment variables:
+
+- `CHECKPOINT_KEEP_LAST`: keep only the last N checkpoints of each thread.
+- `CHECKPOINT_KEEP_BOUNDARIES_AFTER_DAYS`: for checkpoints older than this,
+  keep only the first and last checkpoint of each run.
+- `CHECKPOINT_DROP_DELETED_THREADS`: drop the checkpoints of deleted threads.
+
+Checkpoints younger than `CHECKPOINT_COMPACTION_MIN_AGE` seconds are never
+deleted. Threads are processed in chunks, and rows are deleted in batches of
+`CHECKPOINT_COMPACTION_BATCH_SIZE`, newest first, so that deltas are always
+deleted before the checkpoints they are built from. Deltas that are kept but
+whose base is deleted, including the first checkpoint of threads forked from
+a deleted checkpoint, are first rewritten as full snapshots. Blobs no longer
+referenced by any checkpoint are deleted last.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+from uuid import UUID
+
+import structlog
+from pydantic import BaseSettings
+
+from app import metrics
+from app.checkpoint import PostgresCheckpoint
+from app.lifespan import get_pg_pool
+
+logger = structlog.get_logger(__name__)
+
+
+class CompactionSettings(BaseSettings):
+    keep_last: Optional[int] = None
+    keep_boundaries_after_days: Optional[float] = None
+    drop_deleted_threads: bool = False
+    compaction_interval: float = 3600
+    compaction_min_age: float = 3600
+    compaction_batch_size: int = 1000
+    compaction_thread_chunk: int = 100
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.keep_last is not None
+            or self.keep_boundaries_after_days is not None
+            or self.drop_deleted_threads
+        )
+
+    class Config:
+        env_prefix = "checkpoint_"
+
+
+class CompactionResult(NamedTuple):
+    rows: int
+    """The number of checkpoints deleted."""
+    blobs: int
+    """The number of blobs deleted."""
+    bytes: int
+    """The size of the checkpoints and blobs deleted."""
+
+
+async def _delete(conn, keys: list[tuple[str, datetime]]) -> tuple[int, int]:
+    """Delete checkpoints, except those still needed as the base of a delta,
+    in the same thread or in a fork."""
+    deleted = await conn.fetch(
+        """
+        WITH batch AS (
+            SELECT * FROM unnest($1::text[], $2::timestamptz[]) AS d(thread_id, thread_ts)
+        )
+        DELETE FROM checkpoints c USING batch
+        WHERE c.thread_id = ANY($1)
+        AND c.thread_id = batch.thread_id AND c.thread_ts = batch.thread_ts
+        AND NOT EXISTS (
+            SELECT 1 FROM checkpoints b
+            WHERE b.thread_id = c.thread_id AND b.base_ts = c.thread_ts
+            AND b.base_thread_id IS NULL
+            AND (b.thread_id, b.thread_ts) NOT IN (SELECT thread_id, thread_ts FROM batch)
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM checkpoints b
+            WHERE b.base_thread_id = c.thread_id AND b.base_ts = c.thread_ts
+            AND (b.thread_id, b.thread_ts) NOT IN (SELECT thread_id, thread_ts FROM batch)
+        )
+        RETURNING octet_length(c.checkpoint)""",
+        [k[0] for k in keys],
+        [k[1] for k in keys],
+    )
+    return len(deleted), sum(r[0] or 0 for r in deleted)
+
+
+async def _compact_threads(
+    checkpointer: PostgresCheckpoint,
+    settings: CompactionSettings,
+    thread_ids: list[str],
+) -> tuple[int, int]:
+    now = datetime.now(timezone.utc)
+    min_age_cutoff = now - timedelta(seconds=settings.compaction_min_age)
+    boundaries_cutoff = (
+        now - timedelta(days=settings.keep_boundaries_after_days)
+        if settings.keep_boundaries_after_days is not None
+        else None
+    )
+    async with get_pg_pool().acquire() as conn:
+        deleted_threads = set()
+        if settings.drop_deleted_threads:
+            # Checkpoint thread ids that aren't UUIDs have no thread, others
+            # are looked up by primary key.
+            uuids = {}
+            for thread_id in thread_ids:
+                try:
+                    uuids[str(UUID(thread_id))] = thread_id
+                except ValueError:
+                    deleted_threads.add(thread_id)
+            deleted_threads.update(
+                uuids[r[0]]
+                for r in await conn.fetch(
+                    """
+                    SELECT t FROM unnest($1::uuid[]) t
+                    WHERE NOT EXISTS (SELECT 1 FROM thread WHERE thread_id = t)""",
+                    list(uuids),
+                )
+            )
+        # A checkpoint is at a run boundary if it is the first of a run (it
+        # has no parent), or the last one (the next one has no parent).
+        rows = await conn.fetch(
+            """
+            SELECT thread_id, thread_ts, base_thread_id, base_ts,
+                row_number() OVER (PARTITION BY thread_id ORDER BY thread_ts DESC),
+                parent_ts IS NULL
+                    OR lead(thread_ts) OVER w IS NULL
+                    OR lead(parent_ts) OVER w IS NULL
+            FROM checkpoints
+            WHERE thread_id = ANY($1)
+            WINDOW w AS (PARTITION BY thread_id ORDER BY thread_ts)""",
+            thread_ids,
+        )
+        # The first checkpoints of threads forked from these threads
+        forks = await conn.fetch(
+            """
+            SELECT thread_id, thread_ts, base_thread_id, base_ts FROM checkpoints
+            WHERE base_thread_id = ANY($1)""",
+            thread_ids,
+        )
+    doomed = set()
+    for thread_id, thread_ts, _, _, rank, boundary in rows:
+        if thread_id in deleted_threads:
+            doomed.add((thread_id, thread_ts))
+        elif thread_ts >= min_age_cutoff:
+            continue
+        elif settings.keep_last is not None and rank > settings.keep_last:
+            doomed.add((thread_id, thread_ts))
+        elif (
+            boundaries_cutoff is not None
+            and thread_ts < boundaries_cutoff
+            and not boundary
+        ):
+            doomed.add((thread_id, thread_ts))
+    if not doomed:
+        return 0, 0
+
+    for thread_id, thread_ts, base_thread_id, base_ts, *_ in [*rows, *forks]:
+        if (
+            base_ts is not None
+            and (base_thread_id or thread_id, base_ts) in doomed
+            and (thread_id, thread_ts) not in doomed
+        ):
+            await checkpointer.arebase(thread_id, thread_ts)
+
+    count, nbytes = 0, 0
+    doomed_keys = sorted(doomed, key=lambda k: k[1], reverse=True)
+    for i in range(0, len(doomed_keys), settings.compaction_batch_size):
+        async with get_pg_pool().acquire() as conn:
+            batch_count, batch_bytes = await _delete(
+                conn, doomed_keys[i : i + settings.compaction_batch_size]
+            )
+        count += batch_count
+        nbytes += batch_bytes
+    return count, nbytes
+
+
+async def _collect_blobs(settings: CompactionSettings) -> tuple[int, int]:
+    """Delete blobs that no checkpoint references."""
+    # Blobs are touched hourly while written, see UPSERT_BLOB
+    cutoff = datetime.now(timezone.utc) - timedelta(
+        seconds=settings.compaction_min_age, hours=1
+    )
+    count, nbytes = 0, 0
+    while True:
+        async with get_pg_pool().acquire() as conn:
+            deleted = await conn.fetch(
+                """
+                WITH batch AS (
+                    SELECT hash FROM checkpoint_blobs b
+                    WHERE touched_at < $1
+                    AND NOT EXISTS (
+                        SELECT 1 FROM checkpoints c WHERE c.blobs @> ARRAY[b.hash]
+                    )
+                    LIMIT $2
+                )
+                DELETE FROM checkpoint_blobs b USING batch
+                WHERE b.hash = batch.hash AND b.touched_at < $1
+                RETURNING octet_length(b.data)""",
+                cutoff,
+                settings.compaction_batch_size,
+            )
+        count += len(deleted)
+        nbytes += sum(r[0] for r in deleted)
+        if len(deleted) < settings.compaction_batch_size:
+            return count, nbytes
+
+
+async def compact_checkpoints(
+    checkpointer: PostgresCheckpoint, settings: CompactionSettings
+) -> CompactionResult:
+    """Apply the retention policies to all threads once."""
+    rows, nbytes = 0, 0
+    last_thread_id = ""
+    while True:
+        async with get_pg_pool().acquire() as conn:
+            thread_ids = [
+                r[0]
+                for r in await conn.fetch(
+                    """
+                    SELECT thread_id FROM checkpoints WHERE thread_id > $1
+                    GROUP BY thread_id ORDER BY thread_id LIMIT $2""",
+                    last_thread_id,
+                    settings.compaction_thread_chunk,
+                )
+            ]
+        if not thread_ids:
+            break
+        chunk_rows, chunk_bytes = await _compact_threads(
+            checkpointer, settings, thread_ids
+        )
+        rows += chunk_rows
+        nbytes += chunk_bytes
+        last_thread_id = thread_ids[-1]
+    blobs, blob_bytes = await _collect_blobs(settings)
+    nbytes += blob_bytes
+    metrics.incr("compaction.rows_deleted", rows)
+    metrics.incr("compaction.blobs_deleted", blobs)
+    metrics.incr("compaction.bytes_reclaimed", nbytes)
+    return CompactionResult(rows, blobs, nbytes)
+
+
+async def run_compaction(
+    checkpointer: PostgresCheckpoint, settings: CompactionSettings
+) -> None:
+    """Compact checkpoints every `compaction_interval` seconds, until cancelled."""
+    while True:
+        await asyncio.sleep(settings.compaction_interval)
+        try:
+            result = await compact_checkpoints(checkpointer, settings)
+            logger.info(
+                "compacted checkpoints",
+                rows=result.rows,
+                blobs=result.blobs,
+                bytes=result.bytes,
+            )
+        except Exception:
+            logger.exception("checkpoint compaction failed")
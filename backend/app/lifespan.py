@@ -1,3 +1,4 @@
+import asyncio
 import os
 from contextlib import asynccontextmanager
 
@@ -48,14 +49,45 @@ async def lifespan(app: FastAPI):
 
     global _pg_pool
 
-    _pg_pool = await asyncpg.create_pool(
+    connect_kwargs = dict(
         database=os.environ["POSTGRES_DB"],
         user=os.environ["POSTGRES_USER"],
         password=os.environ["POSTGRES_PASSWORD"],
         host=os.environ["POSTGRES_HOST"],
         port=os.environ["POSTGRES_PORT"],
-        init=_init_connection,
+    )
+    _pg_pool = await asyncpg.create_pool(**connect_kwargs, init=_init_connection)
+
+    from app import row_cache, runs
+    from app.agent import CHECKPOINTER
+    from app.auth import jwks
+    from app.auth.settings import AuthType
+    from app.auth.settings import settings as auth_settings
+    from app.compaction import CompactionSettings, run_compaction
+
+    await runs.recover()
+    listener = asyncio.create_task(
+        row_cache.listen(lambda: asyncpg.connect(**connect_kwargs))
+    )
+
+    jwks_refresh = (
+        await jwks.start(auth_settings.jwt_oidc.iss)
+        if auth_settings.auth_type == AuthType.JWT_OIDC
+        else None
+    )
+    compaction_settings = CompactionSettings()
+    compaction = (
+        asyncio.create_task(run_compaction(CHECKPOINTER, compaction_settings))
+        if compaction_settings.enabled
+        else None
     )
     yield
+    await runs.shutdown()
+    listener.cancel()
+    if jwks_refresh is not None:
+        jwks_refresh.cancel()
+    if compaction is not None:
+        compaction.cancel()
+    await CHECKPOINTER.aclose()
     await _pg_pool.close()
     _pg_pool = None
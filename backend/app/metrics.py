@@ -0,0 +1,25 @@
+"""In-process counters and gauges, served by the `/metrics` endpoint."""
+
+from collections import Counter
+from typing import Callable
+
+_counters: Counter = Counter()
+_gauges: dict[str, Callable[[], int]] = {}
+
+
+def incr(name: str, value: int = 1) -> None:
+    """Increment a counter."""
+    _counters[name] += value
+
+
+def register_gauge(name: str, fn: Callable[[], int]) -> None:
+    """Register a function returning the current value of a gauge."""
+    _gauges[name] = fn
+
+
+def snapshot() -> dict[str, int]:
+    """Get the current value of all counters and gauges."""
+    return {
+        **_counters,
+        **{name: fn() for name, fn in _gauges.items()},
+    }
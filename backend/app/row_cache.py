@@ -0,0 +1,141 @@
+"""Caches of database rows, invalidated with LISTEN/NOTIFY.
+
+Triggers on cached tables send a notification on the `row_changes` channel
+with a `<table>:<key>` payload whenever a row changes, or `<table>:` when the
+table is truncated, see migration 000009. Every replica listens on its own
+connection and drops the rows that changed from its caches.
+
+Rows are only cached while listening, as changes made by other replicas
+would otherwise go unnoticed. Caches are cleared when the connection is
+lost.
+"""
+
+import asyncio
+import copy
+import os
+from typing import Any, Awaitable, Callable, Optional
+
+import asyncpg
+import structlog
+
+from app.cache import LRUCache
+
+logger = structlog.get_logger(__name__)
+
+CHANNEL = "row_changes"
+RECONNECT_DELAY = 1.0
+
+_caches: dict[str, "RowCache"] = {}
+_callbacks: dict[str, list[Callable[[str], None]]] = {}
+_listening = False
+
+
+class RowCache:
+    """A TTL and size bounded cache of the rows of `table`, by key.
+
+    Missing rows are cached too, as None. Rows are cached and returned as
+    copies, so that callers may update the rows they get.
+    """
+
+    def __init__(self, table: str, *, maxsize: int, ttl: float) -> None:
+        self.table = table
+        self.rows: LRUCache[str, tuple[Optional[Any]]] = LRUCache(
+            table, maxsize=maxsize, ttl=ttl
+        )
+        # Incremented on every invalidation, so that rows read before a
+        # change aren't cached after it
+        self.epoch = 0
+        _caches[table] = self
+
+    def lookup(self, key: str) -> Optional[tuple[Optional[Any]]]:
+        """Get a cached row, in a 1-tuple, or None if not cached."""
+        if _listening and (cached := self.rows.get(key)):
+            return (_copy(cached[0]),)
+
+    def store(self, key: str, row: Optional[Any], epoch: int) -> None:
+        """Cache a row, unless it may have changed since `epoch` was read."""
+        if _listening and epoch == self.epoch:
+            self.rows.set(key, (_copy(row),))
+
+    async def get(
+        self, key: str, fetch: Callable[[], Awaitable[Optional[Any]]]
+    ) -> Optional[Any]:
+        """Get a row from the cache, or `fetch` it."""
+        if cached := self.lookup(key):
+            return cached[0]
+        epoch = self.epoch
+        row = await fetch()
+        self.store(key, row, epoch)
+        return row
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """Drop a row, or all rows if `key` is None."""
+        self.epoch += 1
+        if key is None:
+            self.rows.clear()
+        else:
+            self.rows.pop(key)
+
+
+def _copy(row: Optional[Any]) -> Optional[dict]:
+    # Values may be mutable too, such as decoded JSON columns
+    return None if row is None else copy.deepcopy(dict(row))
+
+
+def _on_notification(conn, pid: int, channel: str, payload: str) -> None:
+    table, _, key = payload.partition(":")
+    if cache := _caches.get(table):
+        cache.invalidate(key or None)
+    if key:
+        for callback in _callbacks.get(table, ()):
+            callback(key)
+
+
+def on_change(table: str, callback: Callable[[str], None]) -> None:
+    """Call `callback` with the key of every changed row of `table`, on
+    notifications sent by its triggers."""
+    _callbacks.setdefault(table, []).append(callback)
+
+
+def invalidate_all() -> None:
+    """Drop the rows of all caches."""
+    for cache in _caches.values():
+        cache.invalidate()
+
+
+async def listen(connect: Callable[[], Awaitable[asyncpg.Connection]]) -> None:
+    """Listen for row changes on a connection from `connect`, until cancelled.
+
+    The connection is opened again, after `RECONNECT_DELAY` seconds, if lost.
+    """
+    global _listening
+    while True:
+        lost = asyncio.Event()
+        try:
+            conn = await connect()
+        except Exception:
+            logger.exception("failed to connect to listen for row changes")
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+        try:
+            conn.add_termination_listener(lambda _: lost.set())
+            await conn.add_listener(CHANNEL, _on_notification)
+            _listening = True
+            await lost.wait()
+            logger.warning("lost the connection listening for row changes")
+        finally:
+            _listening = False
+            invalidate_all()
+            if not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+def row_cache(table: str) -> RowCache:
+    """A cache of `table` rows, sized with the `ROW_CACHE_SIZE` and
+    `ROW_CACHE_TTL` environment variables."""
+    return RowCache(
+        table,
+        maxsize=int(os.getenv("ROW_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("ROW_CACHE_TTL", "60")),
+    )
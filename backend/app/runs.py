@@ -0,0 +1,473 @@
+"""Runs executed in the background, and recorded in the `run` table.
+
+Runs execute in their own task, independently of the request that started
+them, once admitted by `app.admission`; they are pending until then. A run
+can be cancelled from any replica: the replica executing it is notified
+through `app.row_cache`.
+
+The server-sent events of a run started with `start_stream` are numbered, and
+the last `RUN_STREAM_BUFFER` of them (1000 by default) are kept until
+`RUN_STREAM_TTL` seconds (300 by default) after the run finished. A client
+whose connection dropped can then resume from the last event it received,
+instead of starting a new run. Runs no client streams anymore are cancelled
+after `RUN_STREAM_DISCONNECT_GRACE` seconds (10 by default, never if
+negative), keeping the checkpoints of the steps they completed.
+
+Runs are recorded with the `RUNS_INSTANCE_ID` of the replica executing them
+(its host name by default), which should stay the same when it restarts.
+Runs a replica left pending or running when it stopped without shutting
+down are recorded as failed once it starts again.
+"""
+
+import asyncio
+import functools
+import itertools
+import os
+import socket
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Optional,
+    Sequence,
+    Union,
+)
+from uuid import UUID, uuid4
+
+import orjson
+import structlog
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.messages import AnyMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import merge_configs
+
+import app.storage as storage
+from app import admission, metrics, row_cache
+from app.schema import Run
+from app.stream import astream_state, coalesce, dumps, to_sse
+
+logger = structlog.get_logger(__name__)
+
+BUFFER_SIZE = int(os.getenv("RUN_STREAM_BUFFER", "1000"))
+TTL = float(os.getenv("RUN_STREAM_TTL", "300"))
+DISCONNECT_GRACE = float(os.getenv("RUN_STREAM_DISCONNECT_GRACE", "10"))
+BATCH_CONCURRENCY = int(os.getenv("RUNS_BATCH_CONCURRENCY", "8"))
+INSTANCE_ID = os.getenv("RUNS_INSTANCE_ID") or socket.gethostname()
+
+ENDED = ("success", "error", "cancelled")
+
+_tasks: dict[str, asyncio.Task] = {}
+# The tasks executing the graphs of streamed runs, apart from `_tasks`
+_graph_tasks: dict[str, asyncio.Task] = {}
+# Runs are only cancelled once, as that would interrupt recording it
+_cancelled: set[str] = set()
+_streams: dict[str, "RunStream"] = {}
+
+
+async def _final_state(app: Runnable, config: RunnableConfig) -> dict:
+    state = await app.aget_state({"configurable": config["configurable"]})
+    values = state.values
+    messages = values.get("messages", []) if isinstance(values, dict) else values
+    return {"event": "data", "data": dumps(messages or []).decode()}
+
+
+async def final_events(app: Runnable, config: RunnableConfig) -> AsyncIterator[dict]:
+    """The messages of the final checkpoint of a run, as server-sent events."""
+    yield await _final_state(app, config)
+    yield {"event": "end"}
+
+
+class RunStream:
+    """The server-sent events of a run, numbered from 0."""
+
+    def __init__(
+        self,
+        run_id: str,
+        user_id: str,
+        app: Runnable,
+        config: RunnableConfig,
+        *,
+        maxlen: int = BUFFER_SIZE,
+    ) -> None:
+        self.run_id = run_id
+        self.user_id = user_id
+        self.app = app
+        self.config = config
+        self.events: deque[dict] = deque(maxlen=maxlen)
+        self.next_id = 0
+        self.done = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._abandon: Optional[asyncio.TimerHandle] = None
+
+    def _append(self, event: dict) -> None:
+        self.events.append({**event, "id": str(self.next_id)})
+        self.next_id += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def run(self, events: AsyncIterator[dict]) -> Optional[str]:
+        """Buffer the events, returning the message of the error event sent,
+        if any."""
+        error = None
+        async for event in events:
+            if event["event"] == "error":
+                error = orjson.loads(event["data"])["message"]
+            self._append(event)
+        return error
+
+    def queued(self, position: int) -> None:
+        """Send the position of the run in the admission queue."""
+        self._append(
+            {"event": "queue", "data": orjson.dumps({"position": position}).decode()}
+        )
+
+    def close(self) -> None:
+        """End the stream, whether the run finished or not."""
+        if not self.events or self.events[-1]["event"] != "end":
+            self._append({"event": "end"})
+        self.done = True
+        self._changed.set()
+        if self._abandon is not None:
+            self._abandon.cancel()
+        asyncio.get_running_loop().call_later(TTL, _forget, self)
+
+    def unsubscribed(self) -> None:
+        """Cancel the run after a grace period, unless streamed again."""
+        if not self.subscribers and not self.done and DISCONNECT_GRACE >= 0:
+            self._abandon = asyncio.get_running_loop().call_later(
+                DISCONNECT_GRACE, self._abandoned
+            )
+
+    def _abandoned(self) -> None:
+        logger.info("cancelling run no longer streamed", run_id=self.run_id)
+        metrics.incr("runs.stream.abandoned")
+        _cancel(self.run_id)
+
+    async def subscribe(
+        self, last_event_id: Optional[int] = None
+    ) -> AsyncIterator[dict]:
+        """Stream the events after `last_event_id`, or all of them.
+
+        If some of these events are no longer buffered, a finished run streams
+        the messages of its final checkpoint instead, followed by the last
+        event. A run still executing resumes from its oldest buffered event.
+
+        The run is cancelled if no client streams it for a while, see
+        `unsubscribed`.
+        """
+        next_id = 0 if last_event_id is None else last_event_id + 1
+        self.subscribers += 1
+        if self._abandon is not None:
+            self._abandon.cancel()
+            self._abandon = None
+        try:
+            while True:
+                first_id = self.next_id - len(self.events)
+                if next_id < first_id:
+                    metrics.incr("runs.stream.gaps")
+                    if self.done:
+                        yield {
+                            **await _final_state(self.app, self.config),
+                            "id": str(self.next_id - 2),
+                        }
+                        yield self.events[-1]
+                        return
+                    logger.warning(
+                        "resuming run stream after a gap",
+                        run_id=self.run_id,
+                        missed=first_id - next_id,
+                    )
+                    next_id = first_id
+                changed = self._changed
+                new_events = list(
+                    itertools.islice(self.events, next_id - first_id, None)
+                )
+                for event in new_events:
+                    yield event
+                next_id += len(new_events)
+                if next_id >= self.next_id:
+                    if self.done:
+                        return
+                    await changed.wait()
+        finally:
+            # Also when the client disconnects
+            self.subscribers -= 1
+            self.unsubscribed()
+
+
+def _forget(stream: RunStream) -> None:
+    if _streams.get(stream.run_id) is stream:
+        del _streams[stream.run_id]
+
+
+async def _execute(
+    run_id: str,
+    ticket: admission.Ticket,
+    work: Callable[[], Awaitable[Optional[str]]],
+) -> tuple[str, Optional[str]]:
+    """Execute `work` once admitted, recording and returning the status of the
+    run and its error.
+
+    `work` returns the error the run failed with, if it didn't raise it.
+    """
+    status, error = "cancelled", None
+    try:
+        await ticket.wait()
+        # Not started if cancelled while pending
+        if await storage.begin_run(run_id):
+            error = await work()
+            if run_id in _cancelled:
+                status = "cancelled"
+            else:
+                status = "error" if error else "success"
+    except Exception as e:
+        logger.exception("run failed", run_id=run_id)
+        status, error = "error", type(e).__name__
+    finally:
+        admission.scheduler.release(ticket)
+        await storage.end_run(run_id, status, error)
+        metrics.incr(f"runs.{status}")
+    return status, error
+
+
+def _start(
+    run_id: str,
+    ticket: admission.Ticket,
+    work: Callable[[], Awaitable[Optional[str]]],
+) -> asyncio.Task:
+    task = _tasks[run_id] = asyncio.create_task(_execute(run_id, ticket, work))
+    task.add_done_callback(lambda _: _forget_task(run_id))
+    # In case the task was cancelled before it started
+    task.add_done_callback(lambda _: admission.scheduler.release(ticket))
+    return task
+
+
+async def _put_run(
+    user_id: str, run_id: str, config: RunnableConfig, ticket: admission.Ticket
+) -> Run:
+    try:
+        return await storage.put_run(
+            user_id,
+            run_id,
+            config["configurable"]["thread_id"],
+            instance_id=INSTANCE_ID,
+        )
+    except BaseException:
+        admission.scheduler.release(ticket)
+        raise
+
+
+def _forget_task(run_id: str) -> None:
+    _tasks.pop(run_id, None)
+    _graph_tasks.pop(run_id, None)
+    _cancelled.discard(run_id)
+
+
+def _cancel(run_id: str) -> Optional[asyncio.Task]:
+    """Cancel the task executing a run, returning it.
+
+    Once the graph of a streamed run started, its own task is cancelled
+    instead, as `astream_events` would wait for it to finish, and the stream
+    then ends.
+    """
+    task = _tasks.get(run_id)
+    if task is not None and run_id not in _cancelled:
+        _cancelled.add(run_id)
+        graph_task = _graph_tasks.get(run_id)
+        if graph_task is not None and not graph_task.done():
+            graph_task.cancel()
+        else:
+            task.cancel()
+    return task
+
+
+class _GraphTask(AsyncCallbackHandler):
+    """Records the task executing the graph of a run."""
+
+    # Called from the task executing the graph, rather than from another one
+    run_inline = True
+
+    def __init__(self, run_id: str) -> None:
+        self.run_id = run_id
+
+    async def on_chain_start(
+        self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs
+    ) -> None:
+        if parent_run_id is None:
+            _graph_tasks[self.run_id] = asyncio.current_task()
+
+
+async def start_run(
+    user_id: str,
+    app: Runnable,
+    input: Union[Sequence[AnyMessage], Dict[str, Any]],
+    config: RunnableConfig,
+) -> Run:
+    """Start a run in the background.
+
+    Raises `admission.QueueFull` if too many runs are waiting to be admitted.
+    """
+    run_id = str(uuid4())
+    ticket = admission.scheduler.enqueue(
+        user_id,
+        admission.run_keys("background", user_id, config["configurable"]),
+    )
+    run = await _put_run(user_id, run_id, config, ticket)
+    _start(run_id, ticket, functools.partial(_invoke, app, input, config, run_id))
+    return run
+
+
+async def _invoke(
+    app: Runnable,
+    input: Union[Sequence[AnyMessage], Dict[str, Any]],
+    config: RunnableConfig,
+    run_id: str,
+) -> None:
+    await app.ainvoke(input, {**config, "run_id": UUID(run_id)})
+
+
+async def run_batch(
+    user_id: str,
+    runs: Sequence[
+        tuple[Runnable, Union[Sequence[AnyMessage], Dict[str, Any]], RunnableConfig]
+    ],
+    *,
+    concurrency: int = BATCH_CONCURRENCY,
+) -> AsyncIterator[dict]:
+    """Execute runs of `(app, input, config)`, at most `concurrency` at once,
+    each once admitted, yielding their `index`, `run_id`, `status` and
+    `error` as they end.
+
+    The runs are recorded in a single statement. If the iteration stops
+    early, the runs not started yet are cancelled, and the others go on.
+    """
+    run_ids = [str(uuid4()) for _ in runs]
+    await storage.put_runs(
+        user_id,
+        [
+            (run_id, config["configurable"]["thread_id"])
+            for run_id, (_, _, config) in zip(run_ids, runs)
+        ],
+        instance_id=INSTANCE_ID,
+    )
+    ended: asyncio.Queue[dict] = asyncio.Queue()
+    todo = iter(enumerate(runs))
+
+    async def execute_one(
+        run_id: str, app: Runnable, input: Any, config: RunnableConfig
+    ) -> tuple[str, Optional[str]]:
+        try:
+            ticket = admission.scheduler.enqueue(
+                user_id,
+                admission.run_keys("background", user_id, config["configurable"]),
+            )
+        except admission.QueueFull:
+            status, error = "error", "Too many runs queued"
+            await storage.end_run(run_id, status, error)
+            return status, error
+        task = _start(
+            run_id, ticket, functools.partial(_invoke, app, input, config, run_id)
+        )
+        await asyncio.wait({task})
+        return ("cancelled", None) if task.cancelled() else task.result()
+
+    async def execute() -> None:
+        for index, (app, input, config) in todo:
+            run_id = run_ids[index]
+            # Every run gets its line, even if recording its outcome failed
+            try:
+                status, error = await execute_one(run_id, app, input, config)
+            except Exception as e:
+                logger.exception("run failed", run_id=run_id)
+                status, error = "error", type(e).__name__
+            ended.put_nowait(
+                {"index": index, "run_id": run_id, "status": status, "error": error}
+            )
+
+    workers = [asyncio.create_task(execute()) for _ in range(concurrency)]
+    try:
+        for _ in runs:
+            yield await ended.get()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if not_started := [run_ids[index] for index, _ in todo]:
+            await storage.cancel_pending_runs(not_started)
+
+
+async def start_stream(
+    user_id: str,
+    app: Runnable,
+    input: Union[Sequence[AnyMessage], Dict[str, Any]],
+    config: RunnableConfig,
+    *,
+    deltas: bool = False,
+) -> RunStream:
+    """Start a run in the background, streaming its events, starting with its
+    position in the admission queue if it has to wait.
+
+    Raises `admission.QueueFull` if too many runs are waiting to be admitted.
+    """
+    run_id = str(uuid4())
+    stream = RunStream(run_id, user_id, app, config)
+    ticket = admission.scheduler.enqueue(
+        user_id,
+        admission.run_keys("stream", user_id, config["configurable"]),
+        stream.queued,
+    )
+    await _put_run(user_id, run_id, config, ticket)
+    _streams[run_id] = stream
+    events = to_sse(
+        coalesce(
+            astream_state(
+                app,
+                input,
+                merge_configs(
+                    config,
+                    {"run_id": UUID(run_id), "callbacks": [_GraphTask(run_id)]},
+                ),
+                deltas=deltas,
+            )
+        )
+    )
+    task = _start(run_id, ticket, lambda: stream.run(events))
+    task.add_done_callback(lambda _: stream.close())
+    # In case the client is gone before streaming it
+    stream.unsubscribed()
+    return stream
+
+
+def get_stream(user_id: str, run_id: str) -> Optional[RunStream]:
+    """Get the stream of a run started by the user, if still buffered."""
+    stream = _streams.get(run_id)
+    if stream is not None and stream.user_id == user_id:
+        return stream
+    return None
+
+
+row_cache.on_change("run", _cancel)
+
+
+async def cancel(user_id: str, run_id: str) -> Optional[Run]:
+    """Cancel a run, if not over yet, returning it."""
+    if await storage.cancel_run(user_id, run_id) and (task := _cancel(run_id)):
+        await asyncio.wait({task})
+    return await storage.get_run(user_id, run_id)
+
+
+async def recover() -> None:
+    """Record the runs this replica left unfinished as interrupted."""
+    if count := await storage.end_unfinished_runs(INSTANCE_ID):
+        logger.warning("interrupted runs recorded", count=count)
+        metrics.incr("runs.interrupted", count)
+
+
+async def shutdown() -> None:
+    """Cancel the runs executing, recording them as cancelled."""
+    tasks = [_cancel(run_id) for run_id in list(_tasks)]
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,9 +1,34 @@
 from datetime import datetime
-from typing import Optional
+from typing import Any, Optional
+from uuid import UUID
 
 from typing_extensions import TypedDict
 
 
+class UUIDStr(str):
+    """A UUID given by a client, validated and normalized to the lower case
+    form the database returns, under which rows are cached."""
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def __modify_schema__(cls, field_schema: dict[str, Any]) -> None:
+        field_schema.update(type="string", format="uuid")
+
+    @classmethod
+    def validate(cls, value: Any) -> "UUIDStr":
+        if isinstance(value, UUID):
+            return cls(value)
+        if not isinstance(value, str):
+            raise TypeError("string required")
+        try:
+            return cls(UUID(value))
+        except ValueError:
+            raise ValueError("value is not a valid uuid")
+
+
 class User(TypedDict):
     user_id: str
     """The ID of the user."""
@@ -42,3 +67,24 @@ class Thread(TypedDict):
     updated_at: datetime
     """The last time the thread was updated."""
     metadata: Optional[dict]
+
+
+class Run(TypedDict):
+    run_id: str
+    """The ID of the run."""
+    thread_id: str
+    """The thread the run is executed on."""
+    user_id: str
+    """The ID of the user that started the run."""
+    status: str
+    """One of pending, running, cancelling, success, error or cancelled."""
+    created_at: datetime
+    """The time the run was created."""
+    started_at: Optional[datetime]
+    """The time the run started executing."""
+    ended_at: Optional[datetime]
+    """The time the run ended."""
+    error: Optional[str]
+    """The error the run failed with."""
+    instance_id: Optional[str]
+    """The replica executing the run."""
@@ -0,0 +1,219 @@
+"""Compact, versioned serialization of checkpoints.
+
+Payloads start with a header of two bytes, the format version followed by the
+compression codec, and are followed by the (optionally compressed) orjson
+encoding of the object. Values JSON can't represent are encoded as objects
+tagged with their type: pydantic models, such as messages and documents, and
+dataclasses as their fields tagged with their class, and tuples, sets, bytes,
+dates and UUIDs as their JSON form tagged with their type. Dicts that hold one
+of the reserved tag keys are themselves tagged, so that they are loaded as
+they were.
+
+Rows written with pickle start with the pickle protocol marker, which is never
+a valid format version, so they remain readable.
+"""
+
+import base64
+import dataclasses
+import datetime
+import enum
+import functools
+import importlib
+import math
+import os
+import pickle
+import uuid
+import zlib
+from typing import Any, Callable, Optional
+
+import orjson
+import structlog
+from langchain_core.pydantic_v1 import BaseModel
+
+logger = structlog.get_logger(__name__)
+
+FORMAT_VERSION = 1
+PICKLE_MARKER = 0x80
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+
+# Only classes from these packages are revived from tagged payloads.
+ALLOWED_MODULES = ("langchain_core.", "langchain.", "langchain_community.", "app.")
+
+TYPE_KEY = "__t"
+DATA_KEY = "__d"
+BYTES_KEY = "__b"
+SET_KEY = "__s"
+RESERVED_KEYS = (TYPE_KEY, BYTES_KEY, SET_KEY)
+
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB}
+_COMPRESSORS: dict[int, tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    CODEC_NONE: (lambda b: b, lambda b: b),
+    CODEC_ZLIB: (zlib.compress, zlib.decompress),
+}
+
+
+def _class_path(cls: type) -> str:
+    path = f"{cls.__module__}:{cls.__qualname__}"
+    if not cls.__module__.startswith(ALLOWED_MODULES):
+        # It couldn't be loaded back
+        raise TypeError(f"Class {path} is not allowed in checkpoints")
+    return path
+
+
+def _encode(obj: Any) -> Any:
+    """Turn an object into JSON values, tagging those of other types.
+
+    Raises TypeError for values that can't be encoded faithfully.
+    """
+    cls = obj.__class__
+    if cls is str or cls is int or cls is bool or obj is None:
+        return obj
+    if cls is float:
+        if not math.isfinite(obj):
+            # orjson would write it as null
+            raise TypeError(f"Float {obj} is not serializable")
+        return obj
+    if cls is list:
+        return [_encode(v) for v in obj]
+    if cls is dict:
+        encoded = {k: _encode(v) for k, v in obj.items()}
+        if any(key in obj for key in RESERVED_KEYS):
+            return {TYPE_KEY: "dict", DATA_KEY: encoded}
+        return encoded
+    if isinstance(obj, BaseModel):
+        return {TYPE_KEY: _class_path(cls), DATA_KEY: _encode(obj.__dict__)}
+    if cls is bytes:
+        return {BYTES_KEY: base64.b64encode(obj).decode()}
+    if cls is set:
+        return {SET_KEY: [_encode(v) for v in obj]}
+    if cls in _BUILTINS:
+        return {TYPE_KEY: cls.__name__, DATA_KEY: _BUILTINS[cls][0](obj)}
+    if isinstance(obj, enum.Enum):
+        return {TYPE_KEY: _class_path(cls), DATA_KEY: _encode(obj.value)}
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return {
+            TYPE_KEY: _class_path(cls),
+            DATA_KEY: _encode(
+                {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)}
+            ),
+        }
+    raise TypeError(f"Object of type {cls.__name__} is not serializable")
+
+
+# Builtin types tagged by name, with how to encode and revive them
+_BUILTINS: dict[type, tuple[Callable[[Any], Any], Callable[[Any], Any]]] = {
+    tuple: (lambda v: [_encode(i) for i in v], tuple),
+    frozenset: (lambda v: [_encode(i) for i in v], frozenset),
+    datetime.datetime: (
+        datetime.datetime.isoformat,
+        datetime.datetime.fromisoformat,
+    ),
+    datetime.date: (datetime.date.isoformat, datetime.date.fromisoformat),
+    datetime.time: (datetime.time.isoformat, datetime.time.fromisoformat),
+    datetime.timedelta: (
+        lambda v: [v.days, v.seconds, v.microseconds],
+        lambda v: datetime.timedelta(*v),
+    ),
+    uuid.UUID: (str, uuid.UUID),
+}
+_REVIVERS = {cls.__name__: revive for cls, (_, revive) in _BUILTINS.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def _load_class(path: str) -> type:
+    module, _, qualname = path.partition(":")
+    if not module.startswith(ALLOWED_MODULES):
+        raise ValueError(f"Refusing to load {path} from a checkpoint")
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _revive_tagged(kind: str, data: Any) -> Any:
+    if kind == "dict":
+        # A dict holding reserved keys, only its values are tagged
+        return {k: revive(v) for k, v in data.items()}
+    if kind in _REVIVERS:
+        return _REVIVERS[kind](revive(data))
+    cls = _load_class(kind)
+    if issubclass(cls, BaseModel):
+        # Fields were taken from a validated instance, so skip validation
+        return cls.construct(**revive(data))
+    if issubclass(cls, enum.Enum):
+        return cls(revive(data))
+    if dataclasses.is_dataclass(cls):
+        obj = cls.__new__(cls)
+        for name, value in revive(data).items():
+            object.__setattr__(obj, name, value)
+        return obj
+    raise ValueError(f"Refusing to load {kind} from a checkpoint")
+
+
+def revive(value: Any) -> Any:
+    """Turn tagged values of a decoded payload back into objects."""
+    if isinstance(value, list):
+        return [revive(v) for v in value]
+    if isinstance(value, dict):
+        if TYPE_KEY in value and DATA_KEY in value:
+            return _revive_tagged(value[TYPE_KEY], value[DATA_KEY])
+        if BYTES_KEY in value and len(value) == 1:
+            return base64.b64decode(value[BYTES_KEY])
+        if SET_KEY in value and len(value) == 1:
+            return set(revive(value[SET_KEY]))
+        return {k: revive(v) for k, v in value.items()}
+    return value
+
+
+def is_pickle(data: bytes) -> bool:
+    return data[0] == PICKLE_MARKER
+
+
+class CheckpointSerializer:
+    """Serializer for checkpoints, see the module docstring for the format.
+
+    Objects that can't be encoded faithfully (eg. instances of classes from
+    other packages stored in a channel) are pickled instead, and `loads` reads
+    both.
+    """
+
+    def __init__(self, *, compression: str = "zlib") -> None:
+        if compression not in CODECS:
+            raise ValueError(f"Compression {compression} is not available")
+        self.codec = CODECS[compression]
+
+    def dumps(self, obj: Any) -> bytes:
+        try:
+            encoded = orjson.dumps(_encode(obj))
+        except TypeError:
+            logger.debug("falling back to pickle", exc_info=True)
+            return pickle.dumps(obj)
+        compress, _ = _COMPRESSORS[self.codec]
+        return bytes((FORMAT_VERSION, self.codec)) + compress(encoded)
+
+    def loads(self, data: bytes) -> Any:
+        if is_pickle(data):
+            return pickle.loads(data)
+        return revive(self.decode(data))
+
+    def decode(self, data: bytes) -> Any:
+        """Decode a payload in this format, leaving tagged values to `revive`."""
+        version, codec = data[0], data[1]
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unknown checkpoint format version {version}")
+        if codec not in _COMPRESSORS:
+            raise ValueError(f"Checkpoint was written with unknown codec {codec}")
+        _, decompress = _COMPRESSORS[codec]
+        return orjson.loads(decompress(data[2:]))
+
+
+def get_serializer(compression: Optional[str] = None) -> CheckpointSerializer:
+    """Get a serializer compressing with `compression`, by default the codec
+    set by the `CHECKPOINT_COMPRESSION` environment variable (`zlib` or
+    `none`), or zlib.
+    """
+    if compression is None:
+        compression = os.getenv("CHECKPOINT_COMPRESSION", "zlib")
+    return CheckpointSerializer(compression=compression)
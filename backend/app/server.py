@@ -8,6 +8,7 @@ from fastapi.exceptions import HTTPException
 from fastapi.staticfiles import StaticFiles
 
 import app.storage as storage
+from app import metrics
 from app.api import router as api_router
 from app.auth.handlers import AuthedUser
 from app.lifespan import lifespan
@@ -53,6 +54,12 @@ async def health() -> dict:
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+async def get_metrics(user: AuthedUser) -> dict:
+    """Get the counters and gauges of this worker, for authenticated users."""
+    return metrics.snapshot()
+
+
 ui_dir = str(ROOT / "ui")
 
 if os.path.exists(ui_dir):
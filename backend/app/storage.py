@@ -1,30 +1,116 @@
 from datetime import datetime, timezone
 from typing import Any, List, Optional, Sequence, Union
+from uuid import uuid4
 
 from langchain_core.messages import AnyMessage
 from langchain_core.runnables import RunnableConfig
 
-from app.agent import agent
+from app.agent import CHECKPOINTER, agent, aget_state, aget_state_history
 from app.lifespan import get_pg_pool
-from app.schema import Assistant, Thread, User
+from app.row_cache import row_cache
+from app.schema import Assistant, Run, Thread, User
 
+_assistants = row_cache("assistant")
+_threads = row_cache("thread")
+_users = row_cache("user")
 
-async def list_assistants(user_id: str) -> List[Assistant]:
-    """List all assistants for the current user."""
+ASSISTANT_COLUMNS = tuple(Assistant.__annotations__)
+
+
+def _like_escape(value: str) -> str:
+    """Escape the wildcards of a LIKE pattern."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def _list_page(
+    table: str,
+    key: str,
+    conditions: list[str],
+    args: list,
+    *,
+    limit: Optional[int],
+    before: Optional[datetime],
+    before_id: Optional[str],
+) -> list:
+    """List the rows of `table` matching `conditions`, most recently updated
+    first.
+
+    Only rows updated before `before` are listed, or, with `before_id`, rows
+    after the (`before`, `before_id`) cursor in that order. Conditions refer
+    to `args` by position.
+    """
+    if before is not None:
+        args.append(before)
+        if before_id is not None:
+            args.append(before_id)
+            conditions.append(f"(updated_at, {key}) < (${len(args) - 1}, ${len(args)})")
+        else:
+            conditions.append(f"updated_at < ${len(args)}")
+    query = (
+        f"SELECT * FROM {table} WHERE {' AND '.join(conditions)} "
+        f"ORDER BY updated_at DESC, {key} DESC"
+    )
+    if limit is not None:
+        args.append(limit)
+        query += f" LIMIT ${len(args)}"
     async with get_pg_pool().acquire() as conn:
-        return await conn.fetch("SELECT * FROM assistant WHERE user_id = $1", user_id)
+        return await conn.fetch(query, *args)
 
 
-async def get_assistant(user_id: str, assistant_id: str) -> Optional[Assistant]:
-    """Get an assistant by ID."""
+async def list_assistants(
+    user_id: str,
+    *,
+    limit: Optional[int] = None,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    assistant_type: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+) -> List[Assistant]:
+    """List assistants for the current user, most recently updated first.
+
+    Pass the `updated_at` and `assistant_id` of the last assistant of a page
+    as `before` and `before_id` to get the next page.
+    """
+    conditions, args = ["user_id = $1"], [user_id]
+    if assistant_type is not None:
+        args.append(assistant_type)
+        conditions.append(f"config->'configurable'->>'type' = ${len(args)}")
+    if name_prefix is not None:
+        args.append(_like_escape(name_prefix))
+        conditions.append(f"name LIKE ${len(args)} || '%'")
+    return await _list_page(
+        "assistant",
+        "assistant_id",
+        conditions,
+        args,
+        limit=limit,
+        before=before,
+        before_id=before_id,
+    )
+
+
+async def _fetch_assistant(assistant_id: str) -> Optional[Assistant]:
     async with get_pg_pool().acquire() as conn:
         return await conn.fetchrow(
-            "SELECT * FROM assistant WHERE assistant_id = $1 AND (user_id = $2 OR public IS true)",
-            assistant_id,
-            user_id,
+            "SELECT * FROM assistant WHERE assistant_id = $1", assistant_id
         )
 
 
+async def get_assistant(user_id: str, assistant_id: str) -> Optional[Assistant]:
+    """Get an assistant by ID, if it is the user's or public."""
+    assistant = await _assistants.get(
+        assistant_id, lambda: _fetch_assistant(assistant_id)
+    )
+    return _readable_assistant(user_id, assistant)
+
+
+def _readable_assistant(
+    user_id: str, assistant: Optional[Assistant]
+) -> Optional[Assistant]:
+    if assistant and (assistant["user_id"] == user_id or assistant["public"]):
+        return assistant
+
+
 async def list_public_assistants() -> List[Assistant]:
     """List all the public assistants."""
     async with get_pg_pool().acquire() as conn:
@@ -66,6 +152,7 @@ async def put_assistant(
                 updated_at,
                 public,
             )
+    _assistants.invalidate(assistant_id)
     return {
         "assistant_id": assistant_id,
         "user_id": user_id,
@@ -84,34 +171,177 @@ async def delete_assistant(user_id: str, assistant_id: str) -> None:
             assistant_id,
             user_id,
         )
+    _assistants.invalidate(assistant_id)
 
 
-async def list_threads(user_id: str) -> List[Thread]:
-    """List all threads for the current user."""
+async def list_threads(
+    user_id: str,
+    *,
+    limit: Optional[int] = None,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+    assistant_id: Optional[str] = None,
+    assistant_type: Optional[str] = None,
+    name_prefix: Optional[str] = None,
+) -> List[Thread]:
+    """List threads for the current user, most recently updated first.
+
+    Pass the `updated_at` and `thread_id` of the last thread of a page as
+    `before` and `before_id` to get the next page.
+    """
+    conditions, args = ["user_id = $1"], [user_id]
+    if assistant_id is not None:
+        args.append(assistant_id)
+        conditions.append(f"assistant_id = ${len(args)}")
+    if assistant_type is not None:
+        args.append(assistant_type)
+        conditions.append(f"metadata->>'assistant_type' = ${len(args)}")
+    if name_prefix is not None:
+        args.append(_like_escape(name_prefix))
+        conditions.append(f"name LIKE ${len(args)} || '%'")
+    return await _list_page(
+        "thread",
+        "thread_id",
+        conditions,
+        args,
+        limit=limit,
+        before=before,
+        before_id=before_id,
+    )
+
+
+async def _fetch_thread(thread_id: str) -> Optional[Thread]:
     async with get_pg_pool().acquire() as conn:
-        return await conn.fetch("SELECT * FROM thread WHERE user_id = $1", user_id)
+        return await conn.fetchrow(
+            "SELECT * FROM thread WHERE thread_id = $1", thread_id
+        )
 
 
 async def get_thread(user_id: str, thread_id: str) -> Optional[Thread]:
-    """Get a thread by ID."""
+    """Get a thread by ID, if it is the user's."""
+    thread = await _threads.get(thread_id, lambda: _fetch_thread(thread_id))
+    if thread and thread["user_id"] == user_id:
+        return thread
+
+
+async def get_thread_and_assistant(
+    user_id: str, thread_id: str
+) -> tuple[Optional[Thread], Optional[Assistant]]:
+    """Get a thread by ID, if it is the user's, along with its assistant, if
+    the user can read it.
+
+    Rows not already cached are read in a single query.
+    """
+    if cached := _threads.lookup(thread_id):
+        thread = cached[0]
+        if not thread or thread["user_id"] != user_id:
+            return None, None
+        if thread["assistant_id"] is None:
+            return thread, None
+        return thread, await get_assistant(user_id, thread["assistant_id"])
+    thread_epoch, assistant_epoch = _threads.epoch, _assistants.epoch
     async with get_pg_pool().acquire() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM thread WHERE thread_id = $1 AND user_id = $2",
-            thread_id,
-            user_id,
+        row = await conn.fetchrow(
+            f"{_THREAD_AND_ASSISTANT} WHERE t.thread_id = $1", thread_id
         )
+    if not row:
+        _threads.store(thread_id, None, thread_epoch)
+        return None, None
+    return _thread_and_assistant(user_id, row, thread_epoch, assistant_epoch)
+
 
+_THREAD_AND_ASSISTANT = f"""
+    SELECT t.*, {", ".join(f"a.{c} AS assistant_{c}" for c in ASSISTANT_COLUMNS)}
+    FROM thread t LEFT JOIN assistant a ON a.assistant_id = t.assistant_id"""
 
-async def get_thread_state(*, user_id: str, thread_id: str, assistant: Assistant):
-    """Get state for a thread."""
-    state = await agent.aget_state(
+
+def _thread_and_assistant(
+    user_id: str, row, thread_epoch: int, assistant_epoch: int
+) -> tuple[Optional[Thread], Optional[Assistant]]:
+    """Split a row of `_THREAD_AND_ASSISTANT`, and cache both parts."""
+    # The assistant columns come last
+    values = list(row.values())
+    split = len(values) - len(ASSISTANT_COLUMNS)
+    thread = dict(zip(row.keys(), values[:split]))
+    assistant = (
+        dict(zip(ASSISTANT_COLUMNS, values[split:]))
+        if thread["assistant_id"] is not None
+        else None
+    )
+    _threads.store(thread["thread_id"], thread, thread_epoch)
+    if assistant is not None:
+        _assistants.store(thread["assistant_id"], assistant, assistant_epoch)
+    if thread["user_id"] != user_id:
+        return None, None
+    return thread, _readable_assistant(user_id, assistant)
+
+
+async def get_threads_and_assistants(
+    user_id: str, thread_ids: Sequence[str]
+) -> dict[str, tuple[Optional[Thread], Optional[Assistant]]]:
+    """Get threads by ID, like `get_thread_and_assistant`, in a single query
+    for those not already cached along with their assistant."""
+    result: dict[str, tuple[Optional[Thread], Optional[Assistant]]] = {}
+    missing = []
+    for thread_id in dict.fromkeys(thread_ids):
+        if cached := _threads.lookup(thread_id):
+            thread = cached[0]
+            if not thread or thread["user_id"] != user_id:
+                result[thread_id] = (None, None)
+                continue
+            if thread["assistant_id"] is None:
+                result[thread_id] = (thread, None)
+                continue
+            if cached_assistant := _assistants.lookup(thread["assistant_id"]):
+                assistant = _readable_assistant(user_id, cached_assistant[0])
+                result[thread_id] = (thread, assistant)
+                continue
+        missing.append(thread_id)
+    if missing:
+        thread_epoch, assistant_epoch = _threads.epoch, _assistants.epoch
+        async with get_pg_pool().acquire() as conn:
+            rows = await conn.fetch(
+                f"{_THREAD_AND_ASSISTANT} WHERE t.thread_id = ANY($1::uuid[])",
+                missing,
+            )
+        for row in rows:
+            result[row["thread_id"]] = _thread_and_assistant(
+                user_id, row, thread_epoch, assistant_epoch
+            )
+        for thread_id in missing:
+            if thread_id not in result:
+                _threads.store(thread_id, None, thread_epoch)
+                result[thread_id] = (None, None)
+    return result
+
+
+async def get_thread_state(
+    *,
+    user_id: str,
+    thread_id: str,
+    assistant: Assistant,
+    limit: Optional[int] = None,
+    offset: Optional[int] = None,
+    before_message_id: Optional[str] = None,
+):
+    """Get state for a thread.
+
+    If `limit`, `offset` or `before_message_id` is given, only a window of the
+    messages is returned: at most `limit` messages, ending `offset` messages
+    before the last one, or right before the message with id
+    `before_message_id`.
+    """
+    state = await aget_state(
         {
             "configurable": {
                 **assistant["config"]["configurable"],
                 "thread_id": thread_id,
                 "assistant_id": assistant["assistant_id"],
             }
-        }
+        },
+        limit=limit,
+        offset=offset,
+        before_id=before_message_id,
     )
     return {
         "values": state.values,
@@ -139,8 +369,19 @@ async def update_thread_state(
     )
 
 
-async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assistant):
-    """Get the history of a thread."""
+async def get_thread_history(
+    *,
+    user_id: str,
+    thread_id: str,
+    assistant: Assistant,
+    limit: Optional[int] = None,
+    before: Optional[datetime] = None,
+):
+    """Get the history of a thread, most recent first.
+
+    Pass the `thread_ts` of the last state of a page as `before` to get the
+    next page.
+    """
     return [
         {
             "values": c.values,
@@ -148,14 +389,16 @@ async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assista
             "config": c.config,
             "parent": c.parent_config,
         }
-        async for c in agent.aget_state_history(
+        async for c in aget_state_history(
             {
                 "configurable": {
                     **assistant["config"]["configurable"],
                     "thread_id": thread_id,
                     "assistant_id": assistant["assistant_id"],
                 }
-            }
+            },
+            before=before,
+            limit=limit,
         )
     ]
 
@@ -163,40 +406,73 @@ async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assista
 async def put_thread(
     user_id: str, thread_id: str, *, assistant_id: str, name: str
 ) -> Thread:
-    """Modify a thread."""
+    """Modify a thread.
+
+    The thread metadata holds the type of its assistant, if the user can read
+    it, looked up in the same query.
+    """
     updated_at = datetime.now(timezone.utc)
-    assistant = await get_assistant(user_id, assistant_id)
-    metadata = (
-        {"assistant_type": assistant["config"]["configurable"]["type"]}
-        if assistant
-        else None
-    )
     async with get_pg_pool().acquire() as conn:
-        await conn.execute(
+        metadata = await conn.fetchval(
             (
-                "INSERT INTO thread (thread_id, user_id, assistant_id, name, updated_at, metadata) VALUES ($1, $2, $3, $4, $5, $6) "
+                "INSERT INTO thread (thread_id, user_id, assistant_id, name, updated_at, metadata) "
+                "SELECT $1::uuid, $2, $3::uuid, $4, $5::timestamptz, ("
+                "SELECT jsonb_build_object('assistant_type', config->'configurable'->>'type') "
+                "FROM assistant WHERE assistant_id = $3 AND (user_id = $2 OR public IS true)) "
                 "ON CONFLICT (thread_id) DO UPDATE SET "
                 "user_id = EXCLUDED.user_id,"
                 "assistant_id = EXCLUDED.assistant_id, "
                 "name = EXCLUDED.name, "
                 "updated_at = EXCLUDED.updated_at, "
-                "metadata = EXCLUDED.metadata;"
+                "metadata = EXCLUDED.metadata "
+                "RETURNING metadata;"
             ),
             thread_id,
             user_id,
             assistant_id,
             name,
             updated_at,
-            metadata,
         )
-        return {
-            "thread_id": thread_id,
-            "user_id": user_id,
-            "assistant_id": assistant_id,
-            "name": name,
-            "updated_at": updated_at,
-            "metadata": metadata,
-        }
+    _threads.invalidate(thread_id)
+    return {
+        "thread_id": thread_id,
+        "user_id": user_id,
+        "assistant_id": assistant_id,
+        "name": name,
+        "updated_at": updated_at,
+        "metadata": metadata,
+    }
+
+
+async def fork_thread(
+    user_id: str,
+    thread: Thread,
+    *,
+    thread_ts: Optional[datetime] = None,
+    name: Optional[str] = None,
+) -> Optional[Thread]:
+    """Fork a thread of the user from one of its states, the latest one by
+    default.
+
+    The new thread shares the checkpoints of the thread it was forked from
+    rather than copying them, see `PostgresCheckpoint.afork`.
+
+    Returns None if the thread has no state at `thread_ts`, or no state at
+    all.
+    """
+    fork_id = str(uuid4())
+    forked = await CHECKPOINTER.afork(
+        {"configurable": {"thread_id": thread["thread_id"], "thread_ts": thread_ts}},
+        fork_id,
+    )
+    if forked is None:
+        return None
+    return await put_thread(
+        user_id,
+        fork_id,
+        assistant_id=thread["assistant_id"],
+        name=name or thread["name"],
+    )
 
 
 async def delete_thread(user_id: str, thread_id: str):
@@ -207,14 +483,147 @@ async def delete_thread(user_id: str, thread_id: str):
             thread_id,
             user_id,
         )
+    _threads.invalidate(thread_id)
 
 
 async def get_or_create_user(sub: str) -> tuple[User, bool]:
     """Returns a tuple of the user and a boolean indicating whether the user was created."""
+    if cached := _users.lookup(sub):
+        return cached[0], False
+    epoch = _users.epoch
     async with get_pg_pool().acquire() as conn:
-        if user := await conn.fetchrow('SELECT * FROM "user" WHERE sub = $1', sub):
-            return user, False
-        user = await conn.fetchrow(
-            'INSERT INTO "user" (sub) VALUES ($1) RETURNING *', sub
+        # Nothing is returned if the user was created by a transaction
+        # committed after this statement started, in which case it is seen
+        # when trying again.
+        row = None
+        while row is None:
+            row = await conn.fetchrow(
+                """
+                WITH created AS (
+                    INSERT INTO "user" (sub) VALUES ($1)
+                    ON CONFLICT (sub) DO NOTHING
+                    RETURNING *
+                )
+                SELECT *, true AS created FROM created
+                UNION ALL
+                SELECT *, false AS created FROM "user"
+                WHERE sub = $1 AND NOT EXISTS (SELECT 1 FROM created)""",
+                sub,
+            )
+    user = {key: value for key, value in row.items() if key != "created"}
+    _users.store(sub, user, epoch)
+    return user, row["created"]
+
+
+async def put_run(
+    user_id: str, run_id: str, thread_id: str, *, instance_id: Optional[str] = None
+) -> Run:
+    """Record a pending run, executed by the replica `instance_id`."""
+    async with get_pg_pool().acquire() as conn:
+        return await conn.fetchrow(
+            """INSERT INTO run (run_id, thread_id, user_id, instance_id)
+            VALUES ($1, $2, $3, $4) RETURNING *""",
+            run_id,
+            thread_id,
+            user_id,
+            instance_id,
+        )
+
+
+async def put_runs(
+    user_id: str,
+    runs: Sequence[tuple[str, str]],
+    *,
+    instance_id: Optional[str] = None,
+) -> list[Run]:
+    """Record pending runs, given as `(run_id, thread_id)` pairs, executed by
+    the replica `instance_id`."""
+    async with get_pg_pool().acquire() as conn:
+        return await conn.fetch(
+            """INSERT INTO run (run_id, thread_id, user_id, instance_id)
+            SELECT * FROM unnest($1::uuid[], $2::uuid[]),
+                (SELECT $3::varchar), (SELECT $4::varchar)
+            RETURNING *""",
+            [run_id for run_id, _ in runs],
+            [thread_id for _, thread_id in runs],
+            user_id,
+            instance_id,
+        )
+
+
+async def get_run(user_id: str, run_id: str) -> Optional[Run]:
+    """Get a run by ID."""
+    async with get_pg_pool().acquire() as conn:
+        return await conn.fetchrow(
+            "SELECT * FROM run WHERE run_id = $1 AND user_id = $2",
+            run_id,
+            user_id,
+        )
+
+
+async def begin_run(run_id: str) -> bool:
+    """Mark a pending run as running, unless it was cancelled."""
+    async with get_pg_pool().acquire() as conn:
+        return (
+            await conn.execute(
+                """UPDATE run SET status = 'running', started_at = $2
+                WHERE run_id = $1 AND status = 'pending'""",
+                run_id,
+                datetime.now(timezone.utc),
+            )
+            == "UPDATE 1"
+        )
+
+
+async def end_run(run_id: str, status: str, error: Optional[str] = None) -> None:
+    """Record the outcome of a run."""
+    async with get_pg_pool().acquire() as conn:
+        await conn.execute(
+            "UPDATE run SET status = $2, ended_at = $3, error = $4 WHERE run_id = $1",
+            run_id,
+            status,
+            datetime.now(timezone.utc),
+            error,
+        )
+
+
+async def cancel_pending_runs(run_ids: Sequence[str]) -> None:
+    """Record runs still pending as cancelled."""
+    async with get_pg_pool().acquire() as conn:
+        await conn.execute(
+            """UPDATE run SET status = 'cancelled', ended_at = $2
+            WHERE run_id = ANY($1::uuid[]) AND status = 'pending'""",
+            run_ids,
+            datetime.now(timezone.utc),
+        )
+
+
+async def end_unfinished_runs(instance_id: str) -> int:
+    """Record the runs a replica left unfinished as interrupted: cancelled if
+    they were being cancelled, failed otherwise. Returns their number."""
+    async with get_pg_pool().acquire() as conn:
+        result = await conn.execute(
+            """UPDATE run SET ended_at = $2,
+                status = CASE status WHEN 'cancelling' THEN 'cancelled' ELSE 'error' END,
+                error = CASE status WHEN 'cancelling' THEN NULL ELSE 'Interrupted' END
+            WHERE instance_id = $1 AND status IN ('pending', 'running', 'cancelling')""",
+            instance_id,
+            datetime.now(timezone.utc),
+        )
+    return int(result.split()[-1])
+
+
+async def cancel_run(user_id: str, run_id: str) -> Optional[Run]:
+    """Request a run to be cancelled, if not over yet.
+
+    The replica executing the run is notified by a trigger, see migration
+    000012.
+    """
+    async with get_pg_pool().acquire() as conn:
+        return await conn.fetchrow(
+            """UPDATE run SET status = 'cancelling'
+            WHERE run_id = $1 AND user_id = $2 AND status IN ('pending', 'running')
+            RETURNING *""",
+            run_id,
+            user_id,
         )
-        return user, True
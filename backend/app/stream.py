@@ -1,4 +1,7 @@
+import asyncio
 import functools
+import operator
+import os
 from typing import Any, AsyncIterator, Dict, Optional, Sequence, Union
 
 import orjson
@@ -8,50 +11,156 @@ from langchain_core.runnables import Runnable, RunnableConfig
 
 logger = structlog.get_logger(__name__)
 
-MessagesStream = AsyncIterator[Union[list[AnyMessage], str]]
+COALESCE_WINDOW = float(os.getenv("STREAM_COALESCE_MS", "50")) / 1000
+COALESCE_MAX_CHUNKS = int(os.getenv("STREAM_COALESCE_CHUNKS", "32"))
+
+
+class PartialMessages(list):
+    """Messages being generated, as generated so far."""
+
+
+class MessageDeltas(list):
+    """Chunks of messages being generated, each to be appended to the previous
+    chunks of the message with the same id."""
+
+
+MessagesStream = AsyncIterator[
+    Union[list[AnyMessage], PartialMessages, MessageDeltas, str]
+]
 
 
 async def astream_state(
     app: Runnable,
     input: Union[Sequence[AnyMessage], Dict[str, Any]],
     config: RunnableConfig,
+    *,
+    deltas: bool = False,
 ) -> MessagesStream:
-    """Stream messages from the runnable."""
+    """Stream messages from the runnable.
+
+    Messages being generated are streamed as `PartialMessages` on every new
+    chunk, or with `deltas`, as `MessageDeltas` of the new chunk only. Either
+    way, the complete message is streamed once generated.
+    """
     root_run_id: Optional[str] = None
     messages: dict[str, BaseMessage] = {}
 
-    async for event in app.astream_events(
+    events = app.astream_events(
         input, config, version="v1", stream_mode="values", exclude_tags=["nostream"]
-    ):
-        if event["event"] == "on_chain_start" and not root_run_id:
-            root_run_id = event["run_id"]
-            yield root_run_id
-        elif event["event"] == "on_chain_stream" and event["run_id"] == root_run_id:
-            new_messages: list[BaseMessage] = []
-
-            # event["data"]["chunk"] is a Sequence[AnyMessage] or a Dict[str, Any]
-            state_chunk_msgs: Union[Sequence[AnyMessage], Dict[str, Any]] = event[
-                "data"
-            ]["chunk"]
-            if isinstance(state_chunk_msgs, dict):
-                state_chunk_msgs = event["data"]["chunk"]["messages"]
-
-            for msg in state_chunk_msgs:
-                msg_id = msg["id"] if isinstance(msg, dict) else msg.id
-                if msg_id in messages and msg == messages[msg_id]:
-                    continue
+    )
+    try:
+        async for event in events:
+            if event["event"] == "on_chain_start" and not root_run_id:
+                root_run_id = event["run_id"]
+                yield root_run_id
+            elif event["event"] == "on_chain_stream" and event["run_id"] == root_run_id:
+                new_messages: list[BaseMessage] = []
+
+                # event["data"]["chunk"] is a Sequence[AnyMessage] or a Dict[str, Any]
+                state_chunk_msgs: Union[Sequence[AnyMessage], Dict[str, Any]] = event[
+                    "data"
+                ]["chunk"]
+                if isinstance(state_chunk_msgs, dict):
+                    state_chunk_msgs = event["data"]["chunk"]["messages"]
+
+                for msg in state_chunk_msgs:
+                    msg_id = msg["id"] if isinstance(msg, dict) else msg.id
+                    if msg_id in messages and msg == messages[msg_id]:
+                        continue
+                    else:
+                        messages[msg_id] = msg
+                        new_messages.append(msg)
+                if new_messages:
+                    yield new_messages
+            elif event["event"] == "on_chat_model_stream":
+                message: BaseMessage = event["data"]["chunk"]
+                if deltas:
+                    # Only tracked so that the complete message is streamed
+                    messages[message.id] = message
+                    yield MessageDeltas([message])
+                elif message.id not in messages:
+                    messages[message.id] = message
+                    yield PartialMessages([messages[message.id]])
                 else:
-                    messages[msg_id] = msg
-                    new_messages.append(msg)
-            if new_messages:
-                yield new_messages
-        elif event["event"] == "on_chat_model_stream":
-            message: BaseMessage = event["data"]["chunk"]
-            if message.id not in messages:
-                messages[message.id] = message
+                    messages[message.id] += message
+                    yield PartialMessages([messages[message.id]])
+    finally:
+        # Stops the graph if the stream is closed before the end
+        await events.aclose()
+
+
+def _merge(batch: list[Union[PartialMessages, MessageDeltas]]):
+    if isinstance(batch[-1], PartialMessages):
+        return batch[-1]
+    return MessageDeltas(
+        functools.reduce(operator.add, chunks) for chunks in zip(*batch)
+    )
+
+
+async def coalesce(
+    messages_stream: MessagesStream,
+    *,
+    window: float = COALESCE_WINDOW,
+    max_chunks: int = COALESCE_MAX_CHUNKS,
+) -> MessagesStream:
+    """Batch the updates of messages being generated.
+
+    Updates of the same messages are merged into one, sent `window` seconds
+    after the first one, or once there are `max_chunks` of them. Pending
+    updates are sent right away when other messages start being generated,
+    before any other item, and at the end of the stream.
+
+    The window and chunk count default to the `STREAM_COALESCE_MS` and
+    `STREAM_COALESCE_CHUNKS` environment variables.
+    """
+    if window <= 0 or max_chunks <= 1:
+        async for item in messages_stream:
+            yield item
+        return
+    loop = asyncio.get_running_loop()
+    iterator = messages_stream.__aiter__()
+    batch: list[Union[PartialMessages, MessageDeltas]] = []
+    deadline = 0.0
+    # Waiting for the next item isn't cancelled when the window closes, as
+    # that would cancel the stream
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(deadline - loop.time(), 0) if batch else None
+            if not (await asyncio.wait({pending}, timeout=timeout))[0]:
+                yield _merge(batch)
+                batch = []
+                continue
+            done, pending = pending, None
+            try:
+                item = done.result()
+            except StopAsyncIteration:
+                break
+            if isinstance(item, (PartialMessages, MessageDeltas)):
+                if batch and [m.id for m in batch[-1]] != [m.id for m in item]:
+                    yield _merge(batch)
+                    batch = []
+                if not batch:
+                    deadline = loop.time() + window
+                batch.append(item)
+                if len(batch) >= max_chunks:
+                    yield _merge(batch)
+                    batch = []
             else:
-                messages[message.id] += message
-            yield [messages[message.id]]
+                if batch:
+                    yield _merge(batch)
+                    batch = []
+                yield item
+        if batch:
+            yield _merge(batch)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
 
 
 def _default(obj) -> Any:
@@ -63,6 +172,15 @@ def _default(obj) -> Any:
 dumps = functools.partial(orjson.dumps, default=_default)
 
 
+def _delta(chunk: BaseMessage) -> dict[str, Any]:
+    """The new content and tool call chunks of a message chunk."""
+    delta = {"id": chunk.id, "content": chunk.content}
+    for key in ("tool_call_chunks", "additional_kwargs"):
+        if value := getattr(chunk, key, None):
+            delta[key] = value
+    return delta
+
+
 async def to_sse(messages_stream: MessagesStream) -> AsyncIterator[dict]:
     """Consume the stream into an EventSourceResponse"""
     try:
@@ -75,6 +193,11 @@ async def to_sse(messages_stream: MessagesStream) -> AsyncIterator[dict]:
                     "event": "metadata",
                     "data": orjson.dumps({"run_id": chunk}).decode(),
                 }
+            elif isinstance(chunk, MessageDeltas):
+                yield {
+                    "event": "delta",
+                    "data": dumps([_delta(msg) for msg in chunk]).decode(),
+                }
             else:
                 yield {
                     "event": "data",
@@ -0,0 +1,191 @@
+"""Benchmark PostgresCheckpoint writes and reads at several concurrency levels.
+
+Runs against a scratch database created next to POSTGRES_DB, see
+`benchmarks.helpers.benchmark_db`.
+
+Usage: python -m benchmarks.checkpoint [--threads 32] [--steps 20]
+    [--message-size 500] [--tool-density 0.5] [--concurrency 1 8 32]
+"""
+
+import argparse
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+import orjson
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import Checkpoint, empty_checkpoint
+
+from app.checkpoint import PostgresCheckpoint
+from app.message_types import LiberalToolMessage
+from app.serde import get_serializer
+from benchmarks.helpers import PoolSampler, Timings, benchmark_db, run_phase
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make_turn(rng: random.Random, turn: int, message_size: int, tool_density: float):
+    """The messages of one turn, with a tool call in `tool_density` of turns."""
+    text = "".join(rng.choices("abcdefghij klmnopqrst uvwxyz", k=message_size))
+    messages = [HumanMessage(content=text, id=f"h{turn}")]
+    if rng.random() < tool_density:
+        messages.append(
+            AIMessage(
+                content="",
+                id=f"c{turn}",
+                tool_calls=[
+                    {
+                        "name": "retriever",
+                        "args": {"query": text[:50]},
+                        "id": f"t{turn}",
+                    }
+                ],
+            )
+        )
+        messages.append(
+            LiberalToolMessage(
+                tool_call_id=f"t{turn}",
+                id=f"r{turn}",
+                content=[
+                    Document(page_content=text, metadata={"source": f"doc{j}"})
+                    for j in range(3)
+                ],
+            )
+        )
+    messages.append(AIMessage(content=text, id=f"a{turn}"))
+    return messages
+
+
+def make_checkpoints(
+    rng: random.Random, steps: int, message_size: int, tool_density: float
+) -> list[Checkpoint]:
+    """The checkpoints of a thread, each adding a turn to the previous one."""
+    checkpoints = []
+    messages = []
+    for step in range(steps):
+        messages = messages + make_turn(rng, step, message_size, tool_density)
+        checkpoint = empty_checkpoint()
+        checkpoint["ts"] = (START + timedelta(seconds=step)).isoformat()
+        checkpoint["channel_values"] = {"__root__": messages}
+        checkpoint["channel_versions"]["__root__"] = step + 1
+        checkpoint["versions_seen"]["agent"]["__root__"] = step + 1
+        checkpoints.append(checkpoint)
+    return checkpoints
+
+
+async def _write_thread(
+    saver: PostgresCheckpoint,
+    timings: Timings,
+    thread_id: str,
+    checkpoints: list[Checkpoint],
+) -> None:
+    config = {"configurable": {"thread_id": thread_id}}
+    for checkpoint in checkpoints:
+        config = await timings.measure("aput", saver.aput(config, checkpoint))
+
+
+async def _get(saver: PostgresCheckpoint, thread_id: str) -> dict:
+    # Read every channel, as runs do, since channel values are computed lazily
+    tup = await saver.aget_tuple({"configurable": {"thread_id": thread_id}})
+    return dict(tup.checkpoint["channel_values"])
+
+
+async def _list(saver: PostgresCheckpoint, thread_id: str, limit=None) -> list:
+    config = {"configurable": {"thread_id": thread_id}}
+    return [
+        dict(c.checkpoint["channel_values"])
+        async for c in saver.alist(config, limit=limit)
+    ]
+
+
+async def run_level(args: argparse.Namespace, pool, concurrency: int) -> dict:
+    rng = random.Random(args.seed)
+    threads = {
+        f"c{concurrency}-t{i}": make_checkpoints(
+            rng, args.steps, args.message_size, args.tool_density
+        )
+        for i in range(args.threads)
+    }
+    saver = PostgresCheckpoint(
+        serde=get_serializer(), snapshot_interval=args.snapshot_interval
+    )
+    timings = Timings()
+
+    async with PoolSampler(pool) as sampler:
+        await run_phase(
+            timings,
+            "aput",
+            concurrency,
+            [
+                lambda t=t, c=c: _write_thread(saver, timings, t, c)
+                for t, c in threads.items()
+            ],
+        )
+        for name, reader in (
+            ("aget_tuple_cached", saver),
+            ("aget_tuple", PostgresCheckpoint(serde=get_serializer())),
+        ):
+            await run_phase(
+                timings,
+                name,
+                concurrency,
+                [
+                    lambda t=t, name=name, reader=reader: timings.measure(
+                        name, _get(reader, t)
+                    )
+                    for t in threads
+                ],
+            )
+        cold = PostgresCheckpoint(serde=get_serializer())
+        await run_phase(
+            timings,
+            "alist",
+            concurrency,
+            [lambda t=t: timings.measure("alist", _list(cold, t)) for t in threads],
+        )
+        await run_phase(
+            timings,
+            "alist_page",
+            concurrency,
+            [
+                lambda t=t: timings.measure("alist_page", _list(cold, t, limit=10))
+                for t in threads
+            ],
+        )
+
+    async with pool.acquire() as conn:
+        rows, total = await conn.fetchrow(
+            "SELECT count(*), sum(octet_length(checkpoint)) FROM checkpoints WHERE thread_id LIKE $1",
+            f"c{concurrency}-%",
+        )
+    return {
+        "operations": timings.summary(),
+        "checkpoints": rows,
+        "bytes_per_checkpoint": total / rows if rows else 0,
+        **sampler.summary(),
+    }
+
+
+async def main(args: argparse.Namespace) -> dict:
+    async with benchmark_db() as pool:
+        return {
+            "params": vars(args),
+            "levels": {
+                str(level): await run_level(args, pool, level)
+                for level in args.concurrency
+            },
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--message-size", type=int, default=500)
+    parser.add_argument("--tool-density", type=float, default=0.5)
+    parser.add_argument("--snapshot-interval", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(orjson.dumps(asyncio.run(main(args)), option=orjson.OPT_INDENT_2).decode())
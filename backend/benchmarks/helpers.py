@@ -0,0 +1,133 @@
+"""Shared setup and measurements for the database benchmarks."""
+
+import asyncio
+import os
+import subprocess
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import asyncpg
+from fastapi import FastAPI
+
+from app.lifespan import get_pg_pool, lifespan
+
+BENCHMARK_DB = "benchmark"
+
+
+async def _admin_execute(query: str) -> None:
+    conn = await asyncpg.connect(
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+        database="postgres",
+    )
+    try:
+        await conn.execute(query)
+    finally:
+        await conn.close()
+
+
+@asynccontextmanager
+async def benchmark_db() -> AsyncIterator[asyncpg.pool.Pool]:
+    """Run the app lifespan against a freshly migrated database, dropped after."""
+    await _admin_execute(f'DROP DATABASE IF EXISTS "{BENCHMARK_DB}" WITH (FORCE)')
+    await _admin_execute(f'CREATE DATABASE "{BENCHMARK_DB}"')
+    os.environ["POSTGRES_DB"] = BENCHMARK_DB
+    subprocess.run(["make", "-s", "migrate"], check=True, stdout=subprocess.DEVNULL)
+    try:
+        async with lifespan(FastAPI()):
+            yield get_pg_pool()
+    finally:
+        await _admin_execute(f'DROP DATABASE IF EXISTS "{BENCHMARK_DB}" WITH (FORCE)')
+
+
+def percentile(values: list[float], p: float) -> float:
+    """The p-th percentile of values, by nearest rank."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class PoolSampler:
+    """Samples how many connections of a pool are in use while running."""
+
+    def __init__(self, pool: asyncpg.pool.Pool, interval: float = 0.001) -> None:
+        self.pool = pool
+        self.interval = interval
+        self.samples: list[int] = []
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self.samples.append(self.pool.get_size() - self.pool.get_idle_size())
+            await asyncio.sleep(self.interval)
+
+    async def __aenter__(self) -> "PoolSampler":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        self._task.cancel()
+
+    def summary(self) -> dict:
+        max_size = self.pool.get_max_size()
+        return {
+            "pool_max_size": max_size,
+            "pool_in_use_max": max(self.samples, default=0),
+            "pool_in_use_avg": sum(self.samples) / len(self.samples)
+            if self.samples
+            else 0,
+            "pool_saturated_ratio": sum(s >= max_size for s in self.samples)
+            / len(self.samples)
+            if self.samples
+            else 0,
+        }
+
+
+class Timings:
+    """Latencies of operations, grouped by name."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self.elapsed: dict[str, float] = {}
+
+    async def measure(self, name: str, awaitable: Awaitable) -> Any:
+        start = time.perf_counter()
+        result = await awaitable
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self) -> dict:
+        return {
+            name: {
+                "count": len(latencies),
+                "throughput_per_s": len(latencies) / self.elapsed[name]
+                if self.elapsed.get(name)
+                else None,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            }
+            for name, latencies in self.latencies.items()
+        }
+
+
+async def run_phase(
+    timings: Timings,
+    name: str,
+    concurrency: int,
+    jobs: list[Callable[[], Awaitable]],
+) -> None:
+    """Run jobs with at most `concurrency` at a time, recording the wall time
+    of the phase under `name` for throughput."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _job(job: Callable[[], Awaitable]) -> None:
+        async with semaphore:
+            await job()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_job(job) for job in jobs))
+    timings.elapsed[name] = time.perf_counter() - start
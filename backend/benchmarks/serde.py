@@ -0,0 +1,151 @@
+"""Compare checkpoint serializers on realistic message lists.
+
+Messages are generated from a seeded random source, with varied text, ids and
+tool results, so that compression isn't flattered by repeated content.
+
+Usage: python -m benchmarks.serde [--messages 200] [--repeat 20] [--seed 0]
+"""
+
+import argparse
+import pickle
+import random
+import string
+import timeit
+
+import orjson
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+
+from app.checkpoint import dumps, loads
+from app.message_types import LiberalToolMessage
+from app.serde import CODECS, CheckpointSerializer
+
+WORDS = (
+    "the of and to in is that for it as with was on be by this are from at or "
+    "an have not which but can their more has all one been were will would "
+    "search result query model agent thread message document source page "
+    "price market report data figure table section policy customer product "
+    "release version error request response latency throughput cache index"
+).split()
+
+
+def _text(rng: random.Random, words: int) -> str:
+    sentence = []
+    for _ in range(words):
+        word = rng.choice(WORDS)
+        if rng.random() < 0.15:
+            # Names, numbers and identifiers, which don't repeat
+            word = "".join(rng.choices(string.ascii_letters + string.digits, k=8))
+        sentence.append(word)
+    return " ".join(sentence).capitalize() + "."
+
+
+def _id(rng: random.Random, prefix: str = "") -> str:
+    return prefix + "".join(rng.choices(string.ascii_letters + string.digits, k=24))
+
+
+def make_messages(count: int, seed: int = 0) -> list:
+    """A conversation of questions, tool calls, tool results and answers."""
+    rng = random.Random(seed)
+    messages = []
+    while len(messages) < count:
+        messages.append(
+            HumanMessage(content=_text(rng, rng.randint(5, 60)), id=_id(rng))
+        )
+        usage = {
+            "completion_tokens": rng.randint(10, 800),
+            "prompt_tokens": rng.randint(100, 8000),
+        }
+        if rng.random() < 0.6:
+            call_id = _id(rng, "call_")
+            messages.append(
+                AIMessage(
+                    content="",
+                    id=_id(rng, "run-"),
+                    tool_calls=[
+                        {
+                            "name": rng.choice(["tavily_search", "retriever", "arxiv"]),
+                            "args": {"query": _text(rng, rng.randint(3, 12))},
+                            "id": call_id,
+                        }
+                    ],
+                    response_metadata={
+                        "token_usage": usage,
+                        "model_name": "gpt-4-turbo",
+                        "finish_reason": "tool_calls",
+                    },
+                )
+            )
+            messages.append(
+                LiberalToolMessage(
+                    tool_call_id=call_id,
+                    id=_id(rng),
+                    content=[
+                        Document(
+                            page_content=_text(rng, rng.randint(40, 250)),
+                            metadata={
+                                "source": f"https://example.com/{_id(rng)}",
+                                "title": _text(rng, rng.randint(3, 10)),
+                                "score": rng.random(),
+                            },
+                        )
+                        for _ in range(rng.randint(1, 5))
+                    ],
+                )
+            )
+        messages.append(
+            AIMessage(
+                content=_text(rng, rng.randint(20, 300)),
+                id=_id(rng, "run-"),
+                response_metadata={
+                    "token_usage": usage,
+                    "model_name": "gpt-4-turbo",
+                    "finish_reason": "stop",
+                },
+            )
+        )
+    return messages[:count]
+
+
+def _load(data: bytes, serde) -> dict:
+    # Read all channels, as channel values are only revived on access
+    return dict(loads(data, serde)["channel_values"])
+
+
+def run(messages: int, repeat: int, seed: int = 0) -> dict:
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"__root__": make_messages(messages, seed)}
+    checkpoint["channel_versions"]["__root__"] = 1
+    checkpoint["versions_seen"]["agent"]["__root__"] = 1
+
+    serializers = {"pickle": pickle}
+    for name in CODECS:
+        serializers[name] = CheckpointSerializer(compression=name)
+
+    results = {}
+    for name, serde in serializers.items():
+        data = dumps(checkpoint, serde)
+        results[name] = {
+            "bytes": len(data),
+            "dumps_ms": timeit.timeit(lambda: dumps(checkpoint, serde), number=repeat)
+            / repeat
+            * 1000,
+            "loads_ms": timeit.timeit(lambda: _load(data, serde), number=repeat)
+            / repeat
+            * 1000,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(
+        orjson.dumps(
+            run(args.messages, args.repeat, args.seed), option=orjson.OPT_INDENT_2
+        ).decode()
+    )
@@ -0,0 +1,111 @@
+"""Benchmark the queries of app.storage at several concurrency levels.
+
+Runs against a scratch database created next to POSTGRES_DB, see
+`benchmarks.helpers.benchmark_db`.
+
+Usage: python -m benchmarks.storage [--users 50] [--threads-per-user 20]
+    [--concurrency 1 8 32]
+"""
+
+import argparse
+import asyncio
+from uuid import uuid4
+
+import orjson
+
+import app.storage as storage
+from benchmarks.helpers import PoolSampler, Timings, benchmark_db, run_phase
+
+
+async def run_level(args: argparse.Namespace, pool, concurrency: int) -> dict:
+    subs = [f"c{concurrency}-u{i}" for i in range(args.users)]
+    timings = Timings()
+
+    def phase(name: str, jobs: list):
+        return run_phase(
+            timings,
+            name,
+            concurrency,
+            [lambda job=job: timings.measure(name, job()) for job in jobs],
+        )
+
+    async with PoolSampler(pool) as sampler:
+        await phase(
+            "get_or_create_user",
+            [lambda s=s: storage.get_or_create_user(s) for s in subs],
+        )
+        users = [(await storage.get_or_create_user(sub))[0]["user_id"] for sub in subs]
+        assistants = {user_id: str(uuid4()) for user_id in users}
+        threads = [
+            (user_id, str(uuid4()))
+            for user_id in users
+            for _ in range(args.threads_per_user)
+        ]
+        await phase(
+            "put_assistant",
+            [
+                lambda u=u: storage.put_assistant(
+                    u,
+                    assistants[u],
+                    name="assistant",
+                    config={"configurable": {"type": "chatbot"}},
+                )
+                for u in users
+            ],
+        )
+        await phase(
+            "put_thread",
+            [
+                lambda u=u, t=t: storage.put_thread(
+                    u, t, assistant_id=assistants[u], name="thread"
+                )
+                for u, t in threads
+            ],
+        )
+        await phase(
+            "list_assistants", [lambda u=u: storage.list_assistants(u) for u in users]
+        )
+        await phase(
+            "list_threads", [lambda u=u: storage.list_threads(u) for u in users]
+        )
+        await phase(
+            "get_assistant",
+            [lambda u=u: storage.get_assistant(u, assistants[u]) for u in users],
+        )
+        await phase(
+            "get_thread",
+            [lambda u=u, t=t: storage.get_thread(u, t) for u, t in threads],
+        )
+
+        async def get_thread_state(user_id: str, thread_id: str):
+            assistant = await storage.get_assistant(user_id, assistants[user_id])
+            return await storage.get_thread_state(
+                user_id=user_id, thread_id=thread_id, assistant=assistant
+            )
+
+        await phase(
+            "get_thread_state",
+            [lambda u=u, t=t: get_thread_state(u, t) for u, t in threads],
+        )
+
+    return {"operations": timings.summary(), **sampler.summary()}
+
+
+async def main(args: argparse.Namespace) -> dict:
+    async with benchmark_db() as pool:
+        return {
+            "params": vars(args),
+            "levels": {
+                str(level): await run_level(args, pool, level)
+                for level in args.concurrency
+            },
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--threads-per-user", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+    print(orjson.dumps(asyncio.run(main(args)), option=orjson.OPT_INDENT_2).decode())
@@ -0,0 +1,5 @@
+-- Delta rows cannot be read without their base, so drop them with the column.
+DELETE FROM checkpoints WHERE base_ts IS NOT NULL;
+
+ALTER TABLE checkpoints
+    DROP COLUMN IF EXISTS base_ts;
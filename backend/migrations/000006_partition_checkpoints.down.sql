@@ -0,0 +1,26 @@
+DROP TRIGGER IF EXISTS mirror_checkpoints ON checkpoints;
+DROP FUNCTION IF EXISTS mirror_checkpoints();
+DROP TABLE IF EXISTS checkpoints_partitioned;
+
+-- Move checkpoints back to a regular table if the switch already happened.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class WHERE relname = 'checkpoints' AND relkind = 'p'
+    ) THEN
+        ALTER TABLE checkpoints RENAME TO checkpoints_partitioned;
+        DROP TABLE IF EXISTS checkpoints_unpartitioned;
+        CREATE TABLE checkpoints_unpartitioned (
+            thread_id TEXT NOT NULL,
+            checkpoint BYTEA,
+            thread_ts TIMESTAMPTZ NOT NULL,
+            parent_ts TIMESTAMPTZ,
+            base_ts TIMESTAMPTZ,
+            PRIMARY KEY (thread_id, thread_ts)
+        );
+        INSERT INTO checkpoints_unpartitioned
+            SELECT * FROM checkpoints_partitioned;
+        DROP TABLE checkpoints_partitioned;
+    END IF;
+    ALTER TABLE IF EXISTS checkpoints_unpartitioned RENAME TO checkpoints;
+END $$;
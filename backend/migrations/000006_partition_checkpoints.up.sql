@@ -0,0 +1,55 @@
+-- Hash partitioned copy of the checkpoints table, with the same columns in
+-- the same order. Existing rows are moved by tools/partition_checkpoints,
+-- while the trigger below mirrors all writes made in the meantime.
+CREATE TABLE IF NOT EXISTS checkpoints_partitioned (
+    thread_id TEXT NOT NULL,
+    checkpoint BYTEA,
+    thread_ts TIMESTAMPTZ NOT NULL,
+    parent_ts TIMESTAMPTZ,
+    base_ts TIMESTAMPTZ,
+    PRIMARY KEY (thread_id, thread_ts)
+) PARTITION BY HASH (thread_id);
+
+DO $$
+BEGIN
+    FOR i IN 0..15 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS checkpoints_p%s PARTITION OF checkpoints_partitioned FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+            i, i
+        );
+    END LOOP;
+END $$;
+
+-- Finds the deltas built on a checkpoint, when compacting.
+CREATE INDEX IF NOT EXISTS checkpoints_partitioned_base_ts_idx
+    ON checkpoints_partitioned (thread_id, base_ts) WHERE base_ts IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION mirror_checkpoints() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM checkpoints_partitioned
+        WHERE thread_id = OLD.thread_id AND thread_ts = OLD.thread_ts;
+        RETURN OLD;
+    END IF;
+    INSERT INTO checkpoints_partitioned VALUES (NEW.*)
+    ON CONFLICT (thread_id, thread_ts) DO UPDATE SET
+        checkpoint = EXCLUDED.checkpoint,
+        parent_ts = EXCLUDED.parent_ts,
+        base_ts = EXCLUDED.base_ts;
+    RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS mirror_checkpoints ON checkpoints;
+CREATE TRIGGER mirror_checkpoints
+    AFTER INSERT OR UPDATE OR DELETE ON checkpoints
+    FOR EACH ROW EXECUTE FUNCTION mirror_checkpoints();
+
+-- Nothing to move if there are no checkpoints yet, so switch right away.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM checkpoints) THEN
+        DROP TABLE checkpoints;
+        ALTER TABLE checkpoints_partitioned RENAME TO checkpoints;
+        DROP FUNCTION mirror_checkpoints();
+    END IF;
+END $$;
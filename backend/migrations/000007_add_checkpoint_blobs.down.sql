@@ -0,0 +1,35 @@
+-- Checkpoints referencing blobs cannot be read without them, so drop them,
+-- and the deltas built on them, with the blobs.
+WITH RECURSIVE doomed AS (
+    SELECT thread_id, thread_ts FROM checkpoints WHERE blobs IS NOT NULL
+    UNION
+    SELECT c.thread_id, c.thread_ts
+    FROM checkpoints c JOIN doomed d
+    ON c.thread_id = d.thread_id AND c.base_ts = d.thread_ts
+)
+DELETE FROM checkpoints c USING doomed d
+WHERE c.thread_id = d.thread_id AND c.thread_ts = d.thread_ts;
+
+ALTER TABLE checkpoints DROP COLUMN IF EXISTS blobs;
+ALTER TABLE IF EXISTS checkpoints_partitioned DROP COLUMN IF EXISTS blobs;
+DROP TABLE IF EXISTS checkpoint_blobs;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_proc WHERE proname = 'mirror_checkpoints') THEN
+        CREATE OR REPLACE FUNCTION mirror_checkpoints() RETURNS TRIGGER AS $mirror$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM checkpoints_partitioned
+                WHERE thread_id = OLD.thread_id AND thread_ts = OLD.thread_ts;
+                RETURN OLD;
+            END IF;
+            INSERT INTO checkpoints_partitioned VALUES (NEW.*)
+            ON CONFLICT (thread_id, thread_ts) DO UPDATE SET
+                checkpoint = EXCLUDED.checkpoint,
+                parent_ts = EXCLUDED.parent_ts,
+                base_ts = EXCLUDED.base_ts;
+            RETURN NEW;
+        END $mirror$ LANGUAGE plpgsql;
+    END IF;
+END $$;
@@ -0,0 +1,35 @@
+CREATE TABLE IF NOT EXISTS checkpoint_blobs (
+    hash BYTEA PRIMARY KEY,
+    data BYTEA NOT NULL,
+    touched_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- The hashes of the blobs referenced by each checkpoint.
+ALTER TABLE checkpoints ADD COLUMN IF NOT EXISTS blobs BYTEA[];
+CREATE INDEX IF NOT EXISTS checkpoints_blobs_idx ON checkpoints USING GIN (blobs);
+
+-- Keep the partitioned copy of checkpoints, and the trigger mirroring writes
+-- into it, in sync if checkpoints are still being moved.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'checkpoints_partitioned') THEN
+        ALTER TABLE checkpoints_partitioned ADD COLUMN IF NOT EXISTS blobs BYTEA[];
+        CREATE INDEX IF NOT EXISTS checkpoints_partitioned_blobs_idx
+            ON checkpoints_partitioned USING GIN (blobs);
+        CREATE OR REPLACE FUNCTION mirror_checkpoints() RETURNS TRIGGER AS $mirror$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM checkpoints_partitioned
+                WHERE thread_id = OLD.thread_id AND thread_ts = OLD.thread_ts;
+                RETURN OLD;
+            END IF;
+            INSERT INTO checkpoints_partitioned VALUES (NEW.*)
+            ON CONFLICT (thread_id, thread_ts) DO UPDATE SET
+                checkpoint = EXCLUDED.checkpoint,
+                parent_ts = EXCLUDED.parent_ts,
+                base_ts = EXCLUDED.base_ts,
+                blobs = EXCLUDED.blobs;
+            RETURN NEW;
+        END $mirror$ LANGUAGE plpgsql;
+    END IF;
+END $$;
@@ -0,0 +1,35 @@
+-- Forked threads cannot be read without their base in another thread, so
+-- drop their checkpoints, and the deltas built on them.
+WITH RECURSIVE doomed AS (
+    SELECT thread_id, thread_ts FROM checkpoints WHERE base_thread_id IS NOT NULL
+    UNION
+    SELECT c.thread_id, c.thread_ts
+    FROM checkpoints c JOIN doomed d
+    ON c.thread_id = d.thread_id AND c.base_ts = d.thread_ts
+)
+DELETE FROM checkpoints c USING doomed d
+WHERE c.thread_id = d.thread_id AND c.thread_ts = d.thread_ts;
+
+ALTER TABLE checkpoints DROP COLUMN IF EXISTS base_thread_id;
+ALTER TABLE IF EXISTS checkpoints_partitioned DROP COLUMN IF EXISTS base_thread_id;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_proc WHERE proname = 'mirror_checkpoints') THEN
+        CREATE OR REPLACE FUNCTION mirror_checkpoints() RETURNS TRIGGER AS $mirror$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM checkpoints_partitioned
+                WHERE thread_id = OLD.thread_id AND thread_ts = OLD.thread_ts;
+                RETURN OLD;
+            END IF;
+            INSERT INTO checkpoints_partitioned VALUES (NEW.*)
+            ON CONFLICT (thread_id, thread_ts) DO UPDATE SET
+                checkpoint = EXCLUDED.checkpoint,
+                parent_ts = EXCLUDED.parent_ts,
+                base_ts = EXCLUDED.base_ts,
+                blobs = EXCLUDED.blobs;
+            RETURN NEW;
+        END $mirror$ LANGUAGE plpgsql;
+    END IF;
+END $$;
@@ -0,0 +1,33 @@
+-- The thread holding the base of a delta, when it is not the thread of the
+-- delta itself. Set on the first checkpoint of a forked thread.
+ALTER TABLE checkpoints ADD COLUMN IF NOT EXISTS base_thread_id TEXT;
+CREATE INDEX IF NOT EXISTS checkpoints_base_thread_idx
+    ON checkpoints (base_thread_id, base_ts) WHERE base_thread_id IS NOT NULL;
+
+-- Keep the partitioned copy of checkpoints, and the trigger mirroring writes
+-- into it, in sync if checkpoints are still being moved.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'checkpoints_partitioned') THEN
+        ALTER TABLE checkpoints_partitioned ADD COLUMN IF NOT EXISTS base_thread_id TEXT;
+        CREATE INDEX IF NOT EXISTS checkpoints_partitioned_base_thread_idx
+            ON checkpoints_partitioned (base_thread_id, base_ts)
+            WHERE base_thread_id IS NOT NULL;
+        CREATE OR REPLACE FUNCTION mirror_checkpoints() RETURNS TRIGGER AS $mirror$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM checkpoints_partitioned
+                WHERE thread_id = OLD.thread_id AND thread_ts = OLD.thread_ts;
+                RETURN OLD;
+            END IF;
+            INSERT INTO checkpoints_partitioned VALUES (NEW.*)
+            ON CONFLICT (thread_id, thread_ts) DO UPDATE SET
+                checkpoint = EXCLUDED.checkpoint,
+                parent_ts = EXCLUDED.parent_ts,
+                base_ts = EXCLUDED.base_ts,
+                blobs = EXCLUDED.blobs,
+                base_thread_id = EXCLUDED.base_thread_id;
+            RETURN NEW;
+        END $mirror$ LANGUAGE plpgsql;
+    END IF;
+END $$;
@@ -0,0 +1,5 @@
+DROP TRIGGER IF EXISTS thread_notify_truncate ON thread;
+DROP TRIGGER IF EXISTS thread_notify_row_change ON thread;
+DROP TRIGGER IF EXISTS assistant_notify_truncate ON assistant;
+DROP TRIGGER IF EXISTS assistant_notify_row_change ON assistant;
+DROP FUNCTION IF EXISTS notify_row_change();
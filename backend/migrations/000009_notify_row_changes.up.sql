@@ -0,0 +1,30 @@
+-- Notify API replicas of changes to rows they may have cached, with a
+-- "<table>:<key>" payload, or "<table>:" when the whole table is truncated.
+-- The key column is given as the trigger argument.
+CREATE OR REPLACE FUNCTION notify_row_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_LEVEL = 'STATEMENT' THEN
+        PERFORM pg_notify('row_changes', TG_TABLE_NAME || ':');
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('row_changes', TG_TABLE_NAME || ':' || (to_jsonb(OLD) ->> TG_ARGV[0]));
+    ELSE
+        PERFORM pg_notify('row_changes', TG_TABLE_NAME || ':' || (to_jsonb(NEW) ->> TG_ARGV[0]));
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE TRIGGER assistant_notify_row_change
+AFTER INSERT OR UPDATE OR DELETE ON assistant
+FOR EACH ROW EXECUTE FUNCTION notify_row_change('assistant_id');
+
+CREATE TRIGGER assistant_notify_truncate
+AFTER TRUNCATE ON assistant
+FOR EACH STATEMENT EXECUTE FUNCTION notify_row_change();
+
+CREATE TRIGGER thread_notify_row_change
+AFTER INSERT OR UPDATE OR DELETE ON thread
+FOR EACH ROW EXECUTE FUNCTION notify_row_change('thread_id');
+
+CREATE TRIGGER thread_notify_truncate
+AFTER TRUNCATE ON thread
+FOR EACH STATEMENT EXECUTE FUNCTION notify_row_change();
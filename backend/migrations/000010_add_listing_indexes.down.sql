@@ -0,0 +1,5 @@
+DROP INDEX IF EXISTS assistant_user_type_updated_idx;
+DROP INDEX IF EXISTS assistant_user_updated_idx;
+DROP INDEX IF EXISTS thread_user_assistant_type_updated_idx;
+DROP INDEX IF EXISTS thread_user_assistant_updated_idx;
+DROP INDEX IF EXISTS thread_user_updated_idx;
@@ -0,0 +1,13 @@
+-- Serve the listing of a user's threads and assistants, most recently
+-- updated first, with or without filters, from these indexes.
+CREATE INDEX IF NOT EXISTS thread_user_updated_idx
+    ON thread (user_id, updated_at DESC, thread_id DESC);
+CREATE INDEX IF NOT EXISTS thread_user_assistant_updated_idx
+    ON thread (user_id, assistant_id, updated_at DESC, thread_id DESC);
+CREATE INDEX IF NOT EXISTS thread_user_assistant_type_updated_idx
+    ON thread (user_id, (metadata->>'assistant_type'), updated_at DESC, thread_id DESC);
+
+CREATE INDEX IF NOT EXISTS assistant_user_updated_idx
+    ON assistant (user_id, updated_at DESC, assistant_id DESC);
+CREATE INDEX IF NOT EXISTS assistant_user_type_updated_idx
+    ON assistant (user_id, (config->'configurable'->>'type'), updated_at DESC, assistant_id DESC);
@@ -0,0 +1,2 @@
+DROP TRIGGER IF EXISTS user_notify_truncate ON "user";
+DROP TRIGGER IF EXISTS user_notify_row_change ON "user";
@@ -0,0 +1,9 @@
+-- Notify API replicas of changes to the users they may have cached by sub,
+-- see 000009_notify_row_changes.
+CREATE TRIGGER user_notify_row_change
+AFTER INSERT OR UPDATE OR DELETE ON "user"
+FOR EACH ROW EXECUTE FUNCTION notify_row_change('sub');
+
+CREATE TRIGGER user_notify_truncate
+AFTER TRUNCATE ON "user"
+FOR EACH STATEMENT EXECUTE FUNCTION notify_row_change();
@@ -0,0 +1,20 @@
+CREATE TABLE IF NOT EXISTS run (
+    run_id UUID PRIMARY KEY,
+    thread_id UUID NOT NULL REFERENCES thread(thread_id) ON DELETE CASCADE,
+    user_id VARCHAR(255) NOT NULL,
+    -- pending, running, cancelling, success, error or cancelled
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    started_at TIMESTAMP WITH TIME ZONE,
+    ended_at TIMESTAMP WITH TIME ZONE,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS run_thread_id_idx ON run (thread_id, created_at DESC);
+
+-- Notify the replica executing a run that it should be cancelled, with a
+-- "run:<run_id>" payload, see 000009_notify_row_changes.
+CREATE TRIGGER run_notify_cancel
+AFTER UPDATE OF status ON run
+FOR EACH ROW WHEN (NEW.status = 'cancelling')
+EXECUTE FUNCTION notify_row_change('run_id');
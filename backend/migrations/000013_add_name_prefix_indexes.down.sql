@@ -0,0 +1,2 @@
+DROP INDEX IF EXISTS assistant_user_name_idx;
+DROP INDEX IF EXISTS thread_user_name_idx;
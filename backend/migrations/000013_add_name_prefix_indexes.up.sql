@@ -0,0 +1,6 @@
+-- Serve the name prefix filter of the thread and assistant listings
+-- (`name LIKE 'prefix%'`) from these indexes.
+CREATE INDEX IF NOT EXISTS thread_user_name_idx
+    ON thread (user_id, name text_pattern_ops);
+CREATE INDEX IF NOT EXISTS assistant_user_name_idx
+    ON assistant (user_id, name text_pattern_ops);
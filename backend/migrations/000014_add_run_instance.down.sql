@@ -0,0 +1,2 @@
+DROP INDEX IF EXISTS run_instance_unfinished_idx;
+ALTER TABLE run DROP COLUMN IF EXISTS instance_id;
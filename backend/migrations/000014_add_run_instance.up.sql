@@ -0,0 +1,6 @@
+-- The replica that recorded a run, which executes it, so that it can find
+-- its unfinished runs again when it restarts after a crash.
+ALTER TABLE run ADD COLUMN IF NOT EXISTS instance_id VARCHAR(255);
+
+CREATE INDEX IF NOT EXISTS run_instance_unfinished_idx ON run (instance_id)
+    WHERE status IN ('pending', 'running', 'cancelling');
@@ -0,0 +1,80 @@
+"""Test the admission of runs."""
+
+import asyncio
+
+import pytest
+
+from app.admission import AdmissionSettings, QueueFull, Scheduler, run_keys
+
+
+def _scheduler(**kwargs) -> Scheduler:
+    return Scheduler(
+        AdmissionSettings(**{"max_streams": None, "max_background": None, **kwargs})
+    )
+
+
+async def test_fair_queuing() -> None:
+    scheduler = _scheduler(max_streams=2, max_queued_per_user=3)
+    keys = {user: run_keys("stream", user, {}) for user in "ab"}
+    running = [scheduler.enqueue("a", keys["a"]) for _ in range(2)]
+    assert all(ticket.admitted for ticket in running)
+
+    positions: list[tuple[str, int]] = []
+    waiting = [
+        scheduler.enqueue(
+            user, keys[user], lambda p, n=f"{user}{i}": positions.append((n, p))
+        )
+        for i, user in enumerate("aaab")
+    ]
+    # a3 behind a1 and a2 only, b3 right after a1
+    assert [ticket.position for ticket in waiting] == [1, 3, 4, 2]
+    with pytest.raises(QueueFull):
+        scheduler.enqueue("a", keys["a"])
+    # Other limits apply to background runs
+    assert scheduler.enqueue("b", run_keys("background", "b", {})).admitted
+
+    # Users take turns
+    for ticket in running:
+        scheduler.release(ticket)
+    assert [t.admitted for t in waiting] == [True, False, False, True]
+    assert positions[-2:] == [("a1", 1), ("a2", 2)]
+    scheduler.release(waiting[0])
+    scheduler.release(waiting[3])
+    assert [t.admitted for t in waiting] == [False, True, True, False]
+    assert scheduler.queued == 0
+
+    # Dropped from the queue if cancelled while waiting
+    ticket = scheduler.enqueue("a", keys["a"])
+    waiter = asyncio.create_task(ticket.wait())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    scheduler.release(ticket)
+    assert scheduler.queued == 0 and not scheduler.queues
+    scheduler.release(waiting[1])
+    assert not ticket.admitted and scheduler.running["kind:stream"] == 1
+
+
+async def test_limits_by_model_and_user() -> None:
+    scheduler = _scheduler(
+        max_per_user=2, max_per_model={"GPT 4 Turbo": 1}, max_queued=1
+    )
+    gpt4 = {"type": "chatbot", "type==chatbot/llm_type": "GPT 4 Turbo"}
+    assert run_keys("stream", "a", {**gpt4, "assistant_id": "x"}) == (
+        "kind:stream",
+        "user:a",
+        "assistant:x",
+        "model:GPT 4 Turbo",
+    )
+    first = scheduler.enqueue("a", run_keys("stream", "a", gpt4))
+    assert first.admitted
+    # Other models are admitted, up to the limit of the user
+    second = scheduler.enqueue("b", run_keys("stream", "b", gpt4))
+    assert not second.admitted
+    assert scheduler.enqueue("b", run_keys("stream", "b", {})).admitted
+    with pytest.raises(QueueFull):
+        scheduler.enqueue("c", run_keys("stream", "c", gpt4))
+
+    scheduler.release(first)
+    await asyncio.wait_for(second.wait(), 1)
+    assert second.admitted and scheduler.running["model:GPT 4 Turbo"] == 1
+    assert "user:a" not in scheduler.running
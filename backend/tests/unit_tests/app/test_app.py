@@ -4,6 +4,7 @@ from typing import Optional, Sequence
 from uuid import uuid4
 
 import asyncpg
+import orjson
 
 from tests.unit_tests.app.helpers import get_client
 
@@ -107,6 +108,61 @@ async def test_threads() -> None:
         assert response.status_code == 200
         assert response.json() == {"values": None, "next": []}
 
+        response = await client.get(
+            f"/threads/{tid}/state", params={"limit": 10}, headers=headers
+        )
+        assert response.status_code == 200
+        assert response.json() == {"values": None, "next": []}
+
+        response = await client.get(
+            f"/threads/{tid}/history", params={"limit": 10}, headers=headers
+        )
+        assert response.status_code == 200
+        assert response.json() == []
+
+        response = await client.post(
+            f"/threads/{tid}/fork",
+            json={"thread_ts": "2024-01-01T00:00:00+00:00"},
+            headers=headers,
+        )
+        assert response.status_code == 404
+        # Nor from the latest state of a thread without any
+        response = await client.post(f"/threads/{tid}/fork", json={}, headers=headers)
+        assert response.status_code == 404
+        assert response.json()["detail"] == "State not found"
+
+        for method, path in [("get", ""), ("post", "/cancel"), ("get", "/stream")]:
+            response = await getattr(client, method)(
+                f"/runs/{uuid4()}{path}", headers=headers
+            )
+            assert response.status_code == 404
+
+        response = await client.post(
+            "/runs/batch", json={"runs": [{"thread_id": "nope"}]}, headers=headers
+        )
+        assert response.status_code == 422
+        missing = str(uuid4())
+        response = await client.post(
+            "/runs/batch",
+            json={"runs": [{"thread_id": missing}, {"thread_id": tid.upper()}]},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        # Thread IDs are normalized, rather than looked up and cached as given
+        not_found, ran = [orjson.loads(line) for line in response.text.splitlines()]
+        assert not_found == {
+            "index": 0,
+            "thread_id": missing,
+            "error": "Thread not found",
+        }
+        assert (ran["index"], ran["thread_id"]) == (1, tid) and ran["run_id"]
+        response = await client.get(f"/threads/{tid.upper()}", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["thread_id"] == tid
+        response = await client.get("/threads/nope", headers=headers)
+        assert response.status_code == 422
+
         response = await client.get("/threads/", headers=headers)
 
         assert response.status_code == 200
@@ -3,9 +3,12 @@ from datetime import datetime, timedelta, timezone
 from typing import Optional
 from unittest.mock import MagicMock, patch
 
+import httpx
 import jwt
 
-from app.auth.handlers import AuthedUser, get_auth_handler
+from app import metrics
+from app.auth import jwks
+from app.auth.handlers import AuthedUser, JWTAuthLocal, get_auth_handler
 from app.auth.settings import (
     AuthType,
     JWTSettingsLocal,
@@ -73,6 +76,15 @@ async def test_jwt_local():
         response = await client.get("/me", headers={"Authorization": "Bearer xyz"})
         assert response.status_code == 401
 
+    # Metrics are only served to authenticated users
+    async with get_client() as client:
+        response = await client.get("/metrics")
+        assert response.status_code == 403
+        response = await client.get(
+            "/metrics", headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 200
+
 
 async def test_jwt_oidc():
     get_auth_handler.cache_clear()
@@ -106,3 +118,99 @@ async def test_jwt_oidc():
             )
             assert response.status_code == 200
             assert response.json()["sub"] == sub
+
+
+async def test_jwt_oidc_keys():
+    """Keys are fetched with OIDC discovery ahead of requests."""
+    get_auth_handler.cache_clear()
+    auth_settings.auth_type = AuthType.JWT_OIDC
+    auth_settings.jwt_oidc = JWTSettingsOIDC(iss="https://issuer", aud="audience")
+    alg = "HS256"
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/.well-known/openid-configuration":
+            return httpx.Response(200, json={"jwks_uri": "https://issuer/jwks"})
+        return httpx.Response(
+            200,
+            json={"keys": [{"kty": "oct", "k": "a2V5", "kid": "kid", "alg": alg}]},
+            headers={"Cache-Control": "public, max-age=100"},
+        )
+
+    refresh = await jwks.start(
+        auth_settings.jwt_oidc.iss, transport=httpx.MockTransport(handler)
+    )
+    try:
+        keys = jwks.get_issuer_keys(auth_settings.jwt_oidc.iss)
+        assert keys.max_age == 100
+
+        def token(kid: str, iss: str = auth_settings.jwt_oidc.iss) -> str:
+            return _create_jwt(
+                key="key",
+                alg=alg,
+                payload={
+                    "sub": "user_jwt_oidc_keys",
+                    "iss": iss,
+                    "aud": auth_settings.jwt_oidc.aud,
+                    "exp": datetime.now(timezone.utc) + timedelta(days=1),
+                },
+                headers={"kid": kid, "alg": alg},
+            )
+
+        async with get_client() as client:
+            response = await client.get(
+                "/me", headers={"Authorization": f"Bearer {token('kid')}"}
+            )
+            assert response.status_code == 200
+            assert response.json()["sub"] == "user_jwt_oidc_keys"
+
+            # Unknown keys and issuers are rejected, unknown keys wake up the
+            # refresh task
+            response = await client.get(
+                "/me", headers={"Authorization": f"Bearer {token('other')}"}
+            )
+            assert response.status_code == 401
+            assert keys._wakeup.is_set()
+            response = await client.get(
+                "/me",
+                headers={"Authorization": f"Bearer {token('kid', 'https://evil')}"},
+            )
+            assert response.status_code == 401
+    finally:
+        refresh.cancel()
+
+
+async def test_verified_token_cache():
+    """Tokens are only verified once until they expire."""
+    get_auth_handler.cache_clear()
+    auth_settings.auth_type = AuthType.JWT_LOCAL
+    auth_settings.jwt_local = JWTSettingsLocal(
+        alg="HS256",
+        iss="issuer",
+        aud="audience",
+        decode_key_b64=b64encode(b"key"),
+    )
+    token = _create_jwt(
+        key="key",
+        alg="HS256",
+        payload={
+            "sub": "user_cached_token",
+            "iss": "issuer",
+            "aud": "audience",
+            "exp": datetime.now(timezone.utc) + timedelta(days=1),
+        },
+    )
+
+    with patch(
+        "app.auth.handlers.JWTAuthLocal.decode_token",
+        side_effect=JWTAuthLocal.decode_token,
+        autospec=True,
+    ) as decode_token:
+        async with get_client() as client:
+            for _ in range(3):
+                response = await client.get(
+                    "/me", headers={"Authorization": f"Bearer {token}"}
+                )
+                assert response.status_code == 200
+                assert response.json()["sub"] == "user_cached_token"
+    assert decode_token.call_count == 1
+    assert metrics.snapshot()["cache.tokens.hits"] >= 2
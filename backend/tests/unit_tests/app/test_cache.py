@@ -0,0 +1,36 @@
+"""Test the in-process caches."""
+
+from app.cache import LRUCache
+
+
+def test_lru_cache_bounds() -> None:
+    cache = LRUCache("test", maxsize=2, maxbytes=10)
+    cache.set("a", 1, size=4)
+    cache.set("b", 2, size=4)
+    assert cache.get("a") == 1
+
+    # Evicts the least recently used entry
+    cache.set("c", 3, size=1)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    # Evicts until under the size bound, and skips entries too large to fit
+    cache.set("d", 4, size=9)
+    assert list(cache._data) == ["c", "d"] and cache.nbytes == 10
+    cache.set("e", 5, size=11)
+    assert "e" not in cache and len(cache) == 2
+
+    assert cache.pop("c") == 3
+    assert cache.nbytes == 9
+
+
+def test_lru_cache_ttl(monkeypatch) -> None:
+    now = 100.0
+    monkeypatch.setattr("app.cache.time.monotonic", lambda: now)
+    cache = LRUCache("test", maxsize=2, ttl=10)
+    cache.set("a", 1, size=4)
+    now += 5
+    assert cache.get("a") == 1
+    now += 5
+    assert cache.get("a") is None
+    assert len(cache) == 0 and cache.nbytes == 0
@@ -0,0 +1,367 @@
+"""Test the postgres checkpoint saver."""
+
+import pickle
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import Checkpoint, empty_checkpoint
+
+from app import metrics
+from app.checkpoint import LazyChannelValues, PostgresCheckpoint
+from app.message_types import LiberalToolMessage
+from app.serde import get_serializer
+
+
+def _checkpoint(step: int, messages: list) -> Checkpoint:
+    checkpoint = empty_checkpoint()
+    ts = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=step)
+    checkpoint["ts"] = ts.isoformat()
+    checkpoint["channel_values"] = {"__root__": list(messages)}
+    checkpoint["channel_versions"]["__root__"] = step + 1
+    return checkpoint
+
+
+def _conversation(length: int) -> list:
+    return [
+        HumanMessage(content=f"question {i}", id=f"h{i}")
+        if i % 2 == 0
+        else AIMessage(content=f"answer {i}", id=f"a{i}")
+        for i in range(length)
+    ]
+
+
+async def _put_steps(saver: PostgresCheckpoint, thread_id: str, steps: int) -> list:
+    messages = _conversation(steps)
+    config = {"configurable": {"thread_id": thread_id}}
+    for step in range(steps):
+        config = await saver.aput(config, _checkpoint(step, messages[: step + 1]))
+    return messages
+
+
+async def test_delta_checkpoints(pool: asyncpg.pool.Pool) -> None:
+    """Deltas are written between snapshots and rebuilt on read."""
+    saver = PostgresCheckpoint(serde=pickle, snapshot_interval=3)
+    messages = await _put_steps(saver, "thread", 7)
+
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT base_ts IS NULL AS snapshot FROM checkpoints ORDER BY thread_ts"
+        )
+    assert [r["snapshot"] for r in rows] == [True, False, False] * 2 + [True]
+
+    latest = await saver.aget_tuple({"configurable": {"thread_id": "thread"}})
+    assert latest.checkpoint["channel_values"]["__root__"] == messages
+    assert latest.parent_config["configurable"]["thread_ts"] == datetime.fromisoformat(
+        _checkpoint(5, []).get("ts")
+    )
+
+    # Reads from a fresh saver don't depend on anything kept in memory
+    history = [
+        c
+        async for c in PostgresCheckpoint(serde=pickle).alist(
+            {"configurable": {"thread_id": "thread"}}
+        )
+    ]
+    assert [c.checkpoint["channel_values"]["__root__"] for c in history] == [
+        messages[: step + 1] for step in reversed(range(7))
+    ]
+
+    past = await PostgresCheckpoint(serde=pickle).aget_tuple(
+        {
+            "configurable": {
+                "thread_id": "thread",
+                "thread_ts": _checkpoint(4, []).get("ts"),
+            }
+        }
+    )
+    assert past.checkpoint["channel_values"]["__root__"] == messages[:5]
+
+
+async def test_delta_checkpoint_rewritten_history(pool: asyncpg.pool.Pool) -> None:
+    """Values that don't extend the base are stored in full."""
+    saver = PostgresCheckpoint(serde=pickle, snapshot_interval=10)
+    messages = await _put_steps(saver, "thread", 3)
+    edited = [messages[0], HumanMessage(content="edited", id=messages[1].id)]
+    await saver.aput({"configurable": {"thread_id": "thread"}}, _checkpoint(3, edited))
+
+    latest = await PostgresCheckpoint(serde=pickle).aget_tuple(
+        {"configurable": {"thread_id": "thread"}}
+    )
+    assert latest.checkpoint["channel_values"]["__root__"] == edited
+
+
+async def test_latest_checkpoint_cache(pool: asyncpg.pool.Pool) -> None:
+    """The latest checkpoint is served from the cache while it is current."""
+    saver = PostgresCheckpoint(serde=pickle, snapshot_interval=3)
+    messages = await _put_steps(saver, "thread", 2)
+    config = {"configurable": {"thread_id": "thread"}}
+
+    hits = metrics.snapshot().get("cache.checkpoints.hits", 0)
+    latest = await saver.aget_tuple(config)
+    assert latest.checkpoint["channel_values"]["__root__"] == messages[:2]
+    assert metrics.snapshot()["cache.checkpoints.hits"] == hits + 1
+
+    # Mutating a returned checkpoint doesn't affect the cache
+    latest.checkpoint["channel_values"]["__root__"] = []
+    latest.checkpoint["channel_versions"]["__root__"] = 100
+    latest = await saver.aget_tuple(config)
+    assert latest.checkpoint["channel_values"]["__root__"] == messages[:2]
+    assert latest.checkpoint["channel_versions"]["__root__"] == 2
+    # Down to its values, whether they were written or read by the saver
+    for _ in range(2):
+        values = latest.checkpoint["channel_values"]["__root__"]
+        values[0].content = "changed"
+        values.append(AIMessage(content="more"))
+        latest = await saver.aget_tuple(config)
+        assert latest.checkpoint["channel_values"]["__root__"] == messages[:2]
+        saver.latest.clear()
+        latest = await saver.aget_tuple(config)
+
+    # A checkpoint written elsewhere makes the cached one stale
+    other = PostgresCheckpoint(serde=pickle)
+    await other.aput(config, _checkpoint(5, messages[:1]))
+    latest = await saver.aget_tuple(config)
+    assert latest.checkpoint["channel_values"]["__root__"] == messages[:1]
+
+
+async def test_stale_delta_base(pool: asyncpg.pool.Pool) -> None:
+    """Deltas against a cached base that is no longer the latest checkpoint of
+    the thread are written as snapshots."""
+    messages = _conversation(6)
+    config = {"configurable": {"thread_id": "thread"}}
+    for saver in [
+        PostgresCheckpoint(serde=pickle, snapshot_interval=10),
+        PostgresCheckpoint(
+            serde=pickle, snapshot_interval=10, write_behind=True, flush_interval=60
+        ),
+    ]:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM checkpoints")
+        for step in range(2):
+            await saver.aput(config, _checkpoint(step, messages[: step + 1]))
+        await saver.aflush()
+        # Another replica writes to the thread
+        await PostgresCheckpoint(serde=pickle).aput(
+            config, _checkpoint(2, messages[:1])
+        )
+        await saver.aput(config, _checkpoint(3, messages[:4]))
+        await saver.aflush()
+        # Compaction deletes the base
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM checkpoints WHERE thread_ts = $1",
+                datetime.fromisoformat(_checkpoint(3, [])["ts"]),
+            )
+        await saver.aput(config, _checkpoint(4, messages[:5]))
+        await saver.aput(config, _checkpoint(5, messages[:6]))
+        await saver.aclose()
+
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT base_ts IS NULL AS snapshot FROM checkpoints ORDER BY thread_ts"
+            )
+        # Deltas queued after a stale one are written as snapshots too
+        last = saver.write_behind
+        assert [r["snapshot"] for r in rows] == [True, False, True, True, last]
+        history = [c async for c in PostgresCheckpoint(serde=pickle).alist(config)]
+        assert [c.checkpoint["channel_values"]["__root__"] for c in history] == [
+            messages[:6],
+            messages[:5],
+            messages[:1],
+            messages[:2],
+            messages[:1],
+        ]
+
+
+async def test_list_pages(pool: asyncpg.pool.Pool) -> None:
+    """History can be listed one page at a time."""
+    saver = PostgresCheckpoint(serde=pickle, snapshot_interval=3)
+    messages = await _put_steps(saver, "thread", 7)
+    config = {"configurable": {"thread_id": "thread"}}
+
+    pages = []
+    before = None
+    while page := [c async for c in saver.alist(config, before=before, limit=3)]:
+        pages.append([c.checkpoint["channel_values"]["__root__"] for c in page])
+        before = page[-1].config["configurable"]["thread_ts"]
+    assert pages == [
+        [messages[:7], messages[:6], messages[:5]],
+        [messages[:4], messages[:3], messages[:2]],
+        [messages[:1]],
+    ]
+
+    # Graphs list a single page with a view of the saver
+    before = datetime.fromisoformat(_checkpoint(2, [])["ts"])
+    page = [c async for c in saver.page(before=before, limit=1).alist(config)]
+    assert [c.checkpoint["ts"] for c in page] == [_checkpoint(1, [])["ts"]]
+
+
+async def test_write_behind(pool: asyncpg.pool.Pool) -> None:
+    """Queued writes are flushed in batches, and before reads of their thread."""
+    saver = PostgresCheckpoint(
+        serde=pickle, snapshot_interval=3, write_behind=True, flush_interval=60
+    )
+    saver.flush_rows = 4
+    messages = await _put_steps(saver, "thread", 5)
+    await _put_steps(saver, "other", 1)
+
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM checkpoints") == 4
+
+    latest = await PostgresCheckpoint(serde=pickle).aget_tuple(
+        {"configurable": {"thread_id": "thread"}}
+    )
+    assert latest.checkpoint["channel_values"]["__root__"] == messages[:4]
+
+    # Reading the thread from the saver that queued its writes flushes them
+    history = [c async for c in saver.alist({"configurable": {"thread_id": "thread"}})]
+    assert [c.checkpoint["channel_values"]["__root__"] for c in history] == [
+        messages[: step + 1] for step in reversed(range(5))
+    ]
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM checkpoints") == 6
+
+    await _put_steps(saver, "last", 1)
+    timer = saver._flush_timer
+    await saver.aclose()
+    assert timer.cancelled()
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM checkpoints") == 7
+
+
+async def test_lazy_channel_values(pool: asyncpg.pool.Pool) -> None:
+    """Channel values of loaded checkpoints are only revived when read."""
+    saver = PostgresCheckpoint(serde=get_serializer(), snapshot_interval=3)
+    messages = await _put_steps(saver, "thread", 5)
+
+    history = [
+        c
+        async for c in PostgresCheckpoint(serde=get_serializer()).alist(
+            {"configurable": {"thread_id": "thread"}}
+        )
+    ]
+    values = history[0].checkpoint["channel_values"]
+    assert isinstance(values, LazyChannelValues)
+    assert not values._values
+    assert values["__root__"] == messages
+    assert type(values["__root__"][1]) is AIMessage
+    assert values.copy()["__root__"] is values["__root__"]
+    assert dict(history[3].checkpoint["channel_values"]) == {"__root__": messages[:2]}
+
+
+async def test_blobs(pool: asyncpg.pool.Pool) -> None:
+    """Large message contents are stored once, out of line."""
+    saver = PostgresCheckpoint(
+        serde=get_serializer(), snapshot_interval=2, blob_threshold=100
+    )
+    docs = [Document(page_content=f"document {i} " * 200) for i in range(3)]
+    messages = _conversation(5)
+    messages[1] = LiberalToolMessage(tool_call_id="t", content=docs, id="tool")
+    config = {"configurable": {"thread_id": "thread"}}
+    for step in range(5):
+        config = await saver.aput(config, _checkpoint(step, messages[: step + 1]))
+
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM checkpoint_blobs") == 1
+        assert (
+            await conn.fetchval("SELECT max(octet_length(checkpoint)) FROM checkpoints")
+            < 1024
+        )
+
+    history = [
+        c
+        async for c in PostgresCheckpoint(serde=get_serializer()).alist(
+            {"configurable": {"thread_id": "thread"}}
+        )
+    ]
+    assert [c.checkpoint["channel_values"]["__root__"] for c in history] == [
+        messages[: step + 1] for step in reversed(range(5))
+    ]
+    assert history[0].checkpoint["channel_values"]["__root__"][1].content == docs
+
+
+async def test_message_window(pool: asyncpg.pool.Pool) -> None:
+    """A window of the latest messages can be read, from the cache or not."""
+    saver = PostgresCheckpoint(serde=get_serializer(), snapshot_interval=3)
+    messages = await _put_steps(saver, "thread", 8)
+
+    for reader in (saver, PostgresCheckpoint(serde=get_serializer())):
+
+        async def window(**kwargs):
+            latest = await reader.window(**kwargs).aget_tuple(
+                {"configurable": {"thread_id": "thread"}}
+            )
+            return latest.checkpoint["channel_values"]["__root__"]
+
+        assert await window(limit=3) == messages[5:]
+        assert await window(limit=3, offset=2) == messages[3:6]
+        assert await window(limit=4, before_id="h6") == messages[2:6]
+        assert await window(limit=4, before_id="h2") == messages[:2]
+        assert await window(offset=10) == []
+        assert await window(before_id="unknown") == []
+
+        # Configurable keys don't cut the messages of the checkpoint
+        latest = await reader.aget_tuple(
+            {"configurable": {"thread_id": "thread", "messages_limit": 1}}
+        )
+        assert latest.checkpoint["channel_values"]["__root__"] == messages
+
+
+async def test_fork(pool: asyncpg.pool.Pool) -> None:
+    """Forks share the checkpoints of their thread, and diverge from there."""
+    saver = PostgresCheckpoint(serde=get_serializer(), snapshot_interval=3)
+    messages = await _put_steps(saver, "thread", 5)
+
+    forked = await saver.afork(
+        {
+            "configurable": {
+                "thread_id": "thread",
+                "thread_ts": _checkpoint(2, [])["ts"],
+            }
+        },
+        "fork",
+    )
+    assert forked["configurable"]["thread_id"] == "fork"
+    assert await saver.afork({"configurable": {"thread_id": "missing"}}, "x") is None
+    async with pool.acquire() as conn:
+        assert (
+            await conn.fetchval(
+                "SELECT count(*) FROM checkpoints WHERE thread_id = 'fork'"
+            )
+            == 1
+        )
+
+    fresh = PostgresCheckpoint(serde=get_serializer(), snapshot_interval=3)
+    tup = await fresh.aget_tuple({"configurable": {"thread_id": "fork"}})
+    assert tup.checkpoint["channel_values"]["__root__"] == messages[:3]
+    assert tup.checkpoint["channel_versions"] == {"__root__": 3}
+    assert tup.parent_config is None
+
+    # The fork diverges without changing its source
+    checkpoint = _checkpoint(10, [*messages[:3], HumanMessage(content="x", id="x")])
+    checkpoint["ts"] = datetime.now(timezone.utc).isoformat()
+    await fresh.aput(forked, checkpoint)
+    tup = await PostgresCheckpoint(serde=get_serializer()).aget_tuple(
+        {"configurable": {"thread_id": "fork"}}
+    )
+    assert [m.id for m in tup.checkpoint["channel_values"]["__root__"]] == [
+        "h0",
+        "a1",
+        "h2",
+        "x",
+    ]
+    tup = await PostgresCheckpoint(serde=get_serializer()).aget_tuple(
+        {"configurable": {"thread_id": "thread"}}
+    )
+    assert tup.checkpoint["channel_values"]["__root__"] == messages
+
+    # Latest checkpoint of the source, and forks of forks
+    await saver.afork({"configurable": {"thread_id": "thread"}}, "fork2")
+    await saver.afork({"configurable": {"thread_id": "fork"}}, "fork3")
+    for thread_id, expected in (("fork2", 5), ("fork3", 4)):
+        tup = await PostgresCheckpoint(serde=get_serializer()).aget_tuple(
+            {"configurable": {"thread_id": thread_id}}
+        )
+        assert len(tup.checkpoint["channel_values"]["__root__"]) == expected
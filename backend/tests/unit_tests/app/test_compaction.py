@@ -0,0 +1,146 @@
+"""Test the checkpoint compaction worker."""
+
+import pickle
+from uuid import uuid4
+
+import asyncpg
+from langchain_core.messages import HumanMessage
+
+import app.storage as storage
+
+from app.checkpoint import PostgresCheckpoint
+from app.compaction import CompactionSettings, compact_checkpoints
+from tests.unit_tests.app.test_checkpoint import _checkpoint, _put_steps
+
+
+async def _count(pool: asyncpg.pool.Pool, thread_id: str) -> int:
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            "SELECT count(*) FROM checkpoints WHERE thread_id = $1", thread_id
+        )
+
+
+async def test_keep_last(pool: asyncpg.pool.Pool) -> None:
+    """Old checkpoints are deleted, and deltas built on them are rebased."""
+    saver = PostgresCheckpoint(serde=pickle, snapshot_interval=5)
+    messages = await _put_steps(saver, "thread", 7)
+    await _put_steps(saver, "other", 2)
+
+    result = await compact_checkpoints(
+        saver, CompactionSettings(keep_last=3, compaction_batch_size=2)
+    )
+    assert result.rows == 4
+    assert result.bytes > 0
+    assert await _count(pool, "thread") == 3
+    assert await _count(pool, "other") == 2
+
+    history = [
+        c
+        async for c in PostgresCheckpoint(serde=pickle).alist(
+            {"configurable": {"thread_id": "thread"}}
+        )
+    ]
+    assert [c.checkpoint["channel_values"]["__root__"] for c in history] == [
+        messages[: step + 1] for step in reversed(range(4, 7))
+    ]
+
+
+async def test_keep_boundaries(pool: asyncpg.pool.Pool) -> None:
+    """Only the first and last checkpoint of each old run are kept."""
+    saver = PostgresCheckpoint(serde=pickle, snapshot_interval=5)
+    messages = await _put_steps(saver, "thread", 4)
+    # A second run starts without a parent checkpoint
+    messages.append(HumanMessage(content="again", id="h4"))
+    config = {"configurable": {"thread_id": "thread"}}
+    for step in range(4, 7):
+        config = await saver.aput(config, _checkpoint(step, messages))
+
+    result = await compact_checkpoints(
+        saver, CompactionSettings(keep_boundaries_after_days=1)
+    )
+    assert result.rows == 3
+    history = [
+        c
+        async for c in PostgresCheckpoint(serde=pickle).alist(
+            {"configurable": {"thread_id": "thread"}}
+        )
+    ]
+    assert [c.checkpoint["ts"] for c in history] == [
+        _checkpoint(step, [])["ts"] for step in (6, 4, 3, 0)
+    ]
+    assert history[0].checkpoint["channel_values"]["__root__"] == messages
+
+
+async def test_drop_deleted_threads(pool: asyncpg.pool.Pool) -> None:
+    saver = PostgresCheckpoint(serde=pickle)
+    await _put_steps(saver, "deleted", 3)
+
+    settings = CompactionSettings(compaction_min_age=10**10)
+    assert (await compact_checkpoints(saver, settings)).rows == 0
+    settings.drop_deleted_threads = True
+    assert (await compact_checkpoints(saver, settings)).rows == 3
+    assert await _count(pool, "deleted") == 0
+
+
+async def test_drop_orphans(pool: asyncpg.pool.Pool) -> None:
+    """Checkpoints of threads missing from a populated thread table are
+    dropped, and only those."""
+    user, _ = await storage.get_or_create_user("owner")
+    async with pool.acquire() as conn:
+        live = await conn.fetchval(
+            """
+            WITH t AS (
+                INSERT INTO thread (user_id, name)
+                SELECT $1, 'thread' FROM generate_series(1, 1000)
+                RETURNING thread_id
+            )
+            SELECT min(thread_id::text) FROM t""",
+            user["user_id"],
+        )
+    saver = PostgresCheckpoint(serde=pickle)
+    await _put_steps(saver, live, 2)
+    await _put_steps(saver, str(uuid4()), 3)
+    await _put_steps(saver, "deleted", 1)
+
+    settings = CompactionSettings(drop_deleted_threads=True)
+    assert (await compact_checkpoints(saver, settings)).rows == 4
+    assert await _count(pool, live) == 2
+
+
+async def test_collect_blobs(pool: asyncpg.pool.Pool) -> None:
+    saver = PostgresCheckpoint(serde=pickle, blob_threshold=10)
+    config = {"configurable": {"thread_id": "deleted"}}
+    await saver.aput(config, _checkpoint(0, [HumanMessage(content="long " * 10)]))
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE checkpoint_blobs SET touched_at = touched_at - INTERVAL '1 day'"
+        )
+
+    settings = CompactionSettings(drop_deleted_threads=True)
+    result = await compact_checkpoints(saver, settings)
+    assert (result.rows, result.blobs) == (1, 1)
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM checkpoint_blobs") == 0
+
+
+async def test_forks_rebased(pool: asyncpg.pool.Pool) -> None:
+    """Forks outlive the checkpoints they were forked from."""
+    saver = PostgresCheckpoint(serde=pickle, snapshot_interval=5)
+    messages = await _put_steps(saver, "thread", 3)
+    await saver.afork(
+        {
+            "configurable": {
+                "thread_id": "thread",
+                "thread_ts": _checkpoint(0, [])["ts"],
+            }
+        },
+        "fork",
+    )
+
+    result = await compact_checkpoints(saver, CompactionSettings(keep_last=1))
+    assert result.rows == 2
+    assert await _count(pool, "fork") == 1
+    tup = await PostgresCheckpoint(serde=pickle).aget_tuple(
+        {"configurable": {"thread_id": "fork"}}
+    )
+    assert tup.checkpoint["channel_values"]["__root__"] == messages[:1]
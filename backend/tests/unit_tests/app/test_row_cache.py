@@ -0,0 +1,85 @@
+"""Test the row caches and their invalidation."""
+
+import asyncio
+from uuid import uuid4
+
+import asyncpg
+
+import app.storage as storage
+from app import row_cache
+
+
+async def _eventually(check) -> None:
+    for _ in range(100):
+        if await check():
+            return
+        await asyncio.sleep(0.01)
+    assert await check()
+
+
+async def test_invalidated_on_change(pool: asyncpg.pool.Pool) -> None:
+    async def listening():
+        return row_cache._listening
+
+    await _eventually(listening)
+    user, _ = await storage.get_or_create_user("cache")
+    user_id = str(user["user_id"])
+    aid = str(uuid4())
+    await storage.put_assistant(
+        user_id, aid, name="before", config={"configurable": {"type": "chatbot"}}
+    )
+    assert (await storage.get_assistant(user_id, aid))["name"] == "before"
+    assert aid in storage._assistants.rows
+
+    # Changes from another replica are seen once notified
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE assistant SET name = 'after' WHERE assistant_id = $1", aid
+        )
+
+    async def renamed():
+        return (await storage.get_assistant(user_id, aid))["name"] == "after"
+
+    await _eventually(renamed)
+
+    # As are truncated tables, and rows missing from them
+    tid = str(uuid4())
+    assert await storage.get_thread(user_id, tid) is None
+    await storage.put_thread(user_id, tid, assistant_id=aid, name="thread")
+    assert (await storage.get_thread(user_id, tid))["name"] == "thread"
+    async with pool.acquire() as conn:
+        await conn.execute("TRUNCATE thread CASCADE")
+
+    async def truncated():
+        return await storage.get_thread(user_id, tid) is None
+
+    await _eventually(truncated)
+
+
+async def test_cached_rows_copied(pool: asyncpg.pool.Pool) -> None:
+    """Updating a row got from a cache doesn't update the cached row."""
+
+    async def listening():
+        return row_cache._listening
+
+    await _eventually(listening)
+    user, _ = await storage.get_or_create_user("copies")
+    user_id = str(user["user_id"])
+    aid, tid = str(uuid4()), str(uuid4())
+    await storage.put_assistant(
+        user_id, aid, name="bot", config={"configurable": {"type": "chatbot"}}
+    )
+    await storage.put_thread(user_id, tid, assistant_id=aid, name="thread")
+
+    for _ in range(2):
+        thread, assistant = await storage.get_thread_and_assistant(user_id, tid)
+        [(batched, _)] = (
+            await storage.get_threads_and_assistants(user_id, [tid])
+        ).values()
+        assert thread["name"] == batched["name"] == "thread"
+        assert assistant["config"] == {"configurable": {"type": "chatbot"}}
+        thread["name"] = batched["name"] = "changed"
+        assistant["config"]["configurable"]["type"] = "changed"
+    assert (await storage.get_assistant(user_id, aid))["config"] == {
+        "configurable": {"type": "chatbot"}
+    }
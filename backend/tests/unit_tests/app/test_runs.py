@@ -0,0 +1,308 @@
+"""Test runs executed in the background."""
+
+import asyncio
+from uuid import uuid4
+
+import orjson
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, MessageGraph
+
+import app.storage as storage
+from app import admission, metrics, runs
+from app.checkpoint import PostgresCheckpoint
+from app.serde import get_serializer
+
+
+async def _thread() -> tuple[str, dict]:
+    user_id = str((await storage.get_or_create_user("u"))[0]["user_id"])
+    thread_id = str(uuid4())
+    await storage.put_thread(user_id, thread_id, assistant_id=None, name="t")
+    return user_id, {"configurable": {"thread_id": thread_id}}
+
+
+OTHER = str(uuid4())
+
+
+async def test_resume_stream(pool, fake_graph) -> None:
+    user_id, config = await _thread()
+    stream = await runs.start_stream(
+        user_id,
+        fake_graph,
+        [HumanMessage(content="hi", id="h")],
+        config,
+        deltas=True,
+    )
+    assert runs.get_stream(user_id, stream.run_id) is stream
+    assert runs.get_stream(OTHER, stream.run_id) is None
+
+    events = [event async for event in stream.subscribe()]
+    assert [event["id"] for event in events] == [str(i) for i in range(len(events))]
+    assert events[0]["event"] == "metadata" and events[-1]["event"] == "end"
+    assert orjson.loads(events[0]["data"]) == {"run_id": stream.run_id}
+
+    # Resumes after the last event received
+    assert [event async for event in stream.subscribe(1)] == events[2:]
+    assert [event async for event in stream.subscribe(len(events) - 1)] == []
+
+    # Falls back to the final checkpoint once events are no longer buffered
+    stream.events = type(stream.events)(stream.events, maxlen=2)
+    resumed = [event async for event in stream.subscribe(0)]
+    assert [event["event"] for event in resumed] == ["data", "end"]
+    assert [m["content"] for m in orjson.loads(resumed[0]["data"])] == [
+        "hi",
+        "hello big world",
+    ]
+    assert resumed[-1] == events[-1]
+
+    run = await storage.get_run(user_id, stream.run_id)
+    assert run["status"] == "success" and run["started_at"] <= run["ended_at"]
+
+
+async def test_cancel_run(pool) -> None:
+    started = asyncio.Event()
+
+    async def wait(messages):
+        started.set()
+        await asyncio.Event().wait()
+
+    graph = MessageGraph()
+    graph.add_node("wait", wait)
+    graph.set_entry_point("wait")
+    graph.add_edge("wait", END)
+
+    user_id, config = await _thread()
+    run = await runs.start_run(
+        user_id, graph.compile(), [HumanMessage(content="hi")], config
+    )
+    assert run["status"] == "pending"
+    await asyncio.wait_for(started.wait(), 5)
+    assert (await storage.get_run(user_id, run["run_id"]))["status"] == "running"
+
+    assert await runs.cancel(OTHER, run["run_id"]) is None
+    run = await runs.cancel(user_id, run["run_id"])
+    assert run["status"] == "cancelled" and run["ended_at"]
+    assert run["run_id"] not in runs._tasks
+    # Over already
+    assert (await runs.cancel(user_id, run["run_id"]))["status"] == "cancelled"
+
+
+async def test_queued_stream(pool, monkeypatch, fake_graph) -> None:
+    monkeypatch.setattr(admission.scheduler.settings, "max_per_user", 1)
+    started = asyncio.Event()
+
+    async def wait(messages):
+        started.set()
+        await asyncio.Event().wait()
+
+    graph = MessageGraph()
+    graph.add_node("wait", wait)
+    graph.set_entry_point("wait")
+    graph.add_edge("wait", END)
+
+    user_id, config = await _thread()
+    run = await runs.start_run(
+        user_id, graph.compile(), [HumanMessage(content="hi")], config
+    )
+    await asyncio.wait_for(started.wait(), 5)
+    stream = await runs.start_stream(
+        user_id, fake_graph, [HumanMessage(content="hi")], config
+    )
+    assert (await storage.get_run(user_id, stream.run_id))["status"] == "pending"
+
+    await runs.cancel(user_id, run["run_id"])
+    events = [event async for event in stream.subscribe()]
+    assert [event["event"] for event in events[:2]] == ["queue", "metadata"]
+    assert orjson.loads(events[0]["data"]) == {"position": 1}
+    assert events[-1]["event"] == "end"
+
+
+async def test_cancel_abandoned_stream(pool, monkeypatch, fake_graph) -> None:
+    monkeypatch.setattr(runs, "DISCONNECT_GRACE", 0.05)
+
+    async def wait(messages):
+        await asyncio.Event().wait()
+
+    graph = MessageGraph()
+    graph.add_node("model", fake_graph.nodes["model"].bound)
+    graph.add_node("wait", wait)
+    graph.set_entry_point("model")
+    graph.add_edge("model", "wait")
+    graph.add_edge("wait", END)
+    app = graph.compile(checkpointer=MemorySaver())
+
+    user_id, config = await _thread()
+    stream = await runs.start_stream(user_id, app, [HumanMessage(content="hi")], config)
+    events = stream.subscribe()
+    async for event in events:
+        if event["event"] == "data" and "hello big world" in event["data"]:
+            break
+    # The client disconnects, and comes back in time
+    await events.aclose()
+    await asyncio.sleep(0.02)
+    events = stream.subscribe(int(event["id"]))
+    task = asyncio.create_task(events.__anext__())
+    await asyncio.sleep(0.1)
+    assert not stream.done
+    task.cancel()
+    await events.aclose()
+
+    # But not the second time
+    abandoned = metrics.snapshot().get("runs.stream.abandoned", 0)
+    await asyncio.wait_for(runs._tasks[stream.run_id], 1)
+    assert stream.done and stream.events[-1]["event"] == "end"
+    assert metrics.snapshot()["runs.stream.abandoned"] == abandoned + 1
+    run = await storage.get_run(user_id, stream.run_id)
+    assert run["status"] == "cancelled"
+    # The steps completed are kept
+    state = await app.aget_state(config)
+    assert [m.content for m in state.values] == ["hi", "hello big world"]
+
+
+async def test_run_batch(pool) -> None:
+    running, most = 0, 0
+
+    async def echo(messages):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if messages[-1].content == "fail":
+            raise ValueError("failed")
+        return AIMessage(content=messages[-1].content)
+
+    graph = MessageGraph()
+    graph.add_node("echo", echo)
+    graph.set_entry_point("echo")
+    graph.add_edge("echo", END)
+    app = graph.compile(checkpointer=MemorySaver())
+
+    user_id, _ = await _thread()
+    batch = []
+    for content in ["a", "fail", "b", "c", "d"]:
+        _, config = await _thread()
+        batch.append((app, [HumanMessage(content=content)], config))
+    ended = [result async for result in runs.run_batch(user_id, batch, concurrency=2)]
+    assert most == 2
+    assert sorted(
+        (result["index"], result["status"], result["error"]) for result in ended
+    ) == [
+        (0, "success", None),
+        (1, "error", "ValueError"),
+        (2, "success", None),
+        (3, "success", None),
+        (4, "success", None),
+    ]
+    for result in ended:
+        run = await storage.get_run(user_id, result["run_id"])
+        assert run["status"] == result["status"]
+    state = await app.aget_state(batch[2][2])
+    assert [m.content for m in state.values] == ["b", "b"]
+
+    # Runs not started when the iteration stops are cancelled
+    results = runs.run_batch(user_id, batch, concurrency=1)
+    assert (await results.__anext__())["index"] == 0
+    await results.aclose()
+    async with pool.acquire() as conn:
+        statuses = await conn.fetch(
+            """SELECT status FROM run WHERE thread_id = ANY($1::uuid[])
+            AND created_at > $2 ORDER BY created_at""",
+            [config["configurable"]["thread_id"] for _, _, config in batch[2:]],
+            (await storage.get_run(user_id, ended[0]["run_id"]))["created_at"],
+        )
+    assert [row["status"] for row in statuses] == ["cancelled"] * 3
+
+
+async def test_recover_unfinished_runs(pool) -> None:
+    """Runs this replica left unfinished are recorded as interrupted."""
+    user_id, config = await _thread()
+    thread_id = config["configurable"]["thread_id"]
+    pending, running, cancelling, other = (str(uuid4()) for _ in range(4))
+    await storage.put_runs(
+        user_id,
+        [(pending, thread_id), (running, thread_id), (cancelling, thread_id)],
+        instance_id=runs.INSTANCE_ID,
+    )
+    await storage.put_run(user_id, other, thread_id, instance_id="other")
+    assert await storage.begin_run(running)
+    assert await storage.cancel_run(user_id, cancelling)
+
+    await runs.recover()
+    statuses = {
+        run_id: (run["status"], run["error"])
+        for run_id in (pending, running, cancelling, other)
+        if (run := await storage.get_run(user_id, run_id))
+    }
+    assert statuses == {
+        pending: ("error", "Interrupted"),
+        running: ("error", "Interrupted"),
+        cancelling: ("cancelled", None),
+        other: ("pending", None),
+    }
+
+
+async def test_run_keeps_history(pool) -> None:
+    """Message window keys in the config of a run don't cut its history."""
+
+    async def echo(messages):
+        return AIMessage(content=messages[-1].content)
+
+    graph = MessageGraph()
+    graph.add_node("echo", echo)
+    graph.set_entry_point("echo")
+    graph.add_edge("echo", END)
+    app = graph.compile(checkpointer=PostgresCheckpoint(serde=get_serializer()))
+
+    user_id, config = await _thread()
+    config["configurable"].update(
+        messages_limit=1, messages_offset=1, messages_before_id="h"
+    )
+    for content in ["a", "b", "c"]:
+        [result] = [
+            result
+            async for result in runs.run_batch(
+                user_id, [(app, [HumanMessage(content=content)], config)]
+            )
+        ]
+        assert result["status"] == "success"
+    state = await app.aget_state(config)
+    assert [m.content for m in state.values] == ["a", "a", "b", "b", "c", "c"]
+
+
+async def test_run_batch_end_run_fails(pool, monkeypatch) -> None:
+    """Runs whose outcome can't be recorded still get their line."""
+
+    async def echo(messages):
+        return AIMessage(content=messages[-1].content)
+
+    graph = MessageGraph()
+    graph.add_node("echo", echo)
+    graph.set_entry_point("echo")
+    graph.add_edge("echo", END)
+    app = graph.compile(checkpointer=MemorySaver())
+
+    end_run = storage.end_run
+    failed = []
+
+    async def failing_end_run(run_id, status, error=None):
+        if not failed:
+            failed.append(run_id)
+            raise ConnectionError("lost")
+        await end_run(run_id, status, error)
+
+    monkeypatch.setattr(storage, "end_run", failing_end_run)
+    user_id, _ = await _thread()
+    batch = []
+    for content in ["a", "b"]:
+        _, config = await _thread()
+        batch.append((app, [HumanMessage(content=content)], config))
+
+    async def collect():
+        return [result async for result in runs.run_batch(user_id, batch)]
+
+    ended = await asyncio.wait_for(collect(), 5)
+    assert sorted(result["index"] for result in ended) == [0, 1]
+    statuses = {r["run_id"]: (r["status"], r["error"]) for r in ended}
+    assert statuses.pop(failed[0]) == ("error", "ConnectionError")
+    assert list(statuses.values()) == [("success", None)]
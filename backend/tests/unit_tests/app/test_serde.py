@@ -0,0 +1,141 @@
+"""Test the checkpoint serializer."""
+
+import dataclasses
+import enum
+import math
+import pickle
+from datetime import date, datetime, time, timedelta, timezone
+from uuid import UUID
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+
+from app.message_types import LiberalToolMessage
+from app.serde import ALLOWED_MODULES, CheckpointSerializer, get_serializer
+
+
+class Color(enum.Enum):
+    RED = "red"
+
+
+@dataclasses.dataclass(frozen=True)
+class Point:
+    x: int
+    y: tuple
+
+
+def _values() -> dict:
+    return {
+        "messages": [
+            HumanMessage(content="what is langgraph?", id="1"),
+            AIMessage(
+                content="",
+                id="2",
+                tool_calls=[{"name": "retriever", "args": {"q": "x"}, "id": "c1"}],
+            ),
+            LiberalToolMessage(
+                content=[Document(page_content="a doc", metadata={"page": 1})],
+                tool_call_id="c1",
+                id="3",
+            ),
+        ],
+        "count": 3,
+        "raw": b"\x00\x01",
+        "tags": {"a"},
+    }
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_roundtrip(compression: str) -> None:
+    serde = CheckpointSerializer(compression=compression)
+    data = serde.dumps(_values())
+    assert data[:1] == b"\x01"
+    loaded = serde.loads(data)
+    assert loaded == _values()
+    assert type(loaded["messages"][2]) is LiberalToolMessage
+    assert type(loaded["messages"][2].content[0]) is Document
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        datetime(2024, 1, 2, 3, 4, 5, 6, tzinfo=timezone(timedelta(hours=2))),
+        datetime(2024, 1, 2),
+        date(2024, 1, 2),
+        time(3, 4, 5),
+        timedelta(days=-1, seconds=5, microseconds=7),
+        UUID("6a6c3a4e-5a2f-4f7b-9d3e-2b9d9b6b3c11"),
+        (1, "a", (2,)),
+        frozenset({1, 2}),
+        Color.RED,
+        Point(x=1, y=(2, 3)),
+    ],
+)
+def test_roundtrip_types(value, monkeypatch) -> None:
+    monkeypatch.setattr("app.serde.ALLOWED_MODULES", (*ALLOWED_MODULES, "tests."))
+    serde = CheckpointSerializer(compression="none")
+    data = serde.dumps({"value": value, "values": [value]})
+    assert data[:1] == b"\x01"
+    loaded = serde.loads(data)
+    assert loaded == {"value": value, "values": [value]}
+    assert type(loaded["value"]) is type(value)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        {"__t": "x", "__d": {}},
+        {"__t": "os:system", "__d": {"a": 1}},
+        {"__b": "AAE="},
+        {"__s": [1]},
+        {"__t": "dict", "__d": {"__t": "x"}},
+    ],
+)
+def test_roundtrip_reserved_keys(value) -> None:
+    serde = CheckpointSerializer(compression="none")
+    message = AIMessage(
+        content="",
+        tool_calls=[{"name": "tool", "args": value, "id": "c1"}],
+        additional_kwargs={"payload": value},
+    )
+    loaded = serde.loads(serde.dumps({"messages": [message], "raw": value}))
+    assert loaded == {"messages": [message], "raw": value}
+    assert loaded["messages"][0].tool_calls[0]["args"] == value
+
+
+def test_reads_pickle() -> None:
+    serde = get_serializer()
+    assert serde.loads(pickle.dumps(_values())) == _values()
+
+
+def test_falls_back_to_pickle() -> None:
+    serde = get_serializer()
+    for value in [
+        {"keys": {1: "not a string key"}},
+        # Classes it couldn't load back
+        {"value": Point(x=1, y=(2,))},
+        # Floats JSON can't hold
+        {"inf": float("inf")},
+        {"values": [1.5, float("-inf")]},
+    ]:
+        data = serde.dumps(value)
+        assert data == pickle.dumps(value)
+        assert serde.loads(data) == value
+    loaded = serde.loads(serde.dumps({"nan": float("nan")}))
+    assert math.isnan(loaded["nan"])
+
+
+def test_refuses_unknown_classes() -> None:
+    serde = CheckpointSerializer(compression="none")
+    data = b"\x01\x00" + b'{"__t": "os:system", "__d": {}}'
+    with pytest.raises(ValueError):
+        serde.loads(data)
+
+
+def test_configured_compression(monkeypatch) -> None:
+    monkeypatch.setenv("CHECKPOINT_COMPRESSION", "none")
+    assert get_serializer().dumps({})[:2] == b"\x01\x00"
+    monkeypatch.setenv("CHECKPOINT_COMPRESSION", "brotli")
+    with pytest.raises(ValueError):
+        get_serializer()
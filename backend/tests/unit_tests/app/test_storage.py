@@ -0,0 +1,164 @@
+"""Test the storage layer."""
+
+from uuid import uuid4
+
+import asyncpg
+
+import app.storage as storage
+from app import metrics, row_cache
+from app.agent import CHECKPOINTER
+from tests.unit_tests.app.test_checkpoint import _put_steps
+from tests.unit_tests.app.test_row_cache import _eventually
+
+
+async def test_get_thread_and_assistant(pool: asyncpg.pool.Pool) -> None:
+    owner = str((await storage.get_or_create_user("owner"))[0]["user_id"])
+    other = str((await storage.get_or_create_user("other"))[0]["user_id"])
+    aid, tid = str(uuid4()), str(uuid4())
+    await storage.put_assistant(
+        owner, aid, name="bot", config={"configurable": {"type": "chatbot"}}
+    )
+    thread = await storage.put_thread(owner, tid, assistant_id=aid, name="thread")
+    assert thread["metadata"] == {"assistant_type": "chatbot"}
+
+    # Both from the database, then from the caches
+    for _ in range(2):
+        thread, assistant = await storage.get_thread_and_assistant(owner, tid)
+        assert (thread["name"], assistant["name"]) == ("thread", "bot")
+        assert await storage.get_thread_and_assistant(other, tid) == (None, None)
+    assert await storage.get_thread_and_assistant(owner, str(uuid4())) == (None, None)
+
+    # Other users' threads may use a public assistant
+    await storage.put_assistant(
+        owner, aid, name="bot", config={"configurable": {"type": "chatbot"}}
+    )
+    other_tid = str(uuid4())
+    thread = await storage.put_thread(other, other_tid, assistant_id=aid, name="t")
+    assert thread["metadata"] is None
+    assert (await storage.get_thread_and_assistant(other, other_tid))[1] is None
+    await storage.put_assistant(
+        owner,
+        aid,
+        name="bot",
+        config={"configurable": {"type": "chatbot"}},
+        public=True,
+    )
+    assert (await storage.get_thread_and_assistant(other, other_tid))[1]["public"]
+
+    await storage.delete_assistant(owner, aid)
+    thread, assistant = await storage.get_thread_and_assistant(owner, tid)
+    assert thread is not None and assistant is None
+
+
+async def test_get_threads_and_assistants(pool: asyncpg.pool.Pool) -> None:
+    owner = str((await storage.get_or_create_user("owner"))[0]["user_id"])
+    other = str((await storage.get_or_create_user("other"))[0]["user_id"])
+    aid, tid, bare_tid, other_tid, missing = (str(uuid4()) for _ in range(5))
+    await storage.put_assistant(
+        owner, aid, name="bot", config={"configurable": {"type": "chatbot"}}
+    )
+    await storage.put_thread(owner, tid, assistant_id=aid, name="thread")
+    await storage.put_thread(owner, bare_tid, assistant_id=None, name="bare")
+    await storage.put_thread(other, other_tid, assistant_id=None, name="other")
+
+    # Both from the database, then from the caches
+    for _ in range(2):
+        found = await storage.get_threads_and_assistants(
+            owner, [tid, bare_tid, other_tid, missing, tid]
+        )
+        assert {
+            thread_id: (thread and thread["name"], assistant and assistant["name"])
+            for thread_id, (thread, assistant) in found.items()
+        } == {
+            tid: ("thread", "bot"),
+            bare_tid: ("bare", None),
+            other_tid: (None, None),
+            missing: (None, None),
+        }
+    assert found[tid] == await storage.get_thread_and_assistant(owner, tid)
+
+
+async def test_list_pages(pool: asyncpg.pool.Pool) -> None:
+    user_id = str((await storage.get_or_create_user("lister"))[0]["user_id"])
+    assistants = {}
+    for kind in ("chatbot", "agent"):
+        assistants[kind] = str(uuid4())
+        await storage.put_assistant(
+            user_id,
+            assistants[kind],
+            name=f"{kind} assistant",
+            config={"configurable": {"type": kind}},
+        )
+    for i in range(5):
+        kind = "chatbot" if i % 2 == 0 else "agent"
+        await storage.put_thread(
+            user_id, str(uuid4()), assistant_id=assistants[kind], name=f"{kind} {i}"
+        )
+
+    names, before, before_id = [], None, None
+    while page := await storage.list_threads(
+        user_id, limit=2, before=before, before_id=before_id
+    ):
+        names.extend(t["name"] for t in page)
+        before, before_id = page[-1]["updated_at"], page[-1]["thread_id"]
+    assert names == ["chatbot 4", "agent 3", "chatbot 2", "agent 1", "chatbot 0"]
+
+    threads = await storage.list_threads(user_id, assistant_type="agent")
+    assert [t["name"] for t in threads] == ["agent 3", "agent 1"]
+    threads = await storage.list_threads(
+        user_id, assistant_id=assistants["chatbot"], name_prefix="chatbot 2"
+    )
+    assert [t["name"] for t in threads] == ["chatbot 2"]
+
+    assert [a["name"] for a in await storage.list_assistants(user_id, limit=1)] == [
+        "agent assistant"
+    ]
+    assert [
+        a["name"]
+        for a in await storage.list_assistants(user_id, assistant_type="chatbot")
+    ] == ["chatbot assistant"]
+    assert await storage.list_assistants(user_id, name_prefix="x") == []
+    # Prefixes are matched literally
+    assert await storage.list_assistants(user_id, name_prefix="_gent") == []
+    assert await storage.list_threads(user_id, name_prefix="%") == []
+
+
+async def test_thread_history_pages(pool: asyncpg.pool.Pool) -> None:
+    """Thread history is listed a page at a time."""
+    tid = str(uuid4())
+    assistant = {"assistant_id": str(uuid4()), "config": {"configurable": {}}}
+    messages = await _put_steps(CHECKPOINTER, tid, 5)
+
+    history = await storage.get_thread_history(
+        user_id="owner", thread_id=tid, assistant=assistant, limit=2
+    )
+    assert [h["values"] for h in history] == [messages[:5], messages[:4]]
+    history = await storage.get_thread_history(
+        user_id="owner",
+        thread_id=tid,
+        assistant=assistant,
+        limit=2,
+        before=history[-1]["config"]["configurable"]["thread_ts"],
+    )
+    assert [h["values"] for h in history] == [messages[:3], messages[:2]]
+
+
+async def test_get_or_create_user(pool: asyncpg.pool.Pool) -> None:
+    async def listening():
+        return row_cache._listening
+
+    await _eventually(listening)
+    epoch = storage._users.epoch
+    user, created = await storage.get_or_create_user("new")
+    assert created
+
+    async def notified():
+        return storage._users.epoch > epoch
+
+    # Wait for the notification of the insert, then the user stays cached
+    await _eventually(notified)
+    hits = metrics.snapshot().get("cache.user.hits", 0)
+    for _ in range(2):
+        again, created = await storage.get_or_create_user("new")
+        assert not created and again["user_id"] == user["user_id"]
+    assert metrics.snapshot()["cache.user.hits"] == hits + 1
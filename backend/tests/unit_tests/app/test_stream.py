@@ -0,0 +1,97 @@
+"""Test streaming runs as server-sent events."""
+
+import asyncio
+
+import orjson
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langgraph.pregel import Pregel
+
+from app.stream import (
+    MessageDeltas,
+    PartialMessages,
+    astream_state,
+    coalesce,
+    to_sse,
+)
+
+
+async def _events(graph: Pregel, deltas: bool) -> list[tuple[str, object]]:
+    return [
+        (event["event"], orjson.loads(event["data"]) if "data" in event else None)
+        async for event in to_sse(
+            astream_state(
+                graph,
+                [HumanMessage(content="hi", id="h")],
+                {"configurable": {"thread_id": "thread"}},
+                deltas=deltas,
+            )
+        )
+    ]
+
+
+async def test_stream_messages(fake_graph: Pregel) -> None:
+    events = await _events(fake_graph, deltas=False)
+    assert [name for name, _ in events] == ["metadata"] + ["data"] * 7 + ["end"]
+    assert [data[0]["content"] for _, data in events[2:-1]] == [
+        "hello",
+        "hello ",
+        "hello big",
+        "hello big ",
+        "hello big world",
+        "hello big world",
+    ]
+
+
+async def test_stream_deltas(fake_graph: Pregel) -> None:
+    events = await _events(fake_graph, deltas=True)
+    assert [name for name, _ in events] == (
+        ["metadata", "data"] + ["delta"] * 5 + ["data", "end"]
+    )
+    deltas = [data[0] for _, data in events[2:-2]]
+    assert "".join(d["content"] for d in deltas) == "hello big world"
+    assert all(d.keys() == {"id", "content"} for d in deltas)
+    final = events[-2][1][0]
+    assert (final["id"], final["type"], final["content"]) == (
+        deltas[0]["id"],
+        "ai",
+        "hello big world",
+    )
+
+
+async def _source(items: list):
+    for item in items:
+        if isinstance(item, float):
+            await asyncio.sleep(item)
+        else:
+            yield item
+
+
+def _chunk(content: str, id: str = "a") -> AIMessageChunk:
+    return AIMessageChunk(content=content, id=id)
+
+
+async def test_coalesce() -> None:
+    human = HumanMessage(content="hi", id="h")
+    items = [
+        "run",
+        [human],
+        *[MessageDeltas([_chunk(c)]) for c in "abcde"],
+        # Other messages flush the batch
+        MessageDeltas([_chunk("x", id="b")]),
+        # So does the window closing while waiting
+        0.2,
+        MessageDeltas([_chunk("y", id="b")]),
+        [AIMessage(content="xy", id="b")],
+    ]
+    out = [item async for item in coalesce(_source(items), window=0.1, max_chunks=3)]
+    assert out[:2] == ["run", [human]]
+    assert [
+        [(m.id, m.content) for m in item] if isinstance(item, MessageDeltas) else item
+        for item in out[2:-1]
+    ] == [[("a", "abc")], [("a", "de")], [("b", "x")], [("b", "y")]]
+    assert out[-1] == [AIMessage(content="xy", id="b")]
+
+    # Only the last of partial messages is kept
+    items = [PartialMessages([_chunk("a" * n)]) for n in range(1, 5)]
+    out = [item async for item in coalesce(_source(items), window=0.1)]
+    assert out == [items[-1]]
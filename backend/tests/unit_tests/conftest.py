@@ -4,7 +4,13 @@ import subprocess
 
 import asyncpg
 import pytest
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, MessageGraph
+from langgraph.pregel import Pregel
 
+from app import row_cache
 from app.auth.settings import AuthType
 from app.auth.settings import settings as auth_settings
 from app.lifespan import get_pg_pool, lifespan
@@ -79,6 +85,21 @@ async def clear_test_db(pool):
         $$;
         """
         await conn.execute(query)
+    # Don't wait for the notifications of the truncated tables
+    row_cache.invalidate_all()
+
+
+@pytest.fixture
+def fake_graph() -> Pregel:
+    """A graph answering "hello big world", once."""
+    graph = MessageGraph()
+    graph.add_node(
+        "model",
+        GenericFakeChatModel(messages=iter([AIMessage(content="hello big world")])),
+    )
+    graph.set_entry_point("model")
+    graph.add_edge("model", END)
+    return graph.compile(checkpointer=MemorySaver())
 
 
 @pytest.fixture(scope="session")
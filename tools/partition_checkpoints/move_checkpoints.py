@@ -0,0 +1,109 @@
+"""Move checkpoints to the hash partitioned table created by migration 6.
+
+Rows are copied in batches, in primary key order, while the app keeps
+running: writes made in the meantime are mirrored by a trigger. Once all rows
+are copied, the partitioned table takes the place of the old one.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+
+import asyncpg
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Rows are locked until their batch is copied, so that they can't be deleted
+# (and the delete mirrored) before their copy exists.
+COPY_BATCH = """
+WITH batch AS (
+    SELECT * FROM checkpoints
+    WHERE (thread_id, thread_ts) > ($1, $2)
+    ORDER BY thread_id, thread_ts
+    LIMIT $3
+    FOR KEY SHARE
+), copied AS (
+    INSERT INTO checkpoints_partitioned
+    SELECT * FROM batch
+    ON CONFLICT (thread_id, thread_ts) DO NOTHING
+)
+SELECT thread_id, thread_ts, count(*) OVER () AS rows
+FROM batch
+ORDER BY thread_id DESC, thread_ts DESC
+LIMIT 1
+"""
+
+
+async def is_partitioned(conn: asyncpg.Connection) -> bool:
+    return await conn.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE relname = 'checkpoints'"
+    )
+
+
+async def copy_rows(conn: asyncpg.Connection, batch_size: int, pause: float) -> int:
+    last = ("", datetime.min.replace(tzinfo=timezone.utc))
+    total = 0
+    while True:
+        row = await conn.fetchrow(COPY_BATCH, *last, batch_size)
+        if row is None:
+            return total
+        last = (row["thread_id"], row["thread_ts"])
+        total += row["rows"]
+        logger.info(f"Copied {total} checkpoints, up to thread {last[0]}")
+        await asyncio.sleep(pause)
+
+
+async def switch_tables(conn: asyncpg.Connection, drop_old: bool) -> None:
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE checkpoints IN ACCESS EXCLUSIVE MODE")
+        await conn.execute("DROP TRIGGER mirror_checkpoints ON checkpoints")
+        await conn.execute("DROP FUNCTION mirror_checkpoints()")
+        await conn.execute(
+            "ALTER TABLE checkpoints RENAME TO checkpoints_unpartitioned"
+        )
+        await conn.execute("ALTER TABLE checkpoints_partitioned RENAME TO checkpoints")
+    if drop_old:
+        await conn.execute("DROP TABLE checkpoints_unpartitioned")
+        logger.info("Dropped the old checkpoints table")
+    else:
+        logger.info("The old checkpoints table was kept as checkpoints_unpartitioned")
+
+
+async def main(batch_size: int, pause: float, drop_old: bool) -> None:
+    conn = await asyncpg.connect(
+        database=os.environ["POSTGRES_DB"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+    )
+    try:
+        if await is_partitioned(conn):
+            logger.info("Checkpoints are already partitioned")
+            return
+        total = await copy_rows(conn, batch_size, pause)
+        logger.info(f"Copied {total} checkpoints")
+        await switch_tables(conn, drop_old)
+        logger.info("Checkpoints are now partitioned")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--batch-size", type=int, default=5000, help="Rows copied per batch."
+    )
+    parser.add_argument(
+        "--pause", type=float, default=0.1, help="Seconds to wait between batches."
+    )
+    parser.add_argument(
+        "--drop-old", action="store_true", help="Drop the old table once switched."
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size, args.pause, args.drop_old))